@@ -1,11 +1,17 @@
 import httpx
 from telegram import Update
+from telegram._utils.defaultvalue import DefaultValue
 from telegram._utils.types import ODVInput
 from telegram.request import BaseRequest, RequestData
 from typing import Optional, Tuple, Union
 import aiohttp
+import asyncio
 import atexit
 import datetime
+import orjson
+import signal
+import sys
+import time
 
 from my_utils import my_logging, validation_util
 import dotenv
@@ -15,10 +21,13 @@ import multiprocessing
 from telegram.ext import ApplicationBuilder, ContextTypes
 from pytz import timezone
 from my_utils.global_var import GLOBAL_SESSION, atexit_handler
+from my_utils.rate_limit_util import PRIORITY_SEND, FloodLimiter, method_priority
 from telegram.request import BaseRequest
 
 # 日志
 logger = my_logging.get_logger('app')
+# 启动时间
+STARTED_AT = time.perf_counter()
 
 
 def init():
@@ -33,9 +42,9 @@ def init():
     return bot_directories
 
 
-def bootstrap(logger, bot_directories):
-    """启动机器人核心方法"""
-    processes = []
+def load_bots(logger, bot_directories):
+    """ 加载每个机器人的token和处理器 """
+    bots = []
     # 动态加载每个机器人
     for bot_directory in bot_directories:
         try:
@@ -48,15 +57,40 @@ def bootstrap(logger, bot_directories):
             token = os.getenv(f'{bot_directory.upper()}_TOKEN')
             if token is None or len(token) == 0:
                 logger.error(f'{bot_directory.upper()}_TOKEN未设置!')
-            command_handlers = handlers()
-            p_bot = multiprocessing.Process(target=start_bot, args=(
-                bot_directory, token, command_handlers))
-            processes.append(p_bot)
+            bots.append((bot_directory, token, handlers()))
         except ImportError as e:
             logger.error(f"Failed to import bot {bot_directory}: {e}")
+    return bots
+
+
+def bootstrap(logger, bot_directories):
+    """启动机器人核心方法(每个机器人一个进程)"""
+    processes = []
+    for bot_directory, token, command_handlers in load_bots(logger, bot_directories):
+        p_bot = multiprocessing.Process(target=start_bot, args=(
+            bot_directory, token, command_handlers, STARTED_AT))
+        processes.append(p_bot)
     return processes
 
 
+def current_rss_mb() -> Optional[float]:
+    """ 当前进程的常驻内存(MB) """
+    try:
+        with open('/proc/self/status', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def report_startup(name: str, started_at: float):
+    """ 输出启动耗时和内存占用 """
+    logger.info(
+        f'{name} ready in {round(time.perf_counter() - started_at, 2)}s, rss: {current_rss_mb()}MB, pid: {os.getpid()}')
+
+
 async def error_handler(_: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Handles errors in the telegram-python-bot library.
@@ -80,12 +114,37 @@ async def error_handler(_: object, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
 
 
+def resolve_timeout(value: ODVInput[float], default: Optional[float]) -> Optional[float]:
+    """ PTB传入DEFAULT_NONE时使用默认值 """
+    return default if isinstance(value, DefaultValue) else value
+
+
 class AiohttpRequest(BaseRequest):
+    # 发送类接口被限流后自动重试的最大等待时间 超过则交给调用方处理
+    MAX_RETRY_AFTER = 30
+    # 发送类接口被限流后最多自动重试的次数 用完后由PTB抛出RetryAfter
+    MAX_SEND_RETRIES = 3
+
     def __init__(
         self,
         session: Optional[aiohttp.ClientSession] = None,
+        limiter: Optional[FloodLimiter] = None,
+        connect_timeout: Optional[float] = 5.0,
+        read_timeout: Optional[float] = 5.0,
+        write_timeout: Optional[float] = 5.0,
+        pool_timeout: Optional[float] = 1.0,
     ):
         self.session = session or aiohttp.ClientSession()
+        # 出站限流器
+        self.limiter = limiter or FloodLimiter()
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._write_timeout = write_timeout
+        self._pool_timeout = pool_timeout
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return self._read_timeout
 
     async def initialize(self) -> None:
         pass
@@ -93,6 +152,24 @@ class AiohttpRequest(BaseRequest):
     async def shutdown(self) -> None:
         pass
 
+    def build_timeout(self, read_timeout, write_timeout, connect_timeout, pool_timeout,
+                      bounded: bool = True) -> aiohttp.ClientTimeout:
+        """
+        将PTB的超时参数转换为aiohttp的超时配置
+        @param bounded: 是否设置总超时 上传/下载文件时不设置(耗时与文件大小有关 只限制连接和两次读取的间隔)
+        """
+        read_timeout = resolve_timeout(read_timeout, self._read_timeout)
+        write_timeout = resolve_timeout(write_timeout, self._write_timeout)
+        connect_timeout = resolve_timeout(
+            connect_timeout, self._connect_timeout)
+        pool_timeout = resolve_timeout(pool_timeout, self._pool_timeout)
+        # aiohttp的connect包含从连接池获取连接的时间
+        connect = None if connect_timeout is None or pool_timeout is None else connect_timeout + pool_timeout
+        # aiohttp没有单独的写超时 用总超时兜底
+        timeouts = (read_timeout, write_timeout, connect_timeout, pool_timeout)
+        total = None if not bounded or None in timeouts else sum(timeouts)
+        return aiohttp.ClientTimeout(total=total, connect=connect, sock_connect=connect_timeout, sock_read=read_timeout)
+
     async def do_request(
         self,
         url: str,
@@ -103,35 +180,72 @@ class AiohttpRequest(BaseRequest):
         connect_timeout: ODVInput[float] = BaseRequest.DEFAULT_NONE,
         pool_timeout: ODVInput[float] = BaseRequest.DEFAULT_NONE,
     ) -> Tuple[int, bytes]:
-        async with self.session.request(
-            method,
-            url,
-            data=request_data.json_parameters if request_data else None,
-        ) as response:
-            status = response.status
-            payload = await response.read()
-            return status, payload
+        api_method = url.rsplit('/', 1)[-1]
+        priority = method_priority(api_method)
+        chat_id = request_data.parameters.get(
+            'chat_id') if request_data else None
+        # 没有请求参数的是文件下载(get_file之后的下载)
+        has_files = request_data is None or request_data.contains_files
+        timeout = self.build_timeout(
+            read_timeout, write_timeout, connect_timeout, pool_timeout, bounded=not has_files)
+        retries = 0
+        while True:
+            if priority is not None and not await self.limiter.acquire(chat_id, priority):
+                # 输入状态被丢弃 直接当作成功
+                return 200, b'{"ok":true,"result":true}'
+            async with self.session.request(
+                method,
+                url,
+                data=request_data.json_parameters if request_data else None,
+                timeout=timeout,
+                # 状态码交给PTB处理 才能正确抛出RetryAfter等异常
+                raise_for_status=False
+            ) as response:
+                status = response.status
+                payload = await response.read()
+            if status != 429:
+                return status, payload
+            retry_after = self.parse_retry_after(payload)
+            self.limiter.block(chat_id, retry_after)
+            # 只自动重试发送类接口; 编辑交给调用方(MessageEditScheduler)合并快照并退避 输入状态直接放弃
+            if priority != PRIORITY_SEND or retry_after > self.MAX_RETRY_AFTER or retries >= self.MAX_SEND_RETRIES:
+                return status, payload
+            retries += 1
 
+    @staticmethod
+    def parse_retry_after(payload: bytes) -> float:
+        try:
+            return float(orjson.loads(payload)['parameters']['retry_after'])
+        except Exception:
+            return 1.0
 
-COMMON_REQUEST = AiohttpRequest(session=GLOBAL_SESSION)
 
 # 支持的更新类型
 ALLOWED_UPDATES = [Update.MESSAGE, Update.EDITED_MESSAGE,
                    Update.CALLBACK_QUERY, Update.INLINE_QUERY]
 
 
-def start_bot(bot_name, token, command_handlers=None):
-
-    if token is None:
-        logger.error("请先设置BOT TOKEN!")
+async def flush_conversations(_=None):
+    """ 退出前写入延迟批量写入中的会话(只有加载了会话存储的进程需要) """
+    if 'bots.gpt_bot.core.persistence' not in sys.modules:
         return
+    from bots.gpt_bot.core.persistence import CONVERSATION_STORE
+    await CONVERSATION_STORE.close()
+
 
-    application = ApplicationBuilder() \
+def build_application(bot_name, token, command_handlers=None, post_init=None):
+    """ 构建机器人应用 """
+    # 限流按bot token计算 每个机器人使用独立的请求对象和限流器 只共享连接池
+    request = AiohttpRequest(session=GLOBAL_SESSION)
+    builder = ApplicationBuilder() \
         .token(token) \
         .concurrent_updates(True) \
-        .request(COMMON_REQUEST) \
-        .get_updates_request(COMMON_REQUEST) \
-        .build()
+        .request(request) \
+        .get_updates_request(request) \
+        .post_shutdown(flush_conversations)
+    if post_init:
+        builder = builder.post_init(post_init)
+    application = builder.build()
 
     if command_handlers:
         application.add_handlers(command_handlers)
@@ -152,34 +266,109 @@ def start_bot(bot_name, token, command_handlers=None):
         job_queue.run_daily(lucky_draw_notice, time=execute_time)
         # 余额不足提醒
         job_queue.run_daily(balance_lack_notice, time=execute_time)
+    return application
+
+
+def webhook_config(bot_name):
+    """ webhook的地址和端口 """
+    validate_res = validation_util.validate(
+        f'{bot_name.upper()}_WEBHOOK_URL', f'{bot_name.upper()}_WEBHOOK_PORT')
+    webhook_url = validate_res[0]
+    webhook_port = int(validate_res[1])
+    return {
+        'listen': '0.0.0.0',
+        'port': webhook_port,
+        'webhook_url': webhook_url,
+        'url_path': f'webhook/{webhook_url.rsplit("/", 1)[-1]}'
+    }
+
+
+def start_bot(bot_name, token, command_handlers=None, started_at=None):
+
+    if token is None:
+        logger.error("请先设置BOT TOKEN!")
+        return
+
+    started_at = started_at or time.perf_counter()
+
+    async def post_init(_):
+        report_startup(bot_name, started_at)
+
+    application = build_application(
+        bot_name, token, command_handlers, post_init)
 
     if platform.system().lower() == 'windows':
         logger.info(f"{bot_name} is started!!")
         application.run_polling(drop_pending_updates=True,
                                 allowed_updates=ALLOWED_UPDATES)
     else:
-        validate_res = validation_util.validate(
-            f'{bot_name.upper()}_WEBHOOK_URL', f'{bot_name.upper()}_WEBHOOK_PORT')
-        webhook_url = validate_res[0]
-        webhook_port = validate_res[1]
+        config = webhook_config(bot_name)
         logger.info(
-            f"{bot_name} is started at http://127.0.0.1:{webhook_port}!! remote webhook url: {webhook_url}")
+            f"{bot_name} is started at http://127.0.0.1:{config['port']}!! remote webhook url: {config['webhook_url']}")
         application.run_webhook(
-            listen="0.0.0.0",
-            port=webhook_port,
-            webhook_url=webhook_url,
-            url_path=f'webhook/{webhook_url.rsplit("/", 1)[-1]}',
+            **config,
             drop_pending_updates=True,
             allowed_updates=ALLOWED_UPDATES
         )
 
 
+async def run_bots(bots):
+    """ 在同一个事件循环中运行所有机器人 共享连接池/redis连接池/已加载的配置 """
+    applications = []
+    for bot_name, token, command_handlers in bots:
+        if token is None:
+            logger.error(f"{bot_name}: 请先设置BOT TOKEN!")
+            continue
+        applications.append(
+            (bot_name, build_application(bot_name, token, command_handlers)))
+    stop_event = asyncio.Event()
+    if platform.system().lower() != 'windows':
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop_event.set)
+    started = []
+    try:
+        for bot_name, application in applications:
+            await application.initialize()
+            started.append(application)
+            if platform.system().lower() == 'windows':
+                await application.updater.start_polling(drop_pending_updates=True,
+                                                        allowed_updates=ALLOWED_UPDATES)
+                logger.info(f"{bot_name} is started!!")
+            else:
+                config = webhook_config(bot_name)
+                await application.updater.start_webhook(**config, drop_pending_updates=True,
+                                                        allowed_updates=ALLOWED_UPDATES)
+                logger.info(
+                    f"{bot_name} is started at http://127.0.0.1:{config['port']}!! remote webhook url: {config['webhook_url']}")
+            await application.start()
+        report_startup(f'{len(started)} bots', STARTED_AT)
+        await stop_event.wait()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        for application in reversed(started):
+            if application.updater.running:
+                await application.updater.stop()
+            if application.running:
+                await application.stop()
+            await application.shutdown()
+        # application.shutdown()不会调用post_shutdown 在事件循环结束前写入会话
+        await flush_conversations()
+
+
 if __name__ == '__main__':
     atexit.register(atexit_handler)
     bot_directories = init()
-    # Bootstrap!
-    processes = bootstrap(logger, bot_directories)
-    for p in processes:
-        p.start()
-    for p in processes:
-        p.join()
+    # 运行模式 process: 每个机器人一个进程(默认) single: 所有机器人运行在同一个进程的同一个事件循环中
+    if os.getenv('BOT_RUNTIME_MODE', 'process').lower() == 'single':
+        # 单进程模式: 所有机器人共享一个事件循环 全局会话也绑定在这个循环上
+        asyncio.get_event_loop().run_until_complete(
+            run_bots(load_bots(logger, bot_directories)))
+    else:
+        # Bootstrap!
+        processes = bootstrap(logger, bot_directories)
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
@@ -0,0 +1,125 @@
+""" 分片转录基准: 合成一段长音频 对比整段上传和分片并发转录的耗时 并校验拼接后的文本
+本地起一个模拟的转录服务: 音频每秒是一个单音 频率对应一个词 服务按每秒的过零率还原出词 耗时与音频时长成正比
+需要ffmpeg(可在PATH中找到) 未安装时跳过
+
+运行: python -m benchmarks.chunked_transcription [--minutes 分钟] [--concurrency 并发数]
+"""
+import argparse
+import asyncio
+import io
+import math
+import struct
+import time
+import wave
+from difflib import SequenceMatcher
+
+import aiohttp
+from aiohttp import web
+
+from bots.gpt_bot.core.audio import CHUNK_OVERLAP, CHUNK_SECONDS, audio_content, ffmpeg_available, transcribe_chunked
+
+SAMPLE_RATE = 16000
+# 词表大小 第k个词的频率为 BASE_FREQUENCY + k * FREQUENCY_STEP
+WORDS = 50
+BASE_FREQUENCY = 200
+FREQUENCY_STEP = 20
+# 模拟服务的耗时: 固定开销 + 每秒音频的处理时间
+SERVER_OVERHEAD = 0.2
+SERVER_SECONDS_PER_AUDIO_SECOND = 0.02
+
+
+def word_at(second: int) -> str:
+    return f'w{second * 7 % WORDS}'
+
+
+def synthesize(seconds: int) -> bytes:
+    """ 合成的wav 每秒一个词对应频率的正弦波 """
+    frames = bytearray()
+    for second in range(seconds):
+        frequency = BASE_FREQUENCY + int(word_at(second)[1:]) * FREQUENCY_STEP
+        frames += struct.pack(f'<{SAMPLE_RATE}h', *(
+            int(12000 * math.sin(2 * math.pi * frequency * i / SAMPLE_RATE)) for i in range(SAMPLE_RATE)))
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(frames)
+    return buffer.getvalue()
+
+
+def recognize(data: bytes) -> list[str]:
+    """ 模拟识别: 每秒的过零次数约为频率的两倍 """
+    # ffmpeg输出到管道时wav头中的长度不可靠 直接从data块之后读取
+    pcm = data[data.index(b'data') + 8:]
+    samples = struct.unpack(f'<{len(pcm) // 2}h', pcm[:len(pcm) // 2 * 2])
+    words = []
+    for offset in range(0, len(samples) - SAMPLE_RATE // 2, SAMPLE_RATE):
+        frame = samples[offset:offset + SAMPLE_RATE]
+        crossings = sum(1 for a, b in zip(frame, frame[1:]) if (a < 0) != (b < 0))
+        frequency = crossings / 2 * SAMPLE_RATE / len(frame)
+        words.append(f'w{round((frequency - BASE_FREQUENCY) / FREQUENCY_STEP)}')
+    return words
+
+
+async def transcriptions(request: web.Request) -> web.Response:
+    form = await request.post()
+    data = form['file'].file.read()
+    words = await asyncio.to_thread(recognize, data)
+    await asyncio.sleep(SERVER_OVERHEAD + len(words) * SERVER_SECONDS_PER_AUDIO_SECOND)
+    return web.Response(text=' '.join(words))
+
+
+async def run(minutes: float, concurrency: int):
+    seconds = int(minutes * 60)
+    audio = synthesize(seconds)
+    reference = ' '.join(word_at(second) for second in range(seconds))
+    app = web.Application(client_max_size=1 << 30)
+    app.router.add_post('/v1/audio/transcriptions', transcriptions)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    url = f'http://127.0.0.1:{port}/v1/audio/transcriptions'
+    async with aiohttp.ClientSession() as session:
+
+        async def transcribe(file_name: str, data: bytes, mime_type: str) -> str:
+            form = aiohttp.FormData()
+            form.add_field('file', data, filename=file_name, content_type=mime_type)
+            form.add_field('model', 'whisper-1')
+            async with session.post(url, data=form) as response:
+                return await response.text()
+
+        start = time.perf_counter()
+        single = await transcribe('audio.wav', audio, 'audio/wav')
+        single_time = time.perf_counter() - start
+
+        content = audio_content(audio, 'audio.wav', 'audio/wav', seconds)
+        start = time.perf_counter()
+        chunked = await transcribe_chunked(content, transcribe, concurrency=concurrency, codec='wav')
+        chunked_time = time.perf_counter() - start
+    await runner.cleanup()
+
+    print(f'audio={seconds}s chunk={CHUNK_SECONDS}s overlap={CHUNK_OVERLAP}s concurrency={concurrency}')
+    print(f'{"mode":>8} {"seconds":>8} {"accuracy":>9}')
+    for name, elapsed, transcript in (('single', single_time, single), ('chunked', chunked_time, chunked)):
+        accuracy = SequenceMatcher(None, reference.split(), transcript.split(), autojunk=False).ratio()
+        print(f'{name:>8} {elapsed:>8.2f} {accuracy:>9.2%}')
+    if chunked != reference:
+        raise SystemExit('stitched transcript differs from the reference')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--minutes', type=float, default=10)
+    parser.add_argument('--concurrency', type=int, default=4)
+    args = parser.parse_args()
+    if not ffmpeg_available():
+        print('ffmpeg not found on PATH, skip (install ffmpeg to run this benchmark)')
+        return
+    asyncio.run(run(args.minutes, args.concurrency))
+
+
+if __name__ == '__main__':
+    main()
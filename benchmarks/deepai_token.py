@@ -0,0 +1,97 @@
+""" DeepAI api-key生成基准: 原生实现与js2py录制结果逐字节比对 并对比两者的耗时
+已安装js2py时额外用随机的User-Agent实时比对
+
+运行: python -m benchmarks.deepai_token
+"""
+import random
+import statistics
+import time
+
+from bots.gpt_bot.core.deepai_token import DEEP_AI_TOKEN_JS, generate_token
+
+ROUNDS = 200
+# js2py执行DEEP_AI_TOKEN_JS录制的(User-Agent, api-key) 覆盖MD5分块边界(55/56/64字节附近)和非ASCII字符
+RECORDED = (
+    ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36', 'tryit-39758725237-9c3b90d36feb8129fa49a8804ec1d27f'),
+    ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36 Edg/126.0.0.0', 'tryit-39196492349-0733e73a5d41d4ba27fa4ed9936bfdbe'),
+    ('', 'tryit-2440530347-d17282976d115cda7fa82afc74073ff2'),
+    ('a', 'tryit-98179779537-07cd9dbef482b41701110f2397c54487'),
+    ('curl/8.4.0', 'tryit-59886346685-22321d072918334302155ac3c61356a7'),
+    ('Mozilla/5.0 中文 é 😀', 'tryit-41700003443-6408bc60f69c551bef0336aa4ff5a3e4'),
+    ('x' * 30, 'tryit-67873113762-6409d2e508e5800704adc2ae5a5becf5'),
+    ('x' * 31, 'tryit-15638994295-94a4aec12b6bed12a22bfc75cc7c261f'),
+    ('x' * 32, 'tryit-3256172236-5b0b428d502cb122195f67e62cc80993'),
+    ('x' * 33, 'tryit-26704939789-16be3376bfbbf08113f64421b7cd1d25'),
+    ('x' * 40, 'tryit-75888954128-ff1d3d54ab516b1ba0093dc4de14a219'),
+    ('x' * 41, 'tryit-5055071927-91ad0473d99a3fce03ba856d34a360ef'),
+    ('x' * 42, 'tryit-62569074731-a9cfe5bb9fff86abe842496841f9353a'),
+    ('x' * 43, 'tryit-34190306042-3fe4544dcf1f06d481cdb98a172904f9'),
+    ('x' * 44, 'tryit-72483953527-9213815df3818c80af6db91ba0c070b7'),
+    ('x' * 45, 'tryit-34144180244-f55e7e51ef02cc7a1a6d8d0674b0283f'),
+    ('x' * 46, 'tryit-76502571118-31cf077faf1fcd83e80a08d6b3f3e2fe'),
+    ('x' * 47, 'tryit-4186945355-2523a9270afe52064dbc90cab3f73abf'),
+    ('x' * 100, 'tryit-92940603524-30e44d81ac6e7ef12eda5f1c0cba3a15'),
+    ('x' * 110, 'tryit-97554553492-0b5d63ab20e7e5ad3922560e18addb91'),
+    ('x' * 111, 'tryit-9572308373-f0a9916a203c5786c2b7266a6f42fd99'),
+    ('x' * 112, 'tryit-37868377093-d1b3245503457edffee14c86844f479b'),
+    ('x' * 113, 'tryit-48420055148-551089a4b208313747623299846dfaee'),
+    ('x' * 200, 'tryit-33186396905-d60479aef685765c24411e47b4214292'),
+)
+
+
+def percentile(samples: list, q: float) -> float:
+    return statistics.quantiles(samples, n=100)[int(q) - 1]
+
+
+def check_recorded() -> int:
+    mismatches = 0
+    for agent, token in RECORDED:
+        seed = token.split('-')[1]
+        native = generate_token(agent, seed)
+        if native != token:
+            mismatches += 1
+            print(f'mismatch: agent={agent!r} expected={token} native={native}')
+    print(f'recorded: {len(RECORDED) - mismatches}/{len(RECORDED)} match')
+    return mismatches
+
+
+def timed(generate, agents) -> list:
+    latencies = []
+    for agent in agents:
+        start = time.perf_counter()
+        generate(agent)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main():
+    mismatches = check_recorded()
+    rng = random.Random(42)
+    alphabet = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 ;:/().,_-'
+    agents = [''.join(rng.choice(alphabet) for _ in range(rng.randint(60, 160))) for _ in range(ROUNDS)]
+    results = [('native', timed(generate_token, agents))]
+    try:
+        import js2py
+    except ImportError:
+        print('js2py not installed, skip live comparison')
+    else:
+        # 原实现每次请求都重新eval_js
+        results.append(('js2py', timed(lambda agent: js2py.eval_js(DEEP_AI_TOKEN_JS)(agent), agents[:20])))
+        generate_js = js2py.eval_js(DEEP_AI_TOKEN_JS)
+        live = 0
+        for agent in agents[:50]:
+            token = generate_js(agent)
+            if generate_token(agent, token.split('-')[1]) == token:
+                live += 1
+            else:
+                mismatches += 1
+        print(f'live: {live}/50 match')
+    print(f'{"impl":>8} {"p50 us":>10} {"p99 us":>10}')
+    for name, latencies in results:
+        print(f'{name:>8} {percentile(latencies, 50) * 1e6:>10.1f} {percentile(latencies, 99) * 1e6:>10.1f}')
+    if mismatches:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
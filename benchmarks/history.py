@@ -0,0 +1,129 @@
+""" 历史消息存储基准: 列表+字典实现(旧) vs deque+slots记录实现(新) 按不同历史长度对比每次请求的组装+追加+裁剪耗时
+
+运行: python -m benchmarks.history
+"""
+import asyncio
+import time
+
+from bots.gpt_bot.core.history import Temque
+from my_utils import tiktoken_util
+
+MODEL = 'gpt-4o'
+# 每个历史长度模拟的请求数
+REQUESTS = 2000
+# 重复测量次数 取最好成绩以降低噪声
+REPEATS = 3
+PRESET_MESSAGES = [{'role': 'system', 'content': '你是一个知识渊博且友好的通用助手'}]
+
+
+class Context:
+    """ 只提供_trim需要的user_data """
+
+    def __init__(self, model: str):
+        self.user_data = {'current_model': model}
+
+
+class LegacyTemque:
+    """ 旧实现: 列表存储{"obj": message}字典 按token预算切片裁剪 组装时重建列表 """
+
+    def __init__(self, maxlen: int = None):
+        self.core = []
+        self.maxlen = maxlen or float("inf")
+
+    @staticmethod
+    def _tokens(item: dict, encoding_name: str) -> int:
+        if item.get('encoding') != encoding_name:
+            item['tokens'] = tiktoken_util.count_message_tokens(item['obj'], encoding_name)
+            item['encoding'] = encoding_name
+        return item['tokens']
+
+    async def _trim(self, context):
+        model = context.user_data['current_model']
+        is_claude = model.startswith('claude-3')
+        encoding_name = tiktoken_util.encoding_name_for_model(model)
+        budget = tiktoken_util.context_budget(model)
+        core = self.core
+        total = sum(self._tokens(x, encoding_name) for x in core)
+        start = 0
+        while start < len(core) and (len(core) - start > self.maxlen or total > budget):
+            total -= core[start]['tokens']
+            start += 1
+        while is_claude and 0 < start < len(core) and core[start]['obj']['role'] != 'user':
+            start += 1
+        if start:
+            del core[:start]
+
+    async def add_many(self, context=None, *objs):
+        for x in objs:
+            self.core.append({"obj": x})
+        await self._trim(context)
+
+    def window(self, budget: int, model: str) -> list:
+        encoding_name = tiktoken_util.encoding_name_for_model(model)
+        core = self.core
+        start = len(core)
+        while start > 0 and self._tokens(core[start - 1], encoding_name) <= budget:
+            budget -= core[start - 1]['tokens']
+            start -= 1
+        if model and model.startswith('claude-3'):
+            while 0 < start < len(core) and core[start]['obj']['role'] != 'user':
+                start += 1
+        return [x['obj'] for x in core[start:]]
+
+
+def conversation(count: int):
+    for i in range(count):
+        yield {'role': 'user', 'content': f'第{i}个问题 关于历史消息存储的性能'}
+        yield {'role': 'assistant', 'content': f'第{i}个回答 使用deque从左侧淘汰'}
+
+
+def prompt_budget(question: dict) -> int:
+    return tiktoken_util.context_budget(MODEL) - \
+        tiktoken_util.count_tokens(PRESET_MESSAGES) - tiktoken_util.count_message_tokens(question)
+
+
+async def legacy_request(que: LegacyTemque, context, question: dict, answer: dict):
+    new_messages = PRESET_MESSAGES + que.window(prompt_budget(question), MODEL) + [question]
+    await que.add_many(context, question, answer)
+    return new_messages
+
+
+async def current_request(que: Temque, context, question: dict, answer: dict):
+    new_messages = list(PRESET_MESSAGES)
+    new_messages.extend(que.window(prompt_budget(question), MODEL))
+    new_messages.append(question)
+    await que.add_many(context, question, answer)
+    return new_messages
+
+
+def measure(que_class, request, history_size: int) -> tuple[float, list]:
+    async def run():
+        context = Context(MODEL)
+        best = float('inf')
+        last_prompt = []
+        for _ in range(REPEATS):
+            que = que_class(maxlen=history_size)
+            await que.add_many(context, *conversation(history_size // 2))
+            turns = list(conversation(REQUESTS))
+            start = time.perf_counter()
+            for i in range(0, len(turns), 2):
+                last_prompt = await request(que, context, turns[i], turns[i + 1])
+            best = min(best, (time.perf_counter() - start) / REQUESTS)
+        return best, last_prompt
+    return asyncio.run(run())
+
+
+def main():
+    # 预热tiktoken词表 不计入耗时
+    tiktoken_util.count_token('warmup', tiktoken_util.encoding_name_for_model(MODEL))
+    print(f'{"history":>8} {"legacy us/request":>18} {"current us/request":>19} {"speedup":>8}')
+    for history_size in (10, 100, 1_000, 10_000):
+        legacy, legacy_prompt = measure(LegacyTemque, legacy_request, history_size)
+        current, current_prompt = measure(Temque, current_request, history_size)
+        # 两种实现组装出的提示词必须一致
+        assert legacy_prompt == current_prompt, f'history={history_size} 组装结果不一致'
+        print(f'{history_size:>8} {legacy * 1e6:>18.1f} {current * 1e6:>19.1f} {legacy / current:>7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
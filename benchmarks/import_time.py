@@ -0,0 +1,82 @@
+""" 启动耗时检查: 用python -X importtime逐个导入机器人模块 报告最慢的导入 超出预算或重量级依赖被提前导入时返回非0
+
+运行: python -m benchmarks.import_time [--budget 毫秒] [--top 条数] [模块 ...]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+# 默认检查的模块(app.py启动时会导入的机器人入口)
+DEFAULT_MODULES = (
+    'app',
+    'bots.gpt_bot.bot',
+    'bots.dogyun_bot.bot',
+    'bots.tmdb_bot.bot',
+    'bots.github_workflow_bot.bot',
+    'bots.watermark_remove_bot.bot',
+)
+# 每个模块的导入预算(毫秒)
+DEFAULT_BUDGET_MS = 800
+# 只应在首次使用时导入的重量级依赖
+HEAVY_MODULES = frozenset({
+    'cv2', 'numpy', 'pandas', 'docx', 'openai', 'tiktoken', 'fake_useragent', 'js2py'
+})
+
+
+def import_profile(module: str) -> tuple[list[tuple[int, int, str]], str]:
+    """
+    在子进程中导入模块
+    @return: ([(自身耗时us, 累计耗时us, 模块名)], 错误输出)
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, env=dict(os.environ, PYTHONPATH='.'))
+    records = []
+    errors = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            errors.append(line)
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            # 表头
+            continue
+        records.append((int(fields[0]), int(fields[1]), fields[2].strip()))
+    return records, '\n'.join(errors) if result.returncode else ''
+
+
+def check(module: str, budget_ms: float, top: int) -> bool:
+    records, error = import_profile(module)
+    if error:
+        print(f'{module}: 导入失败\n{error}')
+        return False
+    # 目标模块是最后一条记录 其累计耗时即为总耗时
+    total_ms = records[-1][1] / 1000 if records else 0.0
+    eager = sorted({name.split('.')[0] for _, _, name in records} & HEAVY_MODULES)
+    ok = total_ms <= budget_ms and not eager
+    print(f'{module}: {total_ms:.1f}ms / {budget_ms:.0f}ms {"OK" if ok else "FAIL"}')
+    for self_us, cumulative_us, name in sorted(records, reverse=True)[:top]:
+        print(f'    {self_us / 1000:>8.1f}ms self {cumulative_us / 1000:>8.1f}ms cumulative  {name}')
+    if eager:
+        print(f'    提前导入了重量级依赖: {", ".join(eager)}')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES)
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET_MS, help='每个模块的导入预算(毫秒)')
+    parser.add_argument('--top', type=int, default=10, help='展示最慢的导入条数')
+    args = parser.parse_args()
+    # 机器人模块导入时会校验环境变量 与app.py一样先加载.env
+    try:
+        import dotenv
+        dotenv.load_dotenv(override=True)
+    except ImportError:
+        pass
+    results = [check(module, args.budget, args.top) for module in args.modules]
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+""" 近似重复索引基准: 10万条缓存时的查询耗时 以及对轻微改写的召回率和对无关提问的误命中率
+
+运行: python -m benchmarks.near_duplicate
+"""
+import random
+import statistics
+import time
+
+from bots.gpt_bot.core.near_duplicate import NearDuplicateIndex
+
+ENTRIES = 100_000
+QUERIES = 2_000
+NAMESPACE = 'bench'
+# 词表: 随机的双字中文词和英文词 模拟真实提问的词汇多样性
+_vocabulary_random = random.Random(7)
+WORDS = tuple(
+    [''.join(chr(_vocabulary_random.randint(0x4e00, 0x62ff)) for _ in range(2)) for _ in range(3000)] +
+    [''.join(_vocabulary_random.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(_vocabulary_random.randint(3, 8)))
+     for _ in range(1000)])
+
+
+def random_prompt(rng: random.Random) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(8, 20)))
+
+
+def small_edit(rng: random.Random, prompt: str) -> str:
+    """ 模拟改写: 增删一个空白 或替换末尾的一个字符 """
+    if rng.random() < 0.5:
+        position = rng.randrange(len(prompt))
+        return prompt[:position] + ' ' + prompt[position:]
+    return prompt[:-1] + rng.choice('的了吧呀')
+
+
+def percentile(samples: list, q: float) -> float:
+    return statistics.quantiles(samples, n=100)[int(q) - 1]
+
+
+def main():
+    rng = random.Random(42)
+    prompts = [random_prompt(rng) for _ in range(ENTRIES)]
+    index = NearDuplicateIndex(max_entries=ENTRIES)
+    start = time.perf_counter()
+    for i, prompt in enumerate(prompts):
+        index.add(NAMESPACE, prompt, i)
+    build = time.perf_counter() - start
+
+    def run(queries, expected):
+        latencies = []
+        found = 0
+        for query, answer in zip(queries, expected):
+            start = time.perf_counter()
+            result = index.lookup(NAMESPACE, query)
+            latencies.append(time.perf_counter() - start)
+            if result is not None and (answer is None or result[0] == answer):
+                found += 1
+        return latencies, found / len(queries)
+
+    targets = rng.sample(range(ENTRIES), QUERIES)
+    exact_latencies, exact_recall = run([prompts[i] for i in targets], targets)
+    near_latencies, near_recall = run([small_edit(rng, prompts[i]) for i in targets], targets)
+    miss_latencies, false_hits = run([random_prompt(rng) for _ in range(QUERIES)], [None] * QUERIES)
+
+    print(f'entries={len(index)} threshold={index.threshold} bands={index.bands} rows={index.rows} '
+          f'build={build:.1f}s ({build / ENTRIES * 1e6:.1f} us/entry)')
+    print(f'{"query":>10} {"p50 us":>8} {"p99 us":>8} {"hit rate":>9}')
+    for name, latencies, rate in (('exact', exact_latencies, exact_recall),
+                                  ('near', near_latencies, near_recall),
+                                  ('unrelated', miss_latencies, false_hits)):
+        print(f'{name:>10} {percentile(latencies, 50) * 1e6:>8.1f} '
+              f'{percentile(latencies, 99) * 1e6:>8.1f} {rate:>9.1%}')
+
+
+if __name__ == '__main__':
+    main()
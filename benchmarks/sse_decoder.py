@@ -0,0 +1,97 @@
+""" SSE解析器基准: 回放OpenAI风格的流式响应 按不同分片大小对比旧解析器和当前解析器的事件吞吐
+
+运行: python -m benchmarks.sse_decoder
+"""
+import asyncio
+import time
+
+import orjson
+
+from bots.gpt_bot.core.streaming import SSEDecoder
+
+# 每个分片大小回放的次数
+ROUNDS = 5
+# 重复测量次数 取最好成绩以降低噪声
+REPEATS = 5
+
+
+class LegacySSEDecoder(SSEDecoder):
+    """ 旧实现: 逐行切分网络分片 并在每一行上检查事件分隔符 """
+
+    async def aiter_bytes(self, iterator):
+        async for chunk in self._aiter_chunks(iterator):
+            for raw_line in chunk.splitlines():
+                sse = self.decode(raw_line.decode("utf-8"))
+                if sse:
+                    yield sse
+
+    async def _aiter_chunks(self, iterator):
+        data = bytearray()
+        async for chunk in iterator:
+            for line in chunk.splitlines(keepends=True):
+                data.extend(line)
+                if data.endswith((b"\r\r", b"\n\n", b"\r\n\r\n")):
+                    yield bytes(data)
+                    data.clear()
+        if data:
+            yield bytes(data)
+
+
+def recorded_stream(event_count: int = 2000) -> bytes:
+    """ 构造与OpenAI chat.completion.chunk一致的流式响应 """
+    parts = []
+    for i in range(event_count):
+        payload = {
+            'id': 'chatcmpl-9bench',
+            'object': 'chat.completion.chunk',
+            'created': 1718000000,
+            'model': 'gpt-4o',
+            'choices': [{
+                'index': 0,
+                'delta': {'content': f'第{i}个片段 token '},
+                'logprobs': None,
+                'finish_reason': None
+            }]
+        }
+        parts.append(b'data: ' + orjson.dumps(payload) + b'\n\n')
+    parts.append(b'data: [DONE]\n\n')
+    return b''.join(parts)
+
+
+async def replay(raw: bytes, chunk_size: int):
+    for i in range(0, len(raw), chunk_size):
+        yield raw[i:i + chunk_size]
+
+
+async def consume(decoder_class, raw: bytes, chunk_size: int) -> list[str]:
+    return [sse._data async for sse in decoder_class().aiter_bytes(replay(raw, chunk_size))]
+
+
+def measure(decoder_class, raw: bytes, chunk_size: int) -> float:
+    async def run():
+        best = 0.0
+        for _ in range(REPEATS):
+            count = 0
+            start = time.perf_counter()
+            for _ in range(ROUNDS):
+                count += len(await consume(decoder_class, raw, chunk_size))
+            best = max(best, count / (time.perf_counter() - start))
+        return best
+    return asyncio.run(run())
+
+
+def main():
+    raw = recorded_stream()
+    print(f'{"chunk":>6} {"legacy events/s":>16} {"current events/s":>17} {"speedup":>8}')
+    for chunk_size in (7, 64, 512, 4096, 65536):
+        # 两种实现解析出的事件必须一致
+        legacy_events = asyncio.run(consume(LegacySSEDecoder, raw, chunk_size))
+        current_events = asyncio.run(consume(SSEDecoder, raw, chunk_size))
+        assert legacy_events == current_events, f'chunk={chunk_size} 解析结果不一致'
+        legacy = measure(LegacySSEDecoder, raw, chunk_size)
+        current = measure(SSEDecoder, raw, chunk_size)
+        print(f'{chunk_size:>6} {legacy:>16.0f} {current:>17.0f} {current / legacy:>7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+""" 停滞检测的首个token计时: 长语音转录很慢但转录后首个token很快时不应判为停滞
+对照: 首个token本身超时仍判为停滞; 两种情况下首token耗时统计都不包含转录时间
+
+运行: python -m benchmarks.stream_watchdog
+"""
+import asyncio
+import time
+
+from bots.gpt_bot.core.router import PLATFORM_ROUTER
+from bots.gpt_bot.core.watchdog import StreamStalled, watched_request
+
+# 测试用的首个token超时(秒)
+FIRST_TIMEOUT = 0.2
+# 模拟的转录耗时(秒) 远超首个token超时
+TRANSCRIBE_SECONDS = 0.6
+
+
+class FakePlatform:
+    """ 转录耗时TRANSCRIBE_SECONDS 首个token耗时first_token秒 """
+
+    def __init__(self, name: str, first_token: float):
+        self.name = name
+        self.first_token = first_token
+
+    async def prepare_messages(self, content) -> list[dict]:
+        await asyncio.sleep(TRANSCRIBE_SECONDS)
+        return [{'role': 'user', 'content': 'transcript'}]
+
+    async def completion(self, stream: bool, context, session, *messages):
+        await asyncio.sleep(self.first_token)
+        yield 'not_finished', 'hello'
+        yield 'finished', 'hello'
+
+
+async def request(gpt_platform: FakePlatform) -> tuple[list, float]:
+    start = time.perf_counter()
+    results = [result async for result in watched_request(
+        gpt_platform, {'type': 'audio'}, None, None, first_timeout=FIRST_TIMEOUT)]
+    return results, time.perf_counter() - start
+
+
+async def run() -> int:
+    failures = 0
+    results, elapsed = await request(FakePlatform('fast_token', 0.05))
+    ttft = PLATFORM_ROUTER.health('fast_token').ttft
+    print(f'slow transcription + fast token: {results} in {elapsed:.2f}s, ttft={ttft}')
+    if results != [('not_finished', 'hello'), ('finished', 'hello')]:
+        failures += 1
+        print('  expected the answer, the stream was treated as stalled')
+    if ttft is None or ttft >= TRANSCRIBE_SECONDS:
+        failures += 1
+        print('  ttft should not include the transcription time')
+    try:
+        results, elapsed = await request(FakePlatform('slow_token', FIRST_TIMEOUT * 2))
+    except StreamStalled as e:
+        print(f'slow first token: stalled ({e})')
+    else:
+        failures += 1
+        print(f'slow first token: expected StreamStalled, got {results}')
+    return failures
+
+
+def main():
+    if asyncio.run(run()):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
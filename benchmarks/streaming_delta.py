@@ -0,0 +1,85 @@
+""" 流式回答管线基准: 累积拼接(旧) vs 增量(新) 每个token的平均耗时
+
+运行: python -m benchmarks.streaming_delta
+"""
+import asyncio
+import time
+
+# 模拟单个token的文本
+TOKEN = '测试token '
+# 模拟Telegram消息的最大长度
+MAX_MESSAGE_LENGTH = 3500
+
+
+async def cumulative_producer(count: int):
+    # 旧约定: 每个token都拼接一次完整回答
+    answer = ''
+    answer_parts = []
+    for _ in range(count):
+        answer_parts.append(TOKEN)
+        answer = ''.join(answer_parts)
+        yield 'not_finished', answer
+    yield 'finished', answer
+
+
+async def delta_producer(count: int):
+    # 新约定: 只返回增量 结束时拼接一次
+    answer_parts = []
+    for _ in range(count):
+        answer_parts.append(TOKEN)
+        yield 'not_finished', TOKEN
+    yield 'finished', ''.join(answer_parts)
+
+
+async def cumulative_consumer(count: int):
+    prev_answer = ''
+    message_content = ''
+    current_message_length = 0
+    async for status, curr_answer in cumulative_producer(count):
+        if abs(len(curr_answer) - len(prev_answer)) < 100 and status != 'finished':
+            continue
+        new_content = curr_answer[len(prev_answer):]
+        if current_message_length + len(new_content) <= MAX_MESSAGE_LENGTH:
+            message_content += new_content
+        current_message_length += len(new_content)
+        prev_answer = curr_answer
+    return prev_answer
+
+
+async def delta_consumer(count: int):
+    answer = ''
+    answer_length = 0
+    edited_length = 0
+    pending_parts = []
+    message_content = ''
+    async for status, item in delta_producer(count):
+        if status == 'finished':
+            answer = item
+            continue
+        pending_parts.append(item)
+        answer_length += len(item)
+        if answer_length - edited_length < 100:
+            continue
+        edited_length = answer_length
+        if answer_length <= MAX_MESSAGE_LENGTH:
+            message_content += ''.join(pending_parts)
+        pending_parts.clear()
+    return answer
+
+
+def measure(consumer, count: int) -> float:
+    start = time.perf_counter()
+    asyncio.run(consumer(count))
+    return (time.perf_counter() - start) / count * 1e9
+
+
+def main():
+    print(f'{"tokens":>8} {"cumulative ns/token":>20} {"delta ns/token":>16}')
+    for count in (1_000, 4_000, 16_000, 32_000):
+        old = measure(cumulative_consumer, count)
+        new = measure(delta_consumer, count)
+        print(f'{count:>8} {old:>20.0f} {new:>16.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -9,20 +9,30 @@ import mimetypes
 import os
 import re
 import traceback
-import cv2
-import numpy as np
+from typing import TYPE_CHECKING
 
 import regex
 import requests
 from telegram import File, Update, InlineKeyboardButton, InlineKeyboardMarkup, Message
 from telegram.constants import ParseMode
 from telegram.ext import MessageHandler,  CallbackContext, CommandHandler, CallbackQueryHandler, filters, ContextTypes
-from bots.gpt_bot.gpt_platform import Platform
-
-from my_utils import code_util, my_logging, bot_util, tiktoken_util
-from my_utils.bot_util import auth, instantiate_platform, migrate_platform
-from my_utils.document_util import DocumentHandler
+from bots.gpt_bot.core.audio import prepare_audio
+from bots.gpt_bot.core.compaction import COMPACTION_WORKER
+from bots.gpt_bot.core.edit_scheduler import MessageEditScheduler
+from bots.gpt_bot.core.hedging import hedged_stream_request
+from bots.gpt_bot.core.persistence import CONVERSATION_STORE
+from bots.gpt_bot.core.response_cache import IMAGE_URL_TTL, RESPONSE_CACHE
+from bots.gpt_bot.core.router import PLATFORM_ROUTER
+from bots.gpt_bot.core.watchdog import continue_on_stall, watched_request
+from bots.gpt_bot.gpt_http_request import BALANCE_CACHE
+
+from my_utils import code_util, my_logging, bot_util
+from my_utils.bot_util import auth, handover_platform, instantiate_platform, migrate_platform
 from my_utils.global_var import GLOBAL_SESSION
+
+if TYPE_CHECKING:
+    # 平台模块依赖openai 只在首次实例化平台时导入
+    from bots.gpt_bot.gpt_platform import Platform
 # 获取日志
 logger = my_logging.get_logger('gpt_bot')
 # 正则
@@ -54,11 +64,84 @@ async def start(update: Update, context: CallbackContext) -> None:
         "/model - 切换模型\n"
         "/balance - 余额查询\n"
         "/platform - 切换平台\n"
+        "/auto - 开启/关闭自动选择平台\n"
         "/shop - 充值\n\n"
     )
     await update.message.reply_text(start_message)
 
 
+def routable_platform_keys(context: CallbackContext):
+    """ 用户可以使用的平台 与平台键盘保持一致 """
+    if context.user_data['identity'] == 'user':
+        return PLATFORMS.keys()
+    return [key for key in PLATFORMS if key.startswith('free')]
+
+
+async def route_platform(update: Update, context: CallbackContext):
+    """
+    自动路由: 切换到支持当前面具和模型的最健康平台(当前平台熔断或明显更慢时)
+    """
+    current_platform: Platform = context.user_data['current_platform']
+    current_mask = context.user_data['current_mask']
+    # 语音输入需要平台支持转录
+    required_models = ('whisper-1',) if update.message.audio or update.message.voice else ()
+    selected_platform_key = PLATFORM_ROUTER.choose(
+        current_platform.name, PLATFORMS, current_mask['mask_key'], context.user_data['current_model'],
+        routable_platform_keys(context), required_models)
+    if selected_platform_key == current_platform.name:
+        return
+    logger.info(f'auto route {current_platform.name} -> {selected_platform_key}: '
+                f'{PLATFORM_ROUTER.health(current_platform.name)}')
+    # 自动切换保留历史消息(手动切换平台才清空)
+    context.user_data['current_platform'] = await handover_platform(
+        current_platform, selected_platform_key, current_mask['max_message_count'])
+
+
+async def hedge_partner(context: CallbackContext, content):
+    """
+    对冲平台: 面具开启了对冲请求时 选择支持当前面具和模型的最健康的另一个平台
+    同一用户按(平台, api_key)复用对冲平台的实例 不为每条消息重新创建
+    @return: 平台对象 不需要对冲时返回None
+    """
+    current_mask = context.user_data['current_mask']
+    # 语音需要先转录 不参与对冲
+    if not current_mask.get('hedged_request') or isinstance(content, dict):
+        return None
+    current_platform: Platform = context.user_data['current_platform']
+    candidates = PLATFORM_ROUTER.candidates(
+        PLATFORMS, current_mask['mask_key'], context.user_data['current_model'], routable_platform_keys(context))
+    partner_key = next((key for key in candidates if key != current_platform.name), None)
+    if partner_key is None:
+        return None
+    # 对冲平台的历史消息每次都从当前平台复制 实例只在同一用户内复用
+    partners: dict = context.user_data.setdefault('hedge_partners', {})
+    key = (partner_key, PLATFORMS[partner_key].get('openai_api_key'))
+    partner_platform = partners.get(key)
+    if partner_platform is None:
+        partner_platform = partners[key] = await instantiate_platform(partner_key)
+    return partner_platform
+
+
+async def stream_answer(context: CallbackContext, content, session: aiohttp.ClientSession, origin: dict | None = None):
+    """
+    当前平台的流式回答 需要时与对冲平台竞速
+    对冲平台在开始迭代时才选择 回答缓存命中时不会创建
+    @param origin: 实际给出回答的平台名称写入origin['platform']
+    """
+    gpt_platform: Platform = context.user_data['current_platform']
+    partner_platform = await hedge_partner(context, content)
+    if partner_platform is None:
+        results = watched_request(gpt_platform, content, context, session)
+    else:
+        results = hedged_stream_request(
+            gpt_platform, partner_platform, content, context, session, origin)
+    try:
+        async for result in results:
+            yield result
+    finally:
+        await results.aclose()
+
+
 def compress_question(question):
     # 使用 regex 库替代 re 库进行正则匹配
     question = regex.sub(r'\s+', ' ', question).strip()
@@ -73,6 +156,8 @@ async def answer(update: Update, context: CallbackContext) -> None:
     is_image_generator = context.user_data.get(
         'current_mask')['mask_key'] == 'image_generator'
     init_message_task = None
+    if context.user_data.get('auto_route') and not is_image_generator:
+        await route_platform(update, context)
     if ENABLE_STREAM:
         message_text = '正在生成图片，请稍候...' if is_image_generator else '正在输入...'
         init_message_task = asyncio.create_task(
@@ -107,6 +192,9 @@ async def answer(update: Update, context: CallbackContext) -> None:
             await handle_stream_response(update, context, content_task, is_image_generator, init_message_task, GLOBAL_SESSION)
         else:
             await handle_response(update, context, content_task, is_image_generator, GLOBAL_SESSION)
+        if not is_image_generator:
+            # 回答已发出 在后台把较早的长消息压缩为摘要
+            COMPACTION_WORKER.submit(context, GLOBAL_SESSION, update.effective_user.id)
     except Exception as e:
         await handle_exception(update, context, e, init_message_task)
 
@@ -179,6 +267,8 @@ async def handle_document_download(update: Update, context: CallbackContext):
     document = update.message.document
     file: File = await context.bot.get_file(document.file_id)
     document_bytes = await file.download_as_bytearray()
+    # pandas/docx较重 收到文档时才导入
+    from my_utils.document_util import DocumentHandler
     return DocumentHandler.format(document_bytes, document.mime_type)
 
 
@@ -193,22 +283,14 @@ async def handle_document(update: Update, context: CallbackContext):
 async def handle_audio(update: Update, context: CallbackContext):
     current_platform: Platform = context.user_data['current_platform']
     audio_file = update.message.audio or update.message.voice
-    if audio_file:
-        file_id = audio_file.file_id
-        new_file: File = await context.bot.get_file(file_id)
-        ogg_path = os.path.join(f"temp/{file_id}.ogg")
-        if 'whisper-1' not in current_platform.supported_models:
-            raise RuntimeError(f'当前平台: {current_platform.name_zh}不支持语音输入!')
-        else:
-            await new_file.download_to_drive(ogg_path)
-            content = {
-                'type': 'audio',
-                'audio_path': ogg_path
-            }
-        try:
-            return content
-        except Exception as e:
-            raise ValueError(e)
+    if 'whisper-1' not in current_platform.supported_models:
+        raise RuntimeError(f'当前平台: {current_platform.name_zh}不支持语音输入!')
+    new_file: File = await context.bot.get_file(audio_file.file_id)
+    # 下载到内存 不落盘
+    data = bytes(await new_file.download_as_bytearray())
+    file_name = getattr(audio_file, 'file_name', None) or f'{audio_file.file_unique_id}.ogg'
+    return await prepare_audio(data, file_name, audio_file.mime_type or 'audio/ogg',
+                               is_voice=update.message.voice is not None, duration=audio_file.duration or 0)
 
 
 async def analyse_video(update: Update, context: CallbackContext):
@@ -236,6 +318,7 @@ async def analyse_video(update: Update, context: CallbackContext):
     # Process the video
     key_frames = process_video(video_path)
     # Save key frames
+    import cv2
     for _, frame in key_frames:
         _, buffer = cv2.imencode('.jpg', frame)
         image_base64 = base64.b64encode(buffer).decode("utf-8")
@@ -282,6 +365,8 @@ async def handle_video(update: Update, context: CallbackContext):
 
 
 def calculate_diff(prev_frame, frame):
+    import cv2
+    import numpy as np
     diff = cv2.absdiff(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY),
                        cv2.cvtColor(prev_frame, cv2.COLOR_BGR2GRAY))
     non_zero_count = np.count_nonzero(diff)
@@ -291,6 +376,9 @@ def calculate_diff(prev_frame, frame):
 
 
 def process_video(video_path):
+    # opencv/numpy较重 收到视频时才导入
+    import cv2
+    import numpy as np
     cap = cv2.VideoCapture(video_path)
     prev_frame = None
     frame_count = 0
@@ -396,15 +484,20 @@ def generate_additional_keyboard(infos):
 
 async def handle_stream_response(update: Update, context: CallbackContext, content_task, is_image_generator: bool,
                                  init_message_task, session: aiohttp.ClientSession):
-    prev_answer = ''
-    current_message_length = 0
+    # 已接收的回答长度
+    answer_length = 0
+    # 完整回答 流结束时由平台一次性给出
+    answer = ''
     max_message_length = 3500
-    message_content = ''
+    # 已显示的增量 编辑时才拼接
+    message_parts = []
     need_notice = True
     gpt_platform: Platform = context.user_data['current_platform']
     init_message, content = await asyncio.gather(init_message_task, content_task)
     if is_image_generator:
-        async for _, curr_answer in gpt_platform.async_stream_request_img(content, context, session):
+        results = RESPONSE_CACHE.wrap(RESPONSE_CACHE.key_for(context, content), gpt_platform.async_stream_request_img(
+            content, context, session), incremental=False, ttl=IMAGE_URL_TTL)
+        async for _, curr_answer in results:
             async with session.get(curr_answer) as img_response:
                 if img_response.content:
                     await asyncio.gather(
@@ -412,62 +505,63 @@ async def handle_stream_response(update: Update, context: CallbackContext, conte
                             update, context, init_message.message_id, True, '图片生成成功! 正在发送...'),
                         update.message.reply_photo(photo=await img_response.content.read(),
                                                    reply_to_message_id=update.effective_message.message_id))
-    elif gpt_platform.name == 'free_2':
-        async for status, curr_answer in gpt_platform.async_stream_request(content, context, session):
-            # 如果状态是additional 则追加内联按钮
-            if status == 'additional' and need_notice:
-                try:
-                    if curr_answer:
-                        if curr_answer.startswith('\x1c'):
-                            json_data = orjson.loads(curr_answer[1:])
-                        else:
-                            json_data = orjson.loads(curr_answer)
-                        infos = json_data[:min(3, len(json_data))]
-                        await context.bot.edit_message_reply_markup(chat_id=update.message.chat_id, message_id=init_message.message_id, reply_markup=generate_additional_keyboard(infos))
-                except:
-                    continue
-                continue
-            if abs(len(curr_answer) - len(prev_answer)) < 100 and status != 'finished':
-                continue
-            new_content = curr_answer[len(prev_answer):]
-            new_content_length = len(new_content)
-            if current_message_length + new_content_length > max_message_length:
-                if need_notice:
-                    need_notice = False
-                    await bot_util.edit_message(update, context, init_message.message_id, stream_ended=True, text="消息过长，内容正发往在线分享平台...")
-                current_message_length += new_content_length
-                prev_answer = curr_answer
-                continue
-            if new_content:
-                message_content += new_content
-                current_message_length += new_content_length
-
-            await bot_util.edit_message(update, context, init_message.message_id, status == 'finished', message_content)
-            # await asyncio.sleep(0.01)
-            prev_answer = curr_answer
     else:
-        async for status, curr_answer in gpt_platform.async_stream_request(content, context, session):
-            if abs(len(curr_answer) - len(prev_answer)) < 100 and status != 'finished':
-                continue
-            new_content = curr_answer[len(prev_answer):]
-            new_content_length = len(new_content)
-            if current_message_length + new_content_length > max_message_length:
-                if need_notice:
-                    need_notice = False
-                    await bot_util.edit_message(update, context, init_message.message_id, stream_ended=True, text="消息过长，内容正发往在线分享平台...")
-                current_message_length += new_content_length
-                prev_answer = curr_answer
-                continue
-            if new_content:
-                message_content += new_content
-                current_message_length += new_content_length
-            await bot_util.edit_message(update, context, init_message.message_id, status == 'finished', message_content)
-            # await asyncio.sleep(0.01)
-            prev_answer = curr_answer
+        # 编辑由调度器在后台完成 接收回答不会被编辑阻塞
+        scheduler = MessageEditScheduler(
+            update, context, init_message.message_id)
+
+        def render() -> str:
+            # 调度器真正编辑时才拼接 每个增量只追加到列表
+            return ''.join(message_parts)
+
+        try:
+            # 实际给出回答的平台 对冲平台胜出或发生续写时会变化
+            origin = {'platform': gpt_platform.name}
+            # 上游停滞时由其他平台续写
+            results = continue_on_stall(
+                stream_answer(context, content, session, origin), content, context, session,
+                routable_platform_keys(context), origin)
+            # 无状态面具的相同提问直接返回缓存的回答
+            results = RESPONSE_CACHE.wrap(
+                RESPONSE_CACHE.key_for(context, content), results,
+                producer=lambda: origin['platform'])
+            # 流式约定: not_finished携带增量 finished携带完整回答 additional为附加信息(free_2)
+            async for status, item in results:
+                # 如果状态是additional 则追加内联按钮
+                if status == 'additional':
+                    if need_notice:
+                        try:
+                            if item:
+                                if item.startswith('\x1c'):
+                                    json_data = orjson.loads(item[1:])
+                                else:
+                                    json_data = orjson.loads(item)
+                                infos = json_data[:min(3, len(json_data))]
+                                await context.bot.edit_message_reply_markup(chat_id=update.message.chat_id, message_id=init_message.message_id, reply_markup=generate_additional_keyboard(infos))
+                        except:
+                            pass
+                    continue
+                if status == 'finished':
+                    answer = item
+                    # 最后一次编辑使用markdown格式 超长的回答由下面发往在线分享平台
+                    await scheduler.close(answer if need_notice else None)
+                    continue
+                answer_length += len(item)
+                if answer_length > max_message_length:
+                    if need_notice:
+                        need_notice = False
+                        scheduler.submit("消息过长，内容正发往在线分享平台...")
+                    continue
+                message_parts.append(item)
+                scheduler.submit(render)
+        except:
+            scheduler.cancel()
+            raise
+        await scheduler.close()
 
     if not need_notice:
         # 将剩余数据保存到在线代码分享平台
-        async with session.post(f'{bot_util.HASTE_SERVER_HOST}/documents', data=prev_answer.encode('utf-8')) as response:
+        async with session.post(f'{bot_util.HASTE_SERVER_HOST}/documents', data=answer.encode('utf-8')) as response:
             if response.status == 200:
                 result = await response.json()
                 document_id = result.get('key')
@@ -484,7 +578,12 @@ async def handle_response(update: Update, context: CallbackContext, content_task
     await bot_util.send_typing(update)
     gpt_platform: Platform = context.user_data['current_platform']
     content = await content_task
-    async for res in gpt_platform.async_request(content, context, session):
+    results = gpt_platform.async_request(content, context, session)
+    if not is_image_generator:
+        results = PLATFORM_ROUTER.observe(gpt_platform.name, results)
+    results = RESPONSE_CACHE.wrap(RESPONSE_CACHE.key_for(context, content), results, stream=False,
+                                  ttl=IMAGE_URL_TTL if is_image_generator else None)
+    async for res in results:
         if res is None or len(res) == 0:
             continue
         if is_image_generator:
@@ -531,10 +630,10 @@ async def exception_message_handler(update, context, init_message_task, text):
 @auth
 async def balance_handler(update: Update, context: CallbackContext):
     await bot_util.send_typing(update)
-    # 使用平台内置的方法查询余额
+    # 使用平台内置的方法查询余额 短时间内的重复查询直接返回缓存
     platform: Platform = context.user_data['current_platform']
     try:
-        balance_result = await platform.query_balance()
+        balance_result = await BALANCE_CACHE.query(platform)
         await bot_util.send_message(update, balance_result)
     except Exception as e:
         traceback.print_exc()
@@ -564,6 +663,7 @@ async def restore_context_handler(update: Update, context: CallbackContext):
     query = update.callback_query
     await query.answer()
     await context.user_data['current_platform'].chat.recover_messages(context)
+    CONVERSATION_STORE.mark_dirty(update.effective_user.id, context.user_data)
     await query.edit_message_text(text="上下文已恢复")
 
 
@@ -638,6 +738,7 @@ async def mask_selection_handler(update: Update, context: CallbackContext):
         selected_mask['max_message_count'])
     # 切换面具后清除上下文
     current_platform.chat.clear_messages(context)
+    CONVERSATION_STORE.mark_dirty(update.effective_user.id, context.user_data)
     await query.edit_message_text(text=bot_util.escape_markdown_v2(
         MASKS[selected_mask_key]['introduction'], False), parse_mode=ParseMode.MARKDOWN_V2)
 
@@ -705,6 +806,7 @@ async def model_selection_handler(update: Update, context: CallbackContext):
     # 根据选择的模型进行相应的处理
     # 切换模型后清除上下文
     context.user_data['current_platform'].chat.clear_messages(context)
+    CONVERSATION_STORE.mark_dirty(update.effective_user.id, context.user_data)
     await query.edit_message_text(
         text=f'模型已切换至*{bot_util.escape_markdown_v2(selected_model,False)}*',
         parse_mode=ParseMode.MARKDOWN_V2
@@ -731,7 +833,22 @@ async def platform_handler(update: Update, context: CallbackContext):
     )
 
 
-def generate_platform_keyboard(update, context, current_platform: Platform):
+@auth
+async def auto_route_handler(update: Update, context: CallbackContext):
+    """
+    开启/关闭自动选择平台
+    Args:
+            update:  更新对象
+            context:  上下文对象
+    """
+    auto_route = context.user_data['auto_route'] = not context.user_data.get('auto_route', False)
+    if auto_route:
+        await update.message.reply_text('已开启自动选择平台: 当前平台故障或明显变慢时自动切换到支持当前面具和模型的平台')
+    else:
+        await update.message.reply_text('已关闭自动选择平台')
+
+
+def generate_platform_keyboard(update, context, current_platform: 'Platform'):
     keyboard = []
     row = []
     if context.user_data['identity'] == 'user':
@@ -827,6 +944,7 @@ async def platform_selection_handler(update: Update, context: CallbackContext):
     # 切换平台 需要转移平台的状态(api-key更改 历史消息迁移)
     context.user_data['current_platform'] = await migrate_platform(from_platform=current_platform, to_platform_key=selected_platform_key,
                                                                    context=context, max_message_count=current_mask['max_message_count'])
+    CONVERSATION_STORE.mark_dirty(update.effective_user.id, context.user_data)
     await query.edit_message_text(
         text=f'平台已切换至[{bot_util.escape_markdown_v2(PLATFORMS[selected_platform_key]["name"])}]({bot_util.escape_markdown_v2(PLATFORMS[selected_platform_key]["index_url"])}) ',
         parse_mode=ParseMode.MARKDOWN_V2,
@@ -854,6 +972,7 @@ def handlers():
         CommandHandler('model', model_handler),
         CommandHandler('balance', balance_handler),
         CommandHandler('platform', platform_handler),
+        CommandHandler('auto', auto_route_handler),
         CommandHandler('shop', shop_handler),
         CallbackQueryHandler(mask_selection_handler,
                              pattern='^mask_key:'),
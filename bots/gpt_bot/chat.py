@@ -1,13 +1,13 @@
 import asyncio
-import traceback
-from typing import List
+import weakref
 
-from my_utils import my_logging
+from my_utils import my_logging, tiktoken_util
 from telegram.ext import CallbackContext
 from openai import AsyncOpenAI
 
-# 生成摘要prompt提示
-SUMMARY_PROMPT = '生成一个摘要.如果包含代码,总结代码片段的主要目的和功能，包括所使用的任何特定算法或技术'
+from bots.gpt_bot.core.clients import CLIENT_REGISTRY
+from bots.gpt_bot.core.history import Temque, history_budget
+
 # 生成摘要最大重试次数
 SUMMARY_MAX_RETRIES = 2
 # 日志模块
@@ -50,113 +50,6 @@ user_msg = type("user_msg", (MsgBase,), {"role_name": "user"})
 assistant_msg = type("assistant_msg", (MsgBase,), {"role_name": "assistant"})
 
 
-class Temque:
-    """ 一个先进先出, 可设置最大容量, 可固定元素的队列 """
-
-    def __init__(self, maxlen: int = None):  # type: ignore
-        self.core: List[dict] = []
-        self.maxlen = maxlen or float("inf")
-
-    async def _trim(self, context: CallbackContext, is_platform_migrate: bool = False):
-        is_claude: bool = context.user_data['current_model'].startswith(
-            'claude-3')
-        core = self.core
-        if len(core) > self.maxlen:
-            dc = len(core) - self.maxlen
-            indexes = []
-            for i, x in enumerate(core):
-                indexes.append(i)
-                if len(indexes) == dc:
-                    # 如果是claude模型 还要保证此时的消息角色为user
-                    if is_claude and x['obj']['role'] == 'user':
-                        dc += 1
-                    else:
-                        break
-            # [::-1]逆序输出
-            for i in indexes[::-1]:
-                core.pop(i)
-        # 接下来进行历史消息处理流程
-        # if not is_platform_migrate:
-        #     # 平台迁移不处理历史消息了 只裁剪
-        #     await self.process_history_message(core, context)
-
-    async def add_many(self, context: CallbackContext = None, *objs):
-        for x in objs:
-            self.core.append({"obj": x})
-        await self._trim(context)
-
-    def __iter__(self):
-        for x in self.core:
-            yield x["obj"]
-
-    def pin(self, *indexes):
-        for i in indexes:
-            self.core[i]["pin"] = True
-
-    def unpin(self, *indexes):
-        for i in indexes:
-            self.core[i]["pin"] = False
-
-    def copy(self):
-        que = self.__class__(maxlen=self.maxlen)  # type: ignore
-        que.core = self.core.copy()
-        return que
-
-    def deepcopy(self):
-        ...  # 创建这个方法是为了以代码提示的方式提醒用户: copy 方法是浅拷贝
-
-    def __add__(self, *obj: list):
-        contents = []
-        for message in self.core:
-            contents.append(message['obj'])
-        for item in obj:
-            contents.append(item)
-        return contents
-
-    def drop_last(self):
-        if len(self.core) > 0:
-            # 移除最后一个元素
-            self.core.pop()
-
-    def clear(self):
-        self.core = []
-
-    async def process_history_message(self, core: List[dict], context: CallbackContext):
-        for index, item in enumerate(core):
-            if len(item['obj']['content']) < 1000:
-                continue
-
-            # todo  不进行摘要 改为压缩 (加快速度)
-
-            # 每一个消息都需要重试
-            asyncio.create_task(self.summary(
-                context, index, item['obj']))
-
-    async def summary(self, context: CallbackContext,  index: int, message: dict):
-        """生成摘要
-
-            Args:
-                message (_type_): 历史消息
-                index: 索引
-                message: 需要摘要的消息
-            """
-        # 专门用于摘要历史消息的平台
-        candidate_platform = context.user_data['candidate_platform']
-        # 调用平台的接口生成摘要
-        try:
-            summary_content: str = await candidate_platform.summary(
-                message, SUMMARY_PROMPT)
-        except Exception as e:
-            traceback.print_exc()
-            raise RuntimeError(f'生成摘要失败: \n{e}')
-        # 更新生成的摘要信息
-        message['content'] = summary_content
-        try:
-            self.core[index]['obj'] = message
-        except:
-            pass
-
-
 async def coroutine_wrapper(normal_function, *args, **kwargs):
     return await asyncio.to_thread(normal_function, *args, **kwargs)
 
@@ -197,8 +90,14 @@ class Chat:
             kwargs["http_client"] = http_client
 
         self.reset_api_key(api_key)
-        self.openai_client = AsyncOpenAI(api_key=api_key, base_url=base_url, timeout=timeout,  # type: ignore
-                                         max_retries=max_retries)  # type: ignore
+        if http_client:
+            self.openai_client = AsyncOpenAI(api_key=api_key, base_url=base_url, timeout=timeout,  # type: ignore
+                                             max_retries=max_retries, http_client=http_client)  # type: ignore
+        else:
+            # 相同(base_url, api_key)的用户共用一个客户端 Chat被回收时释放引用
+            self.openai_client: AsyncOpenAI = CLIENT_REGISTRY.acquire(
+                base_url, api_key, timeout, max_retries)
+            weakref.finalize(self, CLIENT_REGISTRY.release, base_url, api_key)
         self._messages = Temque(maxlen=max_message_count)
 
     def set_max_message_count(self, max_count):
@@ -215,10 +114,10 @@ class Chat:
         '''
         回滚对话
         '''
-        self._messages.core[-2 * n:] = []
-        for x in self._messages.core[-2:]:
-            x = x["obj"]
-            print(f"[{x['role']}]:{x['content']}")
+        for _ in range(2 * n):
+            self._messages.drop_last()
+        for x in list(self._messages.core)[-2:]:
+            print(f"[{x.role}]:{x.content}")
 
     # def pin_messages(self, *indexes):
     #     '''
@@ -233,8 +132,7 @@ class Chat:
     #     self._messages.unpin(*indexes)
 
     def fetch_messages(self):
-        for item in self._messages.core:
-            item['obj']
+        return list(self._messages)
 
     def drop_last_message(self):
         self._messages.drop_last()
@@ -252,15 +150,26 @@ class Chat:
     async def append_messages(self, answer, context, *messages):
         await self._messages.add_many(context, *messages, {"role": "assistant", "content": answer})
 
-    def combine_messages(self, *messages, **openai_completion_options):
-        return openai_completion_options.pop('messages', []) + (self._messages.__add__(*messages)), openai_completion_options
+    def combine_messages(self, *messages, model: str = None, **openai_completion_options):
+        """
+        组装请求消息: 面具预设消息 + 预算内的历史消息 + 本次消息
+        @param model: 模型 用于计算token预算 预留回答所需的token
+        """
+        preset_messages = openai_completion_options.pop('messages', [])
+        encoding_name = tiktoken_util.encoding_name_for_model(model)
+        budget = history_budget(model, openai_completion_options.get('max_tokens'), preset_messages) - \
+            tiktoken_util.count_tokens(messages, encoding_name)
+        new_messages = list(preset_messages)
+        new_messages.extend(self._messages.window(budget, model))
+        new_messages.extend(messages)
+        return new_messages, openai_completion_options
 
     def clear_messages(self, context: CallbackContext):
         """
         清空历史消息
         """
         user_data = context.user_data
-        if len(self._messages.core) == 0:
+        if len(self._messages) == 0:
             return
         user_data['clear_messages'] = list(self._messages)
         self._messages.clear()
@@ -0,0 +1,205 @@
+""" 语音/音频的内存处理: 下载到内存 通过ffmpeg管道转码为低码率单声道 直接上传给转录接口 不落盘
+长音频切分为互相重叠的片段并发转录 再按重叠部分去重拼接
+"""
+import asyncio
+import os
+import shutil
+from difflib import SequenceMatcher
+from typing import Awaitable, Callable
+
+from my_utils.my_logging import get_logger
+
+logger = get_logger('audio')
+
+# 转录前的转码格式: opus / mp3 / none(不转码 分片时使用wav)
+AUDIO_TRANSCODE = os.getenv('AUDIO_TRANSCODE', 'opus').lower()
+# 转码后的码率 语音识别16k采样单声道已足够
+AUDIO_BITRATE = os.getenv('AUDIO_BITRATE', '24k')
+# 小于该大小的语音消息(telegram的语音本身就是ogg/opus)不转码
+AUDIO_TRANSCODE_MIN_BYTES = int(os.getenv('AUDIO_TRANSCODE_MIN_BYTES', 512 * 1024))
+# ffmpeg转码的超时时间(秒)
+FFMPEG_TIMEOUT = 120
+# 超过该时长(秒)的音频分片转录
+CHUNK_MIN_DURATION = int(os.getenv('TRANSCRIBE_CHUNK_MIN_DURATION', 90))
+# 每个片段的时长和相邻片段的重叠时长(秒) 重叠部分用于拼接时对齐
+CHUNK_SECONDS = int(os.getenv('TRANSCRIBE_CHUNK_SECONDS', 60))
+CHUNK_OVERLAP = 3
+# 同时转录的片段数
+TRANSCRIBE_CONCURRENCY = int(os.getenv('TRANSCRIBE_CONCURRENCY', 4))
+# 每个片段的尝试次数
+CHUNK_ATTEMPTS = 2
+# 片段最终转录失败时的占位文本
+FAILED_CHUNK_TEXT = '[此段语音转录失败]'
+# 拼接时重叠部分至少匹配的字符数
+STITCH_MIN_MATCH = 4
+
+# 格式 -> (ffmpeg编码参数, 文件名后缀, mime类型)
+CODECS = {
+    'opus': (('-c:a', 'libopus', '-b:a', AUDIO_BITRATE, '-application', 'voip', '-f', 'ogg'), 'ogg', 'audio/ogg'),
+    'mp3': (('-c:a', 'libmp3lame', '-b:a', AUDIO_BITRATE, '-f', 'mp3'), 'mp3', 'audio/mpeg'),
+    'wav': (('-c:a', 'pcm_s16le', '-f', 'wav'), 'wav', 'audio/wav'),
+}
+# 转录函数: (文件名, 音频, mime类型) -> 文本
+Transcriber = Callable[[str, bytes, str], Awaitable[str]]
+
+
+def audio_content(data: bytes, file_name: str, mime_type: str, duration: float = 0) -> dict:
+    """
+    作为提问内容的音频 Platform.prepare_messages会先转录
+    @param duration: 时长(秒) 未知时为0
+    """
+    return {
+        'type': 'audio',
+        'data': data,
+        'file_name': file_name,
+        'mime_type': mime_type,
+        'duration': duration
+    }
+
+
+def ffmpeg_available() -> bool:
+    return shutil.which('ffmpeg') is not None
+
+
+async def run_ffmpeg(data: bytes, *args: str, timeout: float = FFMPEG_TIMEOUT) -> bytes:
+    """
+    通过标准输入输出调用ffmpeg
+    @param args: 输入之后的参数(输出到pipe:1)
+    @return: ffmpeg的标准输出 失败时抛出RuntimeError
+    """
+    process = await asyncio.create_subprocess_exec(
+        'ffmpeg', '-hide_banner', '-loglevel', 'error', '-i', 'pipe:0', *args, 'pipe:1',
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(data), timeout)
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    if process.returncode != 0:
+        raise RuntimeError(f'ffmpeg exited with {process.returncode}: {stderr.decode(errors="ignore").strip()}')
+    return stdout
+
+
+async def transcode(data: bytes, codec: str = AUDIO_TRANSCODE, start: float = 0,
+                    duration: float | None = None) -> tuple[bytes, str, str]:
+    """
+    转码为16k采样的单声道低码率音频
+    @param start: 截取的起始位置(秒)
+    @param duration: 截取的时长(秒) None表示到结尾
+    @return: (音频, 文件名后缀, mime类型)
+    """
+    args, suffix, mime_type = CODECS[codec]
+    clip = ('-ss', f'{start:g}') if start else ()
+    if duration is not None:
+        clip += ('-t', f'{duration:g}')
+    return await run_ffmpeg(data, *clip, '-vn', '-ac', '1', '-ar', '16000', *args), suffix, mime_type
+
+
+async def prepare_audio(data: bytes, file_name: str, mime_type: str, is_voice: bool = False,
+                        duration: float = 0) -> dict:
+    """
+    准备转录的音频 需要时转码; 未安装ffmpeg或转码失败时使用原始音频
+    @param is_voice: 是否为telegram的语音消息(已是低码率ogg/opus)
+    @param duration: 时长(秒) 长音频在分片时才转码
+    """
+    if (AUDIO_TRANSCODE not in CODECS or (is_voice and len(data) < AUDIO_TRANSCODE_MIN_BYTES)
+            or duration > CHUNK_MIN_DURATION):
+        return audio_content(data, file_name, mime_type, duration)
+    if not ffmpeg_available():
+        logger.warning('ffmpeg not found, upload the original audio')
+        return audio_content(data, file_name, mime_type, duration)
+    try:
+        transcoded, suffix, transcoded_mime_type = await transcode(data)
+    except Exception as e:
+        logger.warning(f'transcode {file_name} failed: {e}')
+        return audio_content(data, file_name, mime_type, duration)
+    if not transcoded or len(transcoded) >= len(data):
+        return audio_content(data, file_name, mime_type, duration)
+    logger.debug(f'transcoded {file_name}: {len(data)} -> {len(transcoded)} bytes')
+    return audio_content(transcoded, f'{os.path.splitext(file_name)[0]}.{suffix}', transcoded_mime_type, duration)
+
+
+def chunk_windows(duration: float, window: float = CHUNK_SECONDS, overlap: float = CHUNK_OVERLAP) -> list[tuple[float, float]]:
+    """
+    切分的片段 相邻片段重叠overlap秒
+    尾段短于两倍重叠时(几乎全是重叠 单独转录容易出错)并入前一个片段
+    @return: [(起始秒, 时长)] 最后一个片段到结尾
+    """
+    step = window - overlap
+    windows = []
+    start = 0
+    while True:
+        if start + window >= duration or duration - (start + step) < 2 * overlap:
+            windows.append((start, duration - start))
+            return windows
+        windows.append((start, window))
+        start += step
+
+
+def _joiner(previous: str, following: str) -> str:
+    # 英文等以空格分词的文本之间补一个空格
+    return ' ' if previous[-1:].isascii() and previous[-1:].isalnum() and following[:1].isascii() else ''
+
+
+def stitch(previous: str, following: str, overlap_ratio: float = CHUNK_OVERLAP / CHUNK_SECONDS) -> str:
+    """
+    拼接相邻片段的转录 去掉重叠部分重复的文本
+    在前一段的结尾和后一段的开头(各取约两倍重叠时长对应的字符数)中找最长的公共子串 从公共子串末尾接上后一段
+    片段边缘被截断的字词也随之去掉; 找不到足够长的公共子串时直接拼接
+    @param overlap_ratio: 重叠时长占片段时长的比例
+    """
+    previous, following = previous.rstrip(), following.lstrip()
+    if not previous or not following:
+        return previous or following
+    probe = max(4 * STITCH_MIN_MATCH, int(len(following) * overlap_ratio * 2))
+    tail, head = previous[-probe:], following[:probe]
+    match = SequenceMatcher(None, tail, head, autojunk=False).find_longest_match(0, len(tail), 0, len(head))
+    if match.size < STITCH_MIN_MATCH:
+        return previous + _joiner(previous, following) + following
+    return previous[:len(previous) - len(tail) + match.a + match.size] + following[match.b + match.size:]
+
+
+async def transcribe_chunked(audio: dict, transcribe: Transcriber, concurrency: int = TRANSCRIBE_CONCURRENCY,
+                             codec: str = AUDIO_TRANSCODE, window: float = CHUNK_SECONDS,
+                             overlap: float = CHUNK_OVERLAP) -> str:
+    """
+    长音频分片并发转录 每个片段单独转码并重试 个别片段失败时以占位文本代替 全部失败时抛出异常
+    @param audio: audio_content 需要有时长
+    @param transcribe: 单个片段的转录函数(通常为当前平台的接口)
+    """
+    codec = codec if codec in CODECS else 'wav'
+    windows = chunk_windows(audio['duration'], window, overlap)
+    name = os.path.splitext(audio['file_name'])[0]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def transcribe_window(index: int, start: float, duration: float) -> str:
+        async with semaphore:
+            error = None
+            for _ in range(CHUNK_ATTEMPTS):
+                try:
+                    data, suffix, mime_type = await transcode(audio['data'], codec, start, duration)
+                    return await transcribe(f'{name}_{index}.{suffix}', data, mime_type)
+                except Exception as e:
+                    error = e
+            logger.warning(f'transcribe chunk {index} ({start:g}s+{duration:g}s) failed: {error}')
+            raise error
+
+    results = await asyncio.gather(*(transcribe_window(index, start, duration)
+                                     for index, (start, duration) in enumerate(windows)), return_exceptions=True)
+    if all(isinstance(result, BaseException) for result in results):
+        raise results[0]
+    transcript = ''
+    for result in results:
+        if isinstance(result, BaseException):
+            transcript = (transcript + _joiner(transcript, FAILED_CHUNK_TEXT) + FAILED_CHUNK_TEXT).strip()
+        else:
+            transcript = stitch(transcript, result, overlap / window)
+    logger.debug(f'transcribed {audio["file_name"]} in {len(windows)} chunks')
+    return transcript
+
+
+def should_chunk(audio: dict) -> bool:
+    """ 时长超过CHUNK_MIN_DURATION且可以用ffmpeg切分 """
+    return audio.get('duration', 0) > CHUNK_MIN_DURATION and ffmpeg_available()
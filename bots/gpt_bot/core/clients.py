@@ -0,0 +1,69 @@
+""" 进程内共享的AsyncOpenAI客户端 """
+import asyncio
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+from my_utils.my_logging import get_logger
+
+logger = get_logger('openai-clients')
+
+# 连接池配置 同一个(base_url, api_key)的所有用户共用
+POOL_LIMITS = httpx.Limits(
+    max_connections=100,
+    max_keepalive_connections=20,
+    keepalive_expiry=120
+)
+
+
+class ClientRegistry:
+    """
+    按(base_url, api_key)引用计数的客户端注册表
+    同一平台同一个key的所有用户共用一个httpx连接池; 最后一个引用释放时(如授权码刷新后旧key不再使用)关闭连接池
+    """
+
+    def __init__(self, limits: httpx.Limits = POOL_LIMITS):
+        self.limits = limits
+        # (base_url, api_key) -> [客户端, 引用数]
+        self._clients: dict[tuple, list] = {}
+
+    def acquire(self, base_url: str, api_key, timeout=None, max_retries=None) -> AsyncOpenAI:
+        """ 获取客户端 引用数+1 """
+        key = (base_url, api_key)
+        entry = self._clients.get(key)
+        if entry is None:
+            options = {}
+            if timeout:
+                options['timeout'] = timeout
+            if max_retries is not None:
+                options['max_retries'] = max_retries
+            client = AsyncOpenAI(api_key=api_key, base_url=base_url,  # type: ignore
+                                 http_client=DefaultAsyncHttpxClient(limits=self.limits), **options)
+            entry = self._clients[key] = [client, 0]
+            logger.debug(f'new client for {base_url}, {len(self._clients)} clients in total')
+        entry[1] += 1
+        return entry[0]
+
+    def release(self, base_url: str, api_key):
+        """ 引用数-1 归零时关闭连接池 """
+        key = (base_url, api_key)
+        entry = self._clients.get(key)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] > 0:
+            return
+        del self._clients[key]
+        client: AsyncOpenAI = entry[0]
+        try:
+            asyncio.get_running_loop().create_task(client.close())
+        except RuntimeError:
+            # 没有运行中的事件循环(进程退出阶段) 连接随进程释放
+            pass
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+
+# 进程内共享的客户端注册表
+CLIENT_REGISTRY = ClientRegistry()
@@ -0,0 +1,116 @@
+""" 历史消息的后台压缩 """
+import asyncio
+
+import aiohttp
+from telegram.ext import CallbackContext
+
+from bots.gpt_bot.core.history import MessageRecord
+from bots.gpt_bot.core.persistence import CONVERSATION_STORE
+from my_utils.my_logging import get_logger
+
+logger = get_logger('compaction')
+
+
+class CompactionMetrics:
+    """ 压缩的统计指标 """
+
+    def __init__(self):
+        # 成功替换为摘要的消息数
+        self.summaries = 0
+        # 生成摘要失败的次数
+        self.failures = 0
+        # 队列已满被放弃的消息数
+        self.dropped = 0
+        # 累计节省的token数
+        self.tokens_saved = 0
+
+    def __repr__(self) -> str:
+        return (f'CompactionMetrics(summaries={self.summaries}, failures={self.failures}, '
+                f'dropped={self.dropped}, tokens_saved={self.tokens_saved})')
+
+
+class CompactionWorker:
+    """
+    进程内的历史消息压缩器
+    回答发出后提交 用candidate_platform把较早的长消息替换为摘要; 队列和并发数都有上限 队列满了直接放弃 不影响回复
+    """
+
+    def __init__(self, concurrency: int = 2, max_pending: int = 64, min_chars: int = 1000, keep_recent: int = 2):
+        # 同时进行的摘要请求数
+        self.concurrency = concurrency
+        # 等待压缩的消息上限
+        self.max_pending = max_pending
+        # 内容长度下限
+        self.min_chars = min_chars
+        # 最近的消息保持原样(下一轮对话大概率还会引用)
+        self.keep_recent = keep_recent
+        self.metrics = CompactionMetrics()
+        self._queue: asyncio.Queue | None = None
+        self._workers: list[asyncio.Task] = []
+
+    def submit(self, context: CallbackContext, session: aiohttp.ClientSession, user_id=None) -> int:
+        """
+        提交当前会话中可压缩的消息 不等待
+        @param user_id: 用户id 压缩后标记会话需要持久化
+        @return: 本次入队的消息数
+        """
+        user_data = context.user_data
+        current_platform = user_data.get('current_platform')
+        if current_platform is None or user_data.get('candidate_platform') is None:
+            return 0
+        queue = self._ensure_started()
+        queued = 0
+        for record in current_platform.chat._messages.compactable(self.min_chars, self.keep_recent):
+            try:
+                queue.put_nowait((user_id, user_data, record, session))
+            except asyncio.QueueFull:
+                self.metrics.dropped += 1
+                break
+            record.compacted = True
+            queued += 1
+        return queued
+
+    def _ensure_started(self) -> asyncio.Queue:
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_pending)
+            self._workers = [asyncio.create_task(self._work())
+                             for _ in range(self.concurrency)]
+        return self._queue
+
+    async def _work(self):
+        while True:
+            user_id, user_data, record, session = await self._queue.get()
+            try:
+                await self._compact(user_id, user_data, record, session)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # 摘要只是优化 失败后保留原文 交给token预算裁剪
+                self.metrics.failures += 1
+                logger.debug(f'compact message failed: {e}')
+            finally:
+                self._queue.task_done()
+
+    async def _compact(self, user_id, user_data: dict, record: MessageRecord, session: aiohttp.ClientSession):
+        candidate_platform = user_data['candidate_platform']
+        summary_content = await candidate_platform.summary(
+            record.content, candidate_platform.SUMMARY_PROMPT, session)
+        if not summary_content:
+            return
+        # 等待摘要期间用户可能切换了平台 以当前的历史消息为准
+        tokens_saved = user_data['current_platform'].chat._messages.replace_content(
+            record, summary_content)
+        if tokens_saved <= 0:
+            return
+        self.metrics.summaries += 1
+        self.metrics.tokens_saved += tokens_saved
+        user_data['compaction_tokens_saved'] = user_data.get(
+            'compaction_tokens_saved', 0) + tokens_saved
+        if user_id is not None:
+            # 历史消息已改写 持久化压缩后的会话
+            CONVERSATION_STORE.mark_dirty(user_id, user_data)
+        logger.debug(f'{self.metrics}')
+
+
+# 进程内共享的压缩器
+COMPACTION_WORKER = CompactionWorker()
@@ -0,0 +1,191 @@
+""" 免费平台(free_3/free_4)的授权信息管理 """
+import asyncio
+import base64
+import time
+import weakref
+from typing import Awaitable, Callable
+
+import orjson
+
+from my_utils.my_logging import get_logger
+
+logger = get_logger('credentials')
+
+# 生成授权信息的方法: 平台配置(副本) -> 带openai_api_key的平台配置
+Generator = Callable[[dict], Awaitable[dict]]
+# 读取已保存的授权信息的方法(如临时配置文件): platform_key -> 授权信息
+Loader = Callable[[str], str | None]
+
+
+def refresh_deadline(token: str, margin: float) -> float | None:
+    """
+    授权信息应当被刷新的时间点 = 过期时间 - 提前量(不超过有效期的一半)
+    @param token: JWT 可带token_type前缀
+    @return: 非JWT或没有过期时间时返回None
+    """
+    try:
+        payload = token.rsplit(' ', 1)[-1].split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        claims = orjson.loads(base64.urlsafe_b64decode(payload))
+    except Exception:
+        return None
+    exp = claims.get('exp')
+    if not exp:
+        return None
+    iat = claims.get('iat')
+    if iat:
+        margin = min(margin, (exp - iat) / 2)
+    return exp - margin
+
+
+class CredentialManager:
+    """
+    授权信息管理
+    同一平台的并发刷新只执行一次(single-flight); 新的授权信息直接发布到内存中该平台的所有实例; JWT到期前主动刷新
+    """
+
+    def __init__(self, refresh_margin: float = 300):
+        # 距离过期多少秒时主动刷新
+        self.refresh_margin = refresh_margin
+        # platform_key -> 生成方法
+        self._generators: dict[str, Generator] = {}
+        # platform_key -> 读取已保存授权信息的方法
+        self._loaders: dict[str, Loader] = {}
+        # platform_key -> 当前的授权信息
+        self._tokens: dict[str, str] = {}
+        # platform_key -> 平台配置(主动刷新时使用)
+        self._configs: dict[str, dict] = {}
+        # platform_key -> 正在进行的刷新
+        self._inflight: dict[str, asyncio.Future] = {}
+        # platform_key -> 使用该授权信息的平台实例
+        self._instances: dict[str, weakref.WeakSet] = {}
+        # platform_key -> 主动刷新的定时器
+        self._timers: dict[str, asyncio.TimerHandle] = {}
+
+    def register_generator(self, platform_key: str, generator: Generator, loader: Loader | None = None):
+        self._generators[platform_key] = generator
+        if loader is not None:
+            self._loaders[platform_key] = loader
+
+    def manages(self, platform_key: str) -> bool:
+        return platform_key in self._generators
+
+    def register(self, platform):
+        """ 登记平台实例 之后的刷新结果会同步到该实例 """
+        if not self.manages(platform.name):
+            return
+        self._instances.setdefault(platform.name, weakref.WeakSet()).add(platform)
+        token = self._tokens.get(platform.name)
+        if token and platform.openai_api_key != token:
+            platform.openai_api_key = token
+
+    def current(self, platform_key: str) -> str | None:
+        return self._tokens.get(platform_key)
+
+    def expiring(self, platform_key: str) -> bool:
+        return self._token_expiring(self._tokens.get(platform_key))
+
+    def _token_expiring(self, token: str | None) -> bool:
+        if token is None:
+            return True
+        deadline = refresh_deadline(token, self.refresh_margin)
+        return deadline is not None and deadline <= time.time()
+
+    def seed(self, platform: dict, token: str):
+        """ 载入已保存的授权信息(如临时配置文件) """
+        platform_key = platform['platform_key']
+        self._configs[platform_key] = platform
+        self._publish(platform_key, token)
+
+    async def resolve(self, platform: dict) -> dict:
+        """
+        获取可用的授权信息 没有或即将过期时刷新
+        @return: 带openai_api_key的平台配置副本
+        """
+        platform_key = platform['platform_key']
+        self._configs[platform_key] = platform
+        token = self._tokens.get(platform_key)
+        if token is None:
+            token = self._adopt_saved(platform_key)
+        if token is None or self.expiring(platform_key):
+            token = await self.refresh(platform, stale_token=token)
+        return {**platform, 'openai_api_key': token}
+
+    async def refresh(self, platform: dict, stale_token: str | None = None) -> str:
+        """
+        刷新授权信息 并发调用共享同一次刷新
+        @param stale_token: 调用方认为已失效的授权信息 如果已被其他请求刷新过 直接返回新的
+        """
+        platform_key = platform['platform_key']
+        current = self._tokens.get(platform_key)
+        if stale_token is not None and current is not None and current != stale_token and not self.expiring(platform_key):
+            return current
+        future = self._inflight.get(platform_key)
+        if future is None:
+            future = self._inflight[platform_key] = asyncio.ensure_future(
+                self._refresh(platform))
+            future.add_done_callback(
+                lambda _: self._inflight.pop(platform_key, None))
+        # 单个等待方被取消不影响其他等待方
+        return await asyncio.shield(future)
+
+    def _adopt_saved(self, platform_key: str, stale_token: str | None = None) -> str | None:
+        """ 采用已保存的授权信息(其他进程可能已经刷新过) """
+        loader = self._loaders.get(platform_key)
+        if loader is None:
+            return None
+        token = loader(platform_key)
+        if token is None or token == stale_token or token == self._tokens.get(platform_key) \
+                or self._token_expiring(token):
+            return None
+        self._publish(platform_key, token)
+        return token
+
+    async def _refresh(self, platform: dict) -> str:
+        platform_key = platform['platform_key']
+        self._configs[platform_key] = platform
+        token = self._adopt_saved(platform_key, self._tokens.get(platform_key))
+        if token is not None:
+            logger.info(f'{platform_key}采用其他进程刷新的授权信息')
+            return token
+        generator = self._generators[platform_key]
+        # 生成方法会修改传入的字典 不能污染全局的平台配置
+        result = await generator(dict(platform))
+        token = result['openai_api_key']
+        self._configs[platform_key] = platform
+        self._publish(platform_key, token)
+        logger.info(f'{platform_key}的授权信息已刷新')
+        return token
+
+    def _publish(self, platform_key: str, token: str):
+        self._tokens[platform_key] = token
+        for instance in list(self._instances.get(platform_key, ())):
+            instance.openai_api_key = token
+        self._schedule(platform_key, token)
+
+    def _schedule(self, platform_key: str, token: str):
+        timer = self._timers.pop(platform_key, None)
+        if timer:
+            timer.cancel()
+        deadline = refresh_deadline(token, self.refresh_margin)
+        if deadline is None or deadline <= time.time():
+            # 已经需要刷新的授权信息由下一次resolve/请求失败时刷新 避免连续刷新
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        delay = deadline - time.time()
+        self._timers[platform_key] = loop.call_later(
+            delay, lambda: asyncio.ensure_future(self._refresh_ahead(platform_key, token)))
+
+    async def _refresh_ahead(self, platform_key: str, token: str):
+        try:
+            await self.refresh(self._configs[platform_key], stale_token=token)
+        except Exception as e:
+            # 主动刷新失败不影响现有授权 请求遇到401/403/500时还会再刷新
+            logger.warning(f'{platform_key}的授权信息主动刷新失败: {e}')
+
+
+# 进程内共享的授权信息管理
+CREDENTIALS = CredentialManager()
@@ -0,0 +1,132 @@
+""" DeepAI的api-key生成 与原先js2py执行DEEP_AI_TOKEN_JS的结果逐字节一致 """
+import asyncio
+import hashlib
+import math
+import random
+from collections import deque
+
+from my_utils.ua_util import ua
+
+# 原JS实现 仅作为对照(benchmarks.deepai_token用它校验)
+DEEP_AI_TOKEN_JS = """
+    function generateToken(agent) {
+        var d, e, g, f, l, h, k, m, n, p, q, w, r, y, C, I, H, D, t, E, z, N, M, ca, O, P, S, T, J, R, Q, W, X, da, ia, Y, ea, Z, U, aa, fa, ha;
+        p = Math.round(1E11 * Math.random()) + "";
+        q = function() {
+            for (var A = [], F = 0; 64 > F; )
+                A[F] = 0 | 4294967296 * Math.sin(++F % Math.PI);
+            return function(B) {
+                var G, K, L, ba = [G = 1732584193, K = 4023233417, ~G, ~K], V = [], x = unescape(encodeURI(B)) + "\\u0080", v = x.length;
+                B = --v / 4 + 2 | 15;
+                for (V[--B] = 8 * v; ~v; )
+                    V[v >> 2] |= x.charCodeAt(v) << 8 * v--;
+                for (F = x = 0; F < B; F += 16) {
+                    for (v = ba; 64 > x; v = [L = v[3], G + ((L = v[0] + [G & K | ~G & L, L & G | ~L & K, G ^ K ^ L, K ^ (G | ~L)][v = x >> 4] + A[x] + ~~V[F | [x, 5 * x + 1, 3 * x + 5, 7 * x][v] & 15]) << (v = [7, 12, 17, 22, 5, 9, 14, 20, 4, 11, 16, 23, 6, 10, 15, 21][4 * v + x++ % 4]) | L >>> -v), G, K])
+                        G = v[1] | 0,
+                        K = v[2];
+                    for (x = 4; x; )
+                        ba[--x] += v[x]
+                }
+                for (B = ""; 32 > x; )
+                    B += (ba[x >> 3] >> 4 * (1 ^ x++) & 15).toString(16);
+                return B.split("").reverse().join("")
+            }
+        }();
+
+        return "tryit-" + p + "-" + q(agent + q(agent + q(agent + p + "x")));
+    }
+    """
+
+_MASK = 0xFFFFFFFF
+# MD5的常量表(与JS中 0 | 4294967296 * Math.sin(++F % Math.PI) 相同)
+_SINES = [int(4294967296 * math.sin(i % math.pi)) & _MASK for i in range(1, 65)]
+_SHIFTS = [7, 12, 17, 22] * 4 + [5, 9, 14, 20] * 4 + [4, 11, 16, 23] * 4 + [6, 10, 15, 21] * 4
+
+
+def _js_words(text: str) -> list[int]:
+    """
+    按JS实现的方式把字符串打包为32位字(含填充和长度)
+    js2py的unescape(encodeURI(s))不做UTF-8转换 非ASCII字符按码点直接移位写入
+    """
+    codes = [ord(char) for char in text]
+    codes.append(0x80)
+    size = len(text)
+    count = (size // 4 + 2) | 15
+    words = [0] * (count + 1)
+    words[count - 1] = (8 * size) & _MASK
+    for index in range(size, -1, -1):
+        words[index >> 2] |= (codes[index] << (8 * index & 31)) & _MASK
+    return words
+
+
+def _md5_words(words: list[int]) -> str:
+    a0, b0, c0, d0 = 0x67452301, 0xEFCDAB89, 0x98BADCFE, 0x10325476
+    for offset in range(0, len(words) - 1, 16):
+        block = words[offset:offset + 16]
+        a, b, c, d = a0, b0, c0, d0
+        for i in range(64):
+            if i < 16:
+                f, g = (b & c) | (~b & d), i
+            elif i < 32:
+                f, g = (d & b) | (~d & c), (5 * i + 1) & 15
+            elif i < 48:
+                f, g = b ^ c ^ d, (3 * i + 5) & 15
+            else:
+                f, g = c ^ (b | (~d & _MASK)), (7 * i) & 15
+            value = (a + (f & _MASK) + _SINES[i] + block[g]) & _MASK
+            shift = _SHIFTS[i]
+            a, d, c = d, c, b
+            b = (b + ((value << shift) | (value >> (32 - shift)))) & _MASK
+        a0, b0, c0, d0 = (a0 + a) & _MASK, (b0 + b) & _MASK, (c0 + c) & _MASK, (d0 + d) & _MASK
+    return b''.join(word.to_bytes(4, 'little') for word in (a0, b0, c0, d0)).hex()
+
+
+def reversed_md5(text: str) -> str:
+    """ JS中的q函数: MD5十六进制摘要的逆序 """
+    if text.isascii():
+        return hashlib.md5(text.encode()).hexdigest()[::-1]
+    return _md5_words(_js_words(text))[::-1]
+
+
+def generate_token(agent: str, seed: str | None = None) -> str:
+    """
+    生成api-key
+    @param agent: 请求使用的User-Agent
+    @param seed: 随机部分 默认与JS一样取 Math.round(1E11 * Math.random())
+    """
+    if seed is None:
+        seed = str(math.floor(1e11 * random.random() + 0.5))
+    return f'tryit-{seed}-' + reversed_md5(agent + reversed_md5(agent + reversed_md5(agent + seed + 'x')))
+
+
+class TokenPool:
+    """ 预先生成的(User-Agent, api-key) 取出后在事件循环空闲时补充 """
+
+    def __init__(self, size: int = 16):
+        self.size = size
+        self._pairs: deque = deque()
+        self._refilling = False
+
+    def _generate(self) -> tuple[str, str]:
+        agent = ua.random
+        return agent, generate_token(agent)
+
+    def _refill(self):
+        self._refilling = False
+        while len(self._pairs) < self.size:
+            self._pairs.append(self._generate())
+
+    def take(self) -> tuple[str, str]:
+        """ 取出一对(User-Agent, api-key) 每个api-key只使用一次 """
+        pair = self._pairs.popleft() if self._pairs else self._generate()
+        if not self._refilling:
+            try:
+                asyncio.get_running_loop().call_soon(self._refill)
+                self._refilling = True
+            except RuntimeError:
+                self._refill()
+        return pair
+
+
+# 进程内共享的api-key池
+DEEPAI_TOKENS = TokenPool()
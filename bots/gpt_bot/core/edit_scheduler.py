@@ -0,0 +1,202 @@
+""" 流式回答的消息编辑调度器 """
+import asyncio
+import time
+from typing import Callable
+
+from telegram import Update
+from telegram.error import RetryAfter, TelegramError
+from telegram.ext import CallbackContext
+
+from my_utils.my_logging import get_logger
+
+logger = get_logger('edit-scheduler')
+
+
+def retry_after_seconds(e: RetryAfter) -> float:
+    """ RetryAfter的等待时间 兼容int和timedelta两种类型 """
+    retry_after = e.retry_after
+    if hasattr(retry_after, 'total_seconds'):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class EditMetrics:
+    """ 编辑调度的统计指标 """
+
+    def __init__(self):
+        # 实际发出的编辑次数
+        self.edits_sent = 0
+        # 被新快照覆盖而丢弃的快照数
+        self.snapshots_coalesced = 0
+        # 因节流/限流而等待的总时长(秒)
+        self.wait_seconds = 0.0
+        # 收到RetryAfter的次数
+        self.retry_after_hits = 0
+
+    def merge(self, other: 'EditMetrics'):
+        self.edits_sent += other.edits_sent
+        self.snapshots_coalesced += other.snapshots_coalesced
+        self.wait_seconds += other.wait_seconds
+        self.retry_after_hits += other.retry_after_hits
+
+    def __repr__(self) -> str:
+        return (f'EditMetrics(edits_sent={self.edits_sent}, snapshots_coalesced={self.snapshots_coalesced}, '
+                f'wait_seconds={round(self.wait_seconds, 3)}, retry_after_hits={self.retry_after_hits})')
+
+
+# 进程内所有消息的累计指标
+EDIT_METRICS = EditMetrics()
+
+
+class MessageEditScheduler:
+    """
+    单条消息的编辑调度器
+    生产者只需submit最新快照 不会被编辑阻塞; 后台任务按照编辑耗时和RetryAfter自适应地决定编辑节奏 中间快照直接丢弃
+    """
+
+    def __init__(self, update: Update, context: CallbackContext, message_id: int,
+                 min_interval: float = 0.8, max_interval: float = 8.0):
+        self.update = update
+        self.context = context
+        self.message_id = message_id
+        # 两次编辑的最小/最大间隔
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        # 当前编辑间隔
+        self.interval = min_interval
+        # 编辑耗时的指数移动平均
+        self._latency = 0.0
+        # 下一次允许编辑的时间
+        self._next_edit_at = 0.0
+        # 最新的快照 只保留一份 可以是在编辑时才生成文本的函数
+        self._snapshot: str | Callable[[], str] | None = None
+        # 上一次成功发出的文本
+        self._sent_text: str | None = None
+        self._wakeup = asyncio.Event()
+        self._closed = False
+        self._finished = False
+        self._close_task: asyncio.Future | None = None
+        self.metrics = EditMetrics()
+        self._task = asyncio.create_task(self._run())
+
+    def submit(self, text: str | Callable[[], str]):
+        """
+        提交最新快照 不等待编辑完成
+        @param text: 文本 或返回文本的函数(真正编辑时才调用 频繁提交时不必每次都拼接)
+        """
+        if self._closed:
+            return
+        if self._snapshot is not None:
+            self.metrics.snapshots_coalesced += 1
+        self._snapshot = text
+        self._wakeup.set()
+
+    async def close(self, final_text: str | None = None):
+        """
+        停止调度 并在流结束后做最后一次编辑 可重复调用 只有第一次生效
+        @param final_text: 最终文本 None表示最后发出尚未发出的快照
+        """
+        if self._close_task is None:
+            self._close_task = asyncio.ensure_future(self._close(final_text))
+        await asyncio.shield(self._close_task)
+
+    async def _close(self, final_text: str | None):
+        if self._finished:
+            return
+        self._closed = True
+        self._wakeup.set()
+        # 等待正在进行的编辑完成
+        await self._task
+        if final_text is not None:
+            # 最终文本覆盖尚未发出的快照
+            if self._snapshot is not None:
+                self.metrics.snapshots_coalesced += 1
+                self._snapshot = None
+            from my_utils import bot_util
+            await self._wait_for_slot()
+            await bot_util.edit_message(self.update, self.context, self.message_id, True, final_text)
+            self.metrics.edits_sent += 1
+        else:
+            await self._flush_snapshot()
+        self._finish()
+
+    def _take_snapshot(self) -> str | None:
+        text, self._snapshot = self._snapshot, None
+        return text() if callable(text) else text
+
+    async def _flush_snapshot(self, max_attempts: int = 3):
+        """ 发出最后一份快照(如"消息过长"的提示) 被限流时等待后重发 """
+        for _ in range(max_attempts):
+            text = self._take_snapshot()
+            if text is None or text == self._sent_text:
+                return
+            await self._wait_for_slot()
+            await self._edit(text)
+
+    def cancel(self):
+        """ 出现异常时直接丢弃所有快照 """
+        if self._finished:
+            return
+        self._closed = True
+        self._snapshot = None
+        self._task.cancel()
+        self._finish()
+
+    def _finish(self):
+        self._finished = True
+        EDIT_METRICS.merge(self.metrics)
+        logger.debug(f'message {self.message_id}: {self.metrics}')
+
+    async def _wait_for_slot(self):
+        delay = self._next_edit_at - time.monotonic()
+        if delay > 0:
+            self.metrics.wait_seconds += delay
+            await asyncio.sleep(delay)
+
+    async def _run(self):
+        while not self._closed:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if self._closed:
+                break
+            await self._wait_for_slot()
+            if self._closed:
+                break
+            # 等待期间可能有更新的快照 取最新的一份
+            text = self._take_snapshot()
+            if text is None or text == self._sent_text:
+                continue
+            await self._edit(text)
+
+    async def _edit(self, text: str):
+        start = time.monotonic()
+        try:
+            await self.context.bot.edit_message_text(
+                text=text,
+                chat_id=self.update.message.chat_id,
+                message_id=self.message_id,
+                disable_web_page_preview=True
+            )
+        except RetryAfter as e:
+            # 被限流 按照服务端要求等待 同时放慢节奏
+            self.metrics.retry_after_hits += 1
+            self.interval = min(self.max_interval, self.interval * 2)
+            self._next_edit_at = time.monotonic() + max(retry_after_seconds(e), self.interval)
+            # 没被新快照覆盖的话 稍后重发
+            if self._snapshot is None:
+                self._snapshot = text
+                self._wakeup.set()
+            return
+        except TelegramError as e:
+            # 中间快照编辑失败(如内容未变化/超时)不影响最终结果
+            logger.debug(f'edit message {self.message_id} failed: {e}')
+            self._next_edit_at = time.monotonic() + self.interval
+            return
+        latency = time.monotonic() - start
+        self.metrics.edits_sent += 1
+        self._sent_text = text
+        self._latency = latency if not self._latency else self._latency * 0.7 + latency * 0.3
+        # 编辑越慢间隔越大 限流后的惩罚逐步衰减
+        self.interval = min(self.max_interval, max(
+            self.min_interval, self._latency * 2, self.interval * 0.8))
+        self._next_edit_at = time.monotonic() + self.interval
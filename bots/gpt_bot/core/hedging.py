@@ -0,0 +1,255 @@
+""" 对冲请求: 同一个问题同时发往两个兼容的平台 先产出token的一方胜出 另一方立即取消 """
+import asyncio
+import contextlib
+import math
+import statistics
+import time
+from collections import deque
+from typing import TYPE_CHECKING, AsyncIterator
+
+import aiohttp
+from telegram.ext import CallbackContext
+
+from bots.gpt_bot.core.watchdog import watched_request
+from my_utils.my_logging import get_logger
+
+if TYPE_CHECKING:
+    from bots.gpt_bot.gpt_platform import Platform
+
+logger = get_logger('hedging')
+
+
+class HedgeMetrics:
+    """ 对冲请求的统计指标 """
+
+    def __init__(self):
+        # 对冲的请求数
+        self.races = 0
+        # 当前平台胜出的次数
+        self.primary_wins = 0
+        # 对冲平台胜出的次数
+        self.secondary_wins = 0
+        # 一方失败后由另一方完成的次数
+        self.fallbacks = 0
+
+    def __repr__(self) -> str:
+        return (f'HedgeMetrics(races={self.races}, primary_wins={self.primary_wins}, '
+                f'secondary_wins={self.secondary_wins}, fallbacks={self.fallbacks})')
+
+
+HEDGE_METRICS = HedgeMetrics()
+
+
+async def _first_output(stream: AsyncIterator) -> list:
+    """
+    读取流直到出现第一个有内容的结果
+    @return: 已读取的结果(最后一个有内容) 流结束仍没有内容时抛出异常
+    """
+    buffered = []
+    async for status, item in stream:
+        buffered.append((status, item))
+        if status != 'additional' and item:
+            return buffered
+    raise RuntimeError('empty answer')
+
+
+async def _discard(task: asyncio.Task, stream):
+    """ 取消落败的一方 关闭其连接 """
+    task.cancel()
+    with contextlib.suppress(BaseException):
+        await task
+    with contextlib.suppress(Exception):
+        await stream.aclose()
+
+
+async def hedged_stream_request(primary: 'Platform', secondary: 'Platform', content, context: CallbackContext,
+                                session: aiohttp.ClientSession, origin: dict | None = None):
+    """
+    对冲的流式请求 结果与Platform.async_stream_request一致
+    对冲平台使用当前历史消息的副本; 只有胜出方的回答写入历史消息 对冲平台胜出时历史消息交还给当前平台
+    @param primary: 当前平台
+    @param secondary: 对冲平台 需支持当前的面具和模型
+    @param origin: 胜出方的平台名称写入origin['platform']
+    """
+    secondary.chat.set_max_message_count(context.user_data['current_mask']['max_message_count'])
+    secondary.chat._messages.take_over(primary.chat._messages)
+    streams = {
+        gpt_platform: watched_request(gpt_platform, content, context, session)
+        for gpt_platform in (primary, secondary)
+    }
+    pending = {asyncio.ensure_future(_first_output(stream)): gpt_platform
+               for gpt_platform, stream in streams.items()}
+    HEDGE_METRICS.races += 1
+    winner = buffered = error = None
+    try:
+        while pending and winner is None:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                gpt_platform = pending.pop(task)
+                if task.exception() is not None:
+                    error = task.exception()
+                    logger.debug(f'hedged request on {gpt_platform.name} failed: {error}')
+                elif winner is None:
+                    winner, buffered = gpt_platform, task.result()
+                else:
+                    # 双方同时产出 只保留先处理的一方
+                    await _discard(task, streams[gpt_platform])
+    finally:
+        # 落败方(或调用方取消时的双方)立即断开
+        for task, gpt_platform in pending.items():
+            await _discard(task, streams[gpt_platform])
+    if winner is None:
+        raise error
+    if error is not None:
+        HEDGE_METRICS.fallbacks += 1
+    if winner is primary:
+        HEDGE_METRICS.primary_wins += 1
+    else:
+        HEDGE_METRICS.secondary_wins += 1
+    logger.debug(f'{winner.name} won the hedged request: {HEDGE_METRICS}')
+    if origin is not None:
+        origin['platform'] = winner.name
+    try:
+        for result in buffered:
+            yield result
+        async for result in streams[winner]:
+            yield result
+    finally:
+        await streams[winner].aclose()
+    if winner is secondary:
+        # 对冲平台已把本轮对话写入其历史消息
+        primary.chat._messages.take_over(secondary.chat._messages)
+
+
+class LatencyHistory:
+    """
+    同一平台内多个后端的首个token耗时记录 用于决定是否值得同时请求多个后端
+    样本不足或首选后端近期失败过时立即竞速; 首选后端稳定时先只请求它 超过其p90耗时仍无输出再请求下一个后端
+    """
+
+    def __init__(self, window: int = 20, min_samples: int = 3, hedge_factor: float = 1.2, max_hedge_delay: float = 10.0):
+        # 每个后端保留的样本数
+        self.window = window
+        # 样本数少于此值时总是竞速
+        self.min_samples = min_samples
+        # 等待首选后端的时间 = p90耗时 * hedge_factor
+        self.hedge_factor = hedge_factor
+        self.max_hedge_delay = max_hedge_delay
+        # 后端 -> [(首个token耗时, 是否成功, 是否截尾)]
+        # 落败被取消的后端只知道耗时不少于已等待的时间(截尾样本) 计入样本数 不参与耗时的统计
+        self._samples: dict[str, deque] = {}
+        # 竞速次数 / 只请求了一个后端的次数
+        self.races = 0
+        self.single_requests = 0
+
+    def __repr__(self) -> str:
+        medians = {name: round(self.median(name), 2) for name in self._samples}
+        return f'LatencyHistory(races={self.races}, single_requests={self.single_requests}, medians={medians})'
+
+    def _history(self, name: str) -> deque:
+        history = self._samples.get(name)
+        if history is None:
+            history = self._samples[name] = deque(maxlen=self.window)
+        return history
+
+    def record(self, name: str, latency: float, ok: bool = True, censored: bool = False):
+        """
+        @param censored: 落败被取消 latency只是已等待的时间(实际耗时的下限)
+        """
+        self._history(name).append((latency, ok, censored))
+
+    def median(self, name: str) -> float:
+        """ 中位耗时 只有截尾样本(每次都落败)时为无穷大 """
+        history = self._samples.get(name)
+        if not history:
+            return 0.0
+        measured = [(latency, ok) for latency, ok, censored in history if not censored]
+        if not measured:
+            return math.inf
+        # 失败的样本按窗口内最大耗时的两倍计
+        worst = max(latency for latency, _ in measured)
+        return statistics.median(latency if ok else 2 * worst + 1 for latency, ok in measured)
+
+    def order(self, names) -> list[str]:
+        """ 按中位耗时排序 样本不足的后端保持原顺序排在前面 """
+        names = list(names)
+        return sorted(names, key=lambda name: (len(self._history(name)) >= self.min_samples and self.median(name),
+                                               names.index(name)))
+
+    def hedge_delay(self, name: str) -> float:
+        """ 首选后端单独请求的时间 0表示立即竞速 """
+        history = self._samples.get(name)
+        if not history or not all(ok for _, ok, _ in history):
+            return 0.0
+        latencies = sorted(latency for latency, _, censored in history if not censored)
+        if len(latencies) < self.min_samples:
+            return 0.0
+        p90 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.9))]
+        return min(p90 * self.hedge_factor, self.max_hedge_delay)
+
+
+async def race_streams(streams: dict[str, AsyncIterator], history: LatencyHistory) -> AsyncIterator:
+    """
+    多个后端的流式结果竞速 先产出有内容结果的一方胜出 其余立即取消
+    首选后端稳定时延迟启动其他后端(见LatencyHistory.hedge_delay); 任一后端失败时立即启动下一个
+    @param streams: 后端名称 -> 流式结果(尚未开始迭代) 字典顺序为默认的优先顺序
+    @return: 胜出方的流式结果 全部失败时抛出最后一个异常
+    """
+    waiting = history.order(streams)
+    delay = history.hedge_delay(waiting[0])
+    started = {}
+    pending = {}
+    winner = buffered = error = None
+    start = time.monotonic()
+
+    def launch():
+        name = waiting.pop(0)
+        started[name] = time.monotonic()
+        pending[asyncio.ensure_future(_first_output(streams[name]))] = name
+
+    try:
+        launch()
+        if delay == 0:
+            while waiting:
+                launch()
+        while pending and winner is None:
+            timeout = max(0.0, start + delay - time.monotonic()) if waiting else None
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                # 首选后端超过预期耗时 请求下一个后端
+                launch()
+                continue
+            for task in done:
+                name = pending.pop(task)
+                if task.exception() is not None:
+                    error = task.exception()
+                    history.record(name, time.monotonic() - started[name], ok=False)
+                    logger.debug(f'{name} failed: {error}')
+                    if waiting:
+                        launch()
+                elif winner is None:
+                    winner, buffered = name, task.result()
+                    history.record(name, time.monotonic() - started[name])
+                else:
+                    await _discard(task, streams[name])
+    finally:
+        for task, name in pending.items():
+            # 落败方的耗时至少为已等待的时间 作为截尾样本记录
+            history.record(name, time.monotonic() - started[name], censored=True)
+            await _discard(task, streams[name])
+        for name in waiting:
+            await streams[name].aclose()
+    if len(started) > 1:
+        history.races += 1
+    else:
+        history.single_requests += 1
+    if winner is None:
+        raise error
+    logger.debug(f'{winner} won: {history}')
+    try:
+        for result in buffered:
+            yield result
+        async for result in streams[winner]:
+            yield result
+    finally:
+        await streams[winner].aclose()
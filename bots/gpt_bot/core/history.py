@@ -0,0 +1,254 @@
+""" 历史消息存储 """
+from collections import deque
+from itertools import islice
+from operator import attrgetter
+from typing import Iterable, Iterator
+
+from telegram.ext import CallbackContext
+
+from my_utils import my_logging, tiktoken_util
+
+# 日志模块
+logger = my_logging.get_logger('history')
+
+
+_message_of = attrgetter('message')
+
+
+def is_claude_model(model: str | None) -> bool:
+    return bool(model) and model.startswith('claude-3')
+
+
+def history_budget(model: str | None, max_tokens: int | None = None, preset_messages: Iterable[dict] = ()) -> int:
+    """
+    历史消息可用的token数: 上下文窗口 - 为回答预留的token - 面具预设消息
+    裁剪存储的历史消息和组装请求时使用同一个预算 保存的历史消息都能发出
+    """
+    return tiktoken_util.context_budget(model, max_tokens) - \
+        tiktoken_util.count_tokens(preset_messages, tiktoken_util.encoding_name_for_model(model))
+
+
+class MessageRecord:
+    """ 单条历史消息 token数按编码缓存 只计算一次; 原始消息直接用于组装请求 不再复制 """
+
+    __slots__ = ('message', 'tokens', 'encoding', 'pinned', 'compacted')
+
+    def __init__(self, message: dict, pinned: bool = False):
+        self.message = message
+        self.tokens = 0
+        self.encoding: str | None = None
+        self.pinned = pinned
+        # 是否已被摘要压缩(或正在压缩)
+        self.compacted = False
+
+    @property
+    def role(self) -> str:
+        return self.message['role']
+
+    @property
+    def content(self):
+        return self.message['content']
+
+    def count(self, encoding_name: str) -> int:
+        if self.encoding != encoding_name:
+            self.tokens = tiktoken_util.count_message_tokens(
+                self.message, encoding_name)
+            self.encoding = encoding_name
+        return self.tokens
+
+    def copy(self) -> 'MessageRecord':
+        """ 复制记录 消息字典本身不会被原地修改 可以共用; 进行中的摘要只会写回原记录 副本可以重新压缩 """
+        record = MessageRecord(self.message, self.pinned)
+        record.tokens, record.encoding = self.tokens, self.encoding
+        return record
+
+    def set_content(self, content):
+        """ 替换内容(如摘要) 缓存的token数随之失效 """
+        self.message = {'role': self.role, 'content': content}
+        self.encoding = None
+
+    def __repr__(self) -> str:
+        return f'MessageRecord(role={self.role!r}, tokens={self.tokens}, pinned={self.pinned})'
+
+
+class Temque:
+    """
+    一个先进先出, 可设置最大容量和token预算, 可固定元素的队列
+    滚动的消息放在deque中 从左侧淘汰; 固定的消息单独存放 不参与淘汰 组装时排在最前面
+    """
+
+    def __init__(self, maxlen: int = None):  # type: ignore
+        self.core: deque[MessageRecord] = deque()
+        self.pinned: list[MessageRecord] = []
+        self.maxlen = maxlen or float("inf")
+        # core中消息的token总数 及其对应的编码
+        self._total_tokens = 0
+        self._encoding: str | None = None
+
+    def __len__(self) -> int:
+        return len(self.pinned) + len(self.core)
+
+    def __iter__(self) -> Iterator[dict]:
+        return map(_message_of, self.records())
+
+    def records(self) -> Iterator[MessageRecord]:
+        yield from self.pinned
+        yield from self.core
+
+    def _sync_encoding(self, encoding_name: str):
+        # 模型切换导致编码变化时才需要重新计数
+        if self._encoding != encoding_name:
+            self._total_tokens = sum(record.count(encoding_name)
+                                     for record in self.core)
+            self._encoding = encoding_name
+
+    def _append(self, record: MessageRecord):
+        self.core.append(record)
+        if self._encoding is not None:
+            self._total_tokens += record.count(self._encoding)
+
+    def _popleft(self) -> MessageRecord:
+        record = self.core.popleft()
+        if self._encoding is not None:
+            self._total_tokens -= record.tokens
+        return record
+
+    async def _trim(self, context: CallbackContext, is_platform_migrate: bool = False):
+        model: str = context.user_data['current_model']
+        options = (context.user_data.get('current_mask') or {}).get('openai_completion_options') or {}
+        self._sync_encoding(tiktoken_util.encoding_name_for_model(model))
+        budget = history_budget(model, options.get('max_tokens'), options.get('messages', ())) - \
+            sum(record.count(self._encoding) for record in self.pinned)
+        core = self.core
+        trimmed = False
+        # 同时满足消息数和token预算 从最早的消息开始丢弃
+        while core and (len(core) > self.maxlen or self._total_tokens > budget):
+            self._popleft()
+            trimmed = True
+        # 如果是claude模型 还要保证保留的第一条消息角色为user
+        if trimmed and is_claude_model(model):
+            while core and core[0].role != 'user':
+                self._popleft()
+
+    async def add_many(self, context: CallbackContext = None, *objs: dict):
+        for x in objs:
+            self._append(MessageRecord(x))
+        await self._trim(context)
+
+    def window(self, budget: int, model: str) -> Iterator[dict]:
+        """
+        不超过token预算的最近历史消息(固定消息始终保留)
+        @param budget: 历史消息可用的token数
+        @param model: 模型 决定编码方式和claude的角色规则
+        """
+        self._sync_encoding(tiktoken_util.encoding_name_for_model(model))
+        for record in self.pinned:
+            budget -= record.count(self._encoding)
+        core = self.core
+        # token总数是增量维护的 只需从最早的消息开始跳过超出预算的部分
+        excess = self._total_tokens - budget
+        start = 0
+        for record in core:
+            if excess <= 0:
+                break
+            excess -= record.tokens
+            start += 1
+        if start and is_claude_model(model):
+            while start < len(core) and core[start].role != 'user':
+                start += 1
+        yield from map(_message_of, self.pinned)
+        yield from map(_message_of, islice(core, start, None) if start else core)
+
+    def pin(self, *indexes):
+        """ 固定core中的消息 """
+        records = [self.core[i] for i in indexes]
+        for record in records:
+            self.core.remove(record)
+            if self._encoding is not None:
+                self._total_tokens -= record.tokens
+            record.pinned = True
+            self.pinned.append(record)
+
+    def unpin(self, *indexes):
+        """ 取消固定 重新回到滚动队列的最前面 """
+        records = [self.pinned[i] for i in indexes]
+        for record in reversed(records):
+            self.pinned.remove(record)
+            record.pinned = False
+            self.core.appendleft(record)
+            if self._encoding is not None:
+                self._total_tokens += record.count(self._encoding)
+
+    def copy(self):
+        que = self.__class__(maxlen=self.maxlen)  # type: ignore
+        que.take_over(self)
+        return que
+
+    def take_over(self, other: 'Temque'):
+        """
+        接管另一个队列的消息(平台迁移/对冲/续写时使用)
+        复制每条记录: 两个队列各自增量维护token总数 压缩摘要替换一方的记录时不能影响另一方
+        """
+        self.core = deque(record.copy() for record in other.core)
+        self.pinned = [record.copy() for record in other.pinned]
+        self._total_tokens = other._total_tokens
+        self._encoding = other._encoding
+
+    def load(self, items: Iterable[tuple[str, object, bool]]):
+        """ 从持久化的(role, content, pinned)恢复消息 不触发裁剪 """
+        self.clear()
+        for role, content, pinned in items:
+            record = MessageRecord({'role': role, 'content': content}, pinned)
+            (self.pinned if pinned else self.core).append(record)
+        # token总数在下一次裁剪/组装时按模型的编码重新计算
+        self._encoding = None
+
+    def dump(self) -> list[tuple[str, object, bool]]:
+        """ 导出(role, content, pinned) 用于持久化 """
+        return [(record.role, record.content, record.pinned) for record in self.records()]
+
+    def deepcopy(self):
+        ...  # 创建这个方法是为了以代码提示的方式提醒用户: copy 方法是浅拷贝
+
+    def __add__(self, obj: Iterable[dict]) -> list[dict]:
+        contents = list(self)
+        contents.extend(obj)
+        return contents
+
+    def drop_last(self):
+        if len(self.core) > 0:
+            # 移除最后一个元素
+            record = self.core.pop()
+            if self._encoding is not None:
+                self._total_tokens -= record.tokens
+
+    def clear(self):
+        self.core.clear()
+        self.pinned.clear()
+        self._total_tokens = 0
+
+    def compactable(self, min_chars: int, keep_recent: int) -> list[MessageRecord]:
+        """
+        可以被摘要压缩的旧消息
+        @param min_chars: 内容长度下限 短消息压缩没有收益
+        @param keep_recent: 最近的消息保持原样 不参与压缩
+        """
+        return [record for record in islice(self.core, 0, max(len(self.core) - keep_recent, 0))
+                if not record.compacted and isinstance(record.content, str) and len(record.content) >= min_chars]
+
+    def replace_content(self, record: MessageRecord, content: str) -> int:
+        """
+        用摘要替换消息内容
+        @return: 节省的token数 消息已被淘汰或摘要没有变短时返回0且不做替换
+        """
+        if record not in self.core or self._encoding is None:
+            return 0
+        before = record.count(self._encoding)
+        after = tiktoken_util.count_message_tokens(
+            {'content': content}, self._encoding)
+        if after >= before:
+            return 0
+        record.set_content(content)
+        record.tokens, record.encoding = after, self._encoding
+        self._total_tokens += after - before
+        return before - after
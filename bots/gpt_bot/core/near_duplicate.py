@@ -0,0 +1,124 @@
+""" 近似重复提问的本地索引: MinHash指纹 + LSH分桶 不依赖向量服务 """
+import os
+import random
+from collections import OrderedDict
+
+HASH_MASK = (1 << 64) - 1
+# 字符n-gram长度 对中文和英文都适用
+SHINGLE_SIZE = 3
+# 相似度(n-gram的Jaccard系数)阈值
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv('NEAR_DUPLICATE_THRESHOLD', 0.85))
+
+
+def shingles(text: str) -> frozenset[str]:
+    """ 去掉空白并转小写后的字符n-gram """
+    text = ''.join(text.lower().split())
+    if len(text) <= SHINGLE_SIZE:
+        return frozenset((text,))
+    return frozenset(text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1))
+
+
+def jaccard(a: frozenset, b: frozenset) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class _Entry:
+    __slots__ = ('namespace', 'bucket_keys', 'grams', 'value')
+
+    def __init__(self, namespace: str, bucket_keys: list, grams: frozenset, value):
+        self.namespace = namespace
+        self.bucket_keys = bucket_keys
+        self.grams = grams
+        self.value = value
+
+
+class NearDuplicateIndex:
+    """
+    近似重复索引
+    每条提问计算bands*rows个MinHash值 每rows个一组作为一个桶: Jaccard系数为s的两条提问至少落入同一个桶的概率为 1-(1-s^rows)^bands
+    (默认8*4: s=0.85时约99.7% s=0.5时约40% s=0.3时约6%) 查询只比较同桶的候选 再用精确的Jaccard系数校验
+    条数超过max_entries时淘汰最早加入的
+    """
+
+    def __init__(self, threshold: float = NEAR_DUPLICATE_THRESHOLD, bands: int = 8, rows: int = 4,
+                 max_entries: int = 100_000, seed: int = 0x5EED):
+        # Jaccard系数阈值
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = rows
+        self.max_entries = max_entries
+        # 每个MinHash值对应的异或掩码(对同一个n-gram哈希做不同的置换)
+        mask_random = random.Random(seed)
+        self._masks = [mask_random.getrandbits(64) for _ in range(bands * rows)]
+        # 键 -> 条目 按加入顺序
+        self._entries: OrderedDict = OrderedDict()
+        # (命名空间, 段序号, 该段的MinHash值) -> 键
+        self._buckets: dict[tuple, set] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _bucket_keys(self, namespace: str, grams: frozenset) -> list[tuple]:
+        # 指纹只在进程内存中使用 可以直接用内置hash
+        hashes = [hash(gram) & HASH_MASK for gram in grams]
+        signature = [min([h ^ mask for h in hashes]) for mask in self._masks]
+        rows = self.rows
+        return [(namespace, band, tuple(signature[band * rows:(band + 1) * rows]))
+                for band in range(self.bands)]
+
+    def add(self, namespace: str, text: str, key, value=None):
+        """
+        加入索引
+        @param namespace: 只在同一命名空间内查找(如同一平台/模型/面具)
+        @param key: 条目的键 重复加入时更新
+        @param value: 命中时返回的值 默认为key
+        """
+        if key in self._entries:
+            self.discard(key)
+        grams = shingles(text)
+        bucket_keys = self._bucket_keys(namespace, grams)
+        self._entries[key] = _Entry(namespace, bucket_keys, grams, key if value is None else value)
+        buckets = self._buckets
+        for bucket_key in bucket_keys:
+            bucket = buckets.get(bucket_key)
+            if bucket is None:
+                buckets[bucket_key] = {key}
+            else:
+                bucket.add(key)
+        while len(self._entries) > self.max_entries:
+            self.discard(next(iter(self._entries)))
+
+    def discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for bucket_key in entry.bucket_keys:
+            bucket = self._buckets.get(bucket_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[bucket_key]
+
+    def lookup(self, namespace: str, text: str) -> tuple[object, float] | None:
+        """
+        查找最相似的条目
+        @return: (值, 相似度) 没有达到阈值的条目时返回None
+        """
+        grams = shingles(text)
+        candidates = set()
+        for bucket_key in self._bucket_keys(namespace, grams):
+            bucket = self._buckets.get(bucket_key)
+            if bucket:
+                candidates.update(bucket)
+        best, best_similarity = None, self.threshold
+        entries = self._entries
+        for key in candidates:
+            entry = entries[key]
+            similarity = jaccard(grams, entry.grams)
+            if similarity >= best_similarity:
+                best, best_similarity = entry, similarity
+        if best is None:
+            return None
+        return best.value, best_similarity
@@ -0,0 +1,171 @@
+""" 会话持久化: 把用户的平台/面具/模型和历史消息写入Redis 重启后在用户下一次发消息时恢复 """
+import asyncio
+import contextlib
+import zlib
+
+import orjson
+
+from my_utils import global_var, redis_util
+from my_utils.my_logging import get_logger
+
+logger = get_logger('persistence')
+
+# 编码格式版本 放在数据的第一个字节
+FORMAT_VERSION = 1
+# 角色编码 未知角色原样保存
+ROLE_CODES = {'system': 0, 'user': 1, 'assistant': 2}
+ROLE_NAMES = {code: role for role, code in ROLE_CODES.items()}
+
+
+def encode_messages(items: list[tuple[str, object, bool]]) -> list:
+    return [[ROLE_CODES.get(role, role), int(pinned), content] for role, content, pinned in items]
+
+
+def decode_messages(rows: list) -> list[tuple[str, object, bool]]:
+    return [(ROLE_NAMES.get(role, role), content, bool(pinned)) for role, pinned, content in rows]
+
+
+def encode_snapshot(snapshot: dict) -> bytes:
+    """ 版本号 + zlib压缩的orjson """
+    return bytes((FORMAT_VERSION,)) + zlib.compress(orjson.dumps(snapshot), 6)
+
+
+def decode_snapshot(data: bytes) -> dict | None:
+    if not data or data[0] != FORMAT_VERSION:
+        return None
+    return orjson.loads(zlib.decompress(data[1:]))
+
+
+def take_snapshot(user_data: dict) -> dict | None:
+    """ 在事件循环中提取需要持久化的状态(只引用 不编码) """
+    current_platform = user_data.get('current_platform')
+    if current_platform is None:
+        return None
+    return {
+        'platform': current_platform.name,
+        'mask': user_data['current_mask']['mask_key'],
+        'model': user_data['current_model'],
+        'messages': current_platform.chat._messages.dump(),
+        'clear_messages': user_data.get('clear_messages') or [],
+        'tokens_saved': user_data.get('compaction_tokens_saved', 0),
+        'auto_route': user_data.get('auto_route', False)
+    }
+
+
+class ConversationStore:
+    """
+    会话存储
+    写: 只标记脏数据 按flush_interval批量写入(write-behind); 读: 用户重启后第一次发消息时才加载
+    """
+
+    def __init__(self, flush_interval: float = 2.0, ttl: int = 7 * 24 * 3600, key_prefix: str = 'gpt_bot:conversation:'):
+        # 批量写入的间隔(秒)
+        self.flush_interval = flush_interval
+        # 会话的过期时间(秒)
+        self.ttl = ttl
+        self.key_prefix = key_prefix
+        # 待写入的会话 user_id -> user_data
+        self._dirty: dict[int, dict] = {}
+        self._flush_task: asyncio.Task | None = None
+
+    def key(self, user_id) -> str:
+        return f'{self.key_prefix}{user_id}'
+
+    def mark_dirty(self, user_id, user_data: dict):
+        """ 标记会话需要写入 不等待 """
+        self._dirty[user_id] = user_data
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # 写入期间新标记的会话留到下一轮
+        while self._dirty:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        """ 把所有脏会话在一个pipeline中写入 编码和压缩放在线程中执行 """
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        snapshots = {}
+        for user_id, user_data in dirty.items():
+            snapshot = take_snapshot(user_data)
+            if snapshot is not None:
+                snapshots[self.key(user_id)] = snapshot
+        if not snapshots:
+            return
+        try:
+            await asyncio.to_thread(self._write, snapshots)
+        except Exception as e:
+            logger.warning(f'persist {len(snapshots)} conversations failed: {e}')
+
+    async def close(self):
+        """ 退出前写入所有脏会话 不再等待下一轮批量写入 """
+        task, self._flush_task = self._flush_task, None
+        if task is not None and not task.done():
+            # 正在进行的写入在线程中继续完成
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        await self.flush()
+
+    def _write(self, snapshots: dict[str, dict]):
+        with redis_util.get_redis_client(global_var.get_redis_pool()) as redis_client:
+            pipeline = redis_client.pipeline(transaction=False)
+            for key, snapshot in snapshots.items():
+                snapshot['messages'] = encode_messages(snapshot['messages'])
+                pipeline.set(key, encode_snapshot(snapshot), ex=self.ttl)
+            pipeline.execute()
+
+    async def load(self, user_id) -> dict | None:
+        """ 读取会话 不存在或读取失败时返回None """
+        try:
+            data = await asyncio.to_thread(self._read, self.key(user_id))
+        except Exception as e:
+            logger.warning(f'load conversation of {user_id} failed: {e}')
+            return None
+        snapshot = decode_snapshot(data)
+        if snapshot is None:
+            return None
+        snapshot['messages'] = decode_messages(snapshot['messages'])
+        return snapshot
+
+    @staticmethod
+    def _read(key: str) -> bytes | None:
+        with redis_util.get_redis_client(global_var.get_redis_pool()) as redis_client:
+            return redis_util.get_bytes(redis_client, key)
+
+
+async def rehydrate(user_id, user_data: dict) -> bool:
+    """
+    恢复用户的会话(平台/面具/模型/历史消息)
+    @return: 是否恢复成功 失败时由调用方按默认值初始化
+    """
+    from my_utils import bot_util
+    snapshot = await CONVERSATION_STORE.load(user_id)
+    if snapshot is None or snapshot['platform'] not in bot_util.platforms:
+        return False
+    platform_config = bot_util.platforms[snapshot['platform']]
+    current_platform = await bot_util.instantiate_platform(platform_key=snapshot['platform'])
+    mask_key = snapshot['mask'] if snapshot['mask'] in platform_config['supported_masks'] \
+        else platform_config['supported_masks'][0]
+    current_mask = bot_util.masks[mask_key]
+    supported_models = platform_config['mask_model_mapping'][mask_key]
+    current_model = snapshot['model'] if snapshot['model'] in supported_models else supported_models[0]
+    current_platform.chat.set_max_message_count(current_mask['max_message_count'])
+    current_platform.chat._messages.load(snapshot['messages'])
+    user_data['current_platform'] = current_platform
+    user_data['current_mask'] = current_mask
+    user_data['current_model'] = current_model
+    if snapshot['clear_messages']:
+        user_data['clear_messages'] = snapshot['clear_messages']
+    user_data['compaction_tokens_saved'] = snapshot['tokens_saved']
+    if snapshot.get('auto_route'):
+        user_data['auto_route'] = True
+    logger.info(f'restored conversation of {user_id}: {len(snapshot["messages"])} messages')
+    return True
+
+
+# 进程内共享的会话存储
+CONVERSATION_STORE = ConversationStore()
@@ -0,0 +1,199 @@
+""" 无状态面具(不携带历史消息)的回答缓存: 相同的提问直接返回缓存的回答 """
+import asyncio
+import hashlib
+import os
+import time
+from typing import AsyncIterator, Callable
+
+import orjson
+from telegram.ext import CallbackContext
+
+from bots.gpt_bot.core.near_duplicate import NearDuplicateIndex
+from my_utils import global_var, redis_util
+from my_utils.my_logging import get_logger
+
+logger = get_logger('response_cache')
+
+# 缓存的过期时间(秒)
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 24 * 3600))
+# 图片链接(DALL-E)一小时后失效 缓存时间不能超过
+IMAGE_URL_TTL = 50 * 60
+# 是否对近似重复的提问返回缓存的回答
+ENABLE_NEAR_DUPLICATE_CACHE = int(os.getenv('ENABLE_NEAR_DUPLICATE_CACHE', 1))
+
+
+class CacheKey:
+    """ 缓存键 """
+
+    __slots__ = ('key', 'namespace', 'prompt', 'platform_name', 'scope')
+
+    def __init__(self, key: str, namespace: str, prompt: str, platform_name: str, scope: tuple):
+        # Redis中的键
+        self.key = key
+        # (平台, 模型, 面具, 请求参数)的哈希 近似查找只在同一命名空间内进行
+        self.namespace = namespace
+        # 规整空白后的提问
+        self.prompt = prompt
+        # 回答所属的平台
+        self.platform_name = platform_name
+        # (模型, 面具, 请求参数) 换平台时用于重新生成键
+        self.scope = scope
+
+
+class ResponseCache:
+    """
+    精确匹配的回答缓存 存储在Redis
+    键为(平台, 模型, 面具, 请求参数, 规整后的提问)的哈希; 只缓存max_message_count为0的面具 回答不依赖历史消息
+    携带历史消息的面具即使是对话的第一轮也不缓存(回答会影响后续对话 不能在用户间共享)
+    条数超过max_entries时淘汰最早写入的; 超过max_entry_bytes的回答不缓存
+    精确未命中时 在进程内的近似重复索引中查找相似的提问 返回其缓存的回答
+    """
+
+    def __init__(self, ttl: int = RESPONSE_CACHE_TTL, max_entries: int = 5000, max_entry_bytes: int = 64 * 1024,
+                 key_prefix: str = 'gpt_bot:response:', near_duplicates: NearDuplicateIndex | None = None):
+        self.ttl = ttl
+        # 缓存条数上限
+        self.max_entries = max_entries
+        # 单条回答的大小上限(字节)
+        self.max_entry_bytes = max_entry_bytes
+        self.key_prefix = key_prefix
+        # 按写入时间排序的索引(zset) 用于限制条数
+        self.index_key = f'{key_prefix}index'
+        # 近似重复索引 None表示只做精确匹配
+        self.near_duplicates = near_duplicates
+        # 进行中的写入 保留引用直到完成
+        self._tasks: set[asyncio.Task] = set()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def cacheable(context: CallbackContext, content) -> bool:
+        """ 面具不携带历史消息 且提问是非空的纯文本 """
+        return context.user_data['current_mask']['max_message_count'] == 0 \
+            and isinstance(content, str) and bool(content.strip())
+
+    def key_for(self, context: CallbackContext, content) -> CacheKey | None:
+        """
+        当前平台的缓存键 回答依赖历史消息或提问不是纯文本时返回None(不缓存)
+        @param content: 发给平台的提问(已压缩)
+        """
+        if not self.cacheable(context, content):
+            return None
+        current_mask = context.user_data['current_mask']
+        scope = (context.user_data['current_model'], current_mask['mask_key'], current_mask['openai_completion_options'])
+        return self._key(context.user_data['current_platform'].name, scope, ' '.join(content.split()))
+
+    def rekey(self, cache_key: CacheKey, platform_name: str) -> CacheKey:
+        """ 同一提问在另一个平台的缓存键 """
+        if platform_name == cache_key.platform_name:
+            return cache_key
+        return self._key(platform_name, cache_key.scope, cache_key.prompt)
+
+    def _key(self, platform_name: str, scope: tuple, prompt: str) -> CacheKey:
+        namespace = hashlib.sha256(orjson.dumps([platform_name, *scope], option=orjson.OPT_SORT_KEYS)).hexdigest()
+        digest = hashlib.sha256(f'{namespace}:{prompt}'.encode()).hexdigest()
+        return CacheKey(f'{self.key_prefix}{digest}', namespace, prompt, platform_name, scope)
+
+    async def get(self, cache_key: CacheKey) -> str | None:
+        """ 精确匹配 未命中时查找近似重复的提问 """
+        answer = await self._get(cache_key.key)
+        if answer is None and self.near_duplicates is not None:
+            found = self.near_duplicates.lookup(cache_key.namespace, cache_key.prompt)
+            if found is not None:
+                similar_key, similarity = found
+                answer = await self._get(similar_key)
+                if answer is None:
+                    # 缓存已过期或被淘汰
+                    self.near_duplicates.discard(similar_key)
+                else:
+                    self.near_hits += 1
+                    logger.debug(f'near duplicate hit, similarity={similarity:.2f}')
+                    return answer
+        if answer is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return answer
+
+    async def _get(self, key: str) -> str | None:
+        try:
+            return await asyncio.to_thread(self._read, key)
+        except Exception as e:
+            logger.warning(f'read response cache failed: {e}')
+            return None
+
+    def put(self, cache_key: CacheKey, answer: str, ttl: int | None = None):
+        """ 写入缓存 不等待 """
+        if not answer or len(answer.encode()) > self.max_entry_bytes:
+            return
+        if self.near_duplicates is not None:
+            self.near_duplicates.add(cache_key.namespace, cache_key.prompt, cache_key.key)
+        task = asyncio.create_task(self._put(cache_key.key, answer, min(ttl or self.ttl, self.ttl)))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _put(self, key: str, answer: str, ttl: int):
+        try:
+            await asyncio.to_thread(self._write, key, answer, ttl)
+        except Exception as e:
+            logger.warning(f'write response cache failed: {e}')
+
+    @staticmethod
+    def _read(key: str) -> str | None:
+        with redis_util.get_redis_client(global_var.get_redis_pool()) as redis_client:
+            return redis_client.get(key)
+
+    def _write(self, key: str, answer: str, ttl: int):
+        now = time.time()
+        with redis_util.get_redis_client(global_var.get_redis_pool()) as redis_client:
+            pipeline = redis_client.pipeline(transaction=False)
+            pipeline.set(key, answer, ex=ttl)
+            pipeline.zadd(self.index_key, {key: now})
+            # 索引中已过期的键
+            pipeline.zremrangebyscore(self.index_key, 0, now - self.ttl)
+            pipeline.zcard(self.index_key)
+            overflow = pipeline.execute()[-1] - self.max_entries
+            if overflow > 0:
+                evicted = [member for member, _ in redis_client.zpopmin(self.index_key, overflow)]
+                redis_client.delete(*evicted)
+
+    async def wrap(self, key: CacheKey | None, results: AsyncIterator, stream: bool = True, incremental: bool = True,
+                   ttl: int | None = None, producer: Callable[[], str | None] | None = None) -> AsyncIterator:
+        """
+        命中时直接返回缓存的回答(不请求平台) 未命中时透传平台的结果并缓存完整回答
+        @param results: 平台的结果 流式为(状态, 内容) 非流式为回答
+        @param incremental: 流式结果是否包含增量(图片生成只有finished)
+        @param producer: 结束后返回实际给出回答的平台(对冲平台胜出时) None表示不缓存(如多个平台续写拼成的回答)
+        """
+        if key is None:
+            async for result in results:
+                yield result
+            return
+        answer = await self.get(key)
+        if answer is not None:
+            await results.aclose()
+            logger.debug(f'response cache hit: hits={self.hits}, near_hits={self.near_hits}, misses={self.misses}')
+            if not stream:
+                yield answer
+            else:
+                if incremental:
+                    yield 'not_finished', answer
+                yield 'finished', answer
+            return
+        async for result in results:
+            if not stream:
+                answer = result
+            elif result[0] == 'finished':
+                answer = result[1]
+            yield result
+        platform_name = key.platform_name if producer is None else producer()
+        if answer and platform_name is not None:
+            self.put(self.rekey(key, platform_name), answer, ttl)
+
+
+# 进程内共享的回答缓存
+RESPONSE_CACHE_MAX_ENTRIES = 5000
+RESPONSE_CACHE = ResponseCache(
+    max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+    near_duplicates=NearDuplicateIndex(max_entries=RESPONSE_CACHE_MAX_ENTRIES) if ENABLE_NEAR_DUPLICATE_CACHE else None)
@@ -0,0 +1,228 @@
+""" 平台健康度评分与熔断 """
+import time
+from collections import deque
+from typing import AsyncIterator, Iterable
+
+from my_utils.my_logging import get_logger
+
+logger = get_logger('router')
+
+# 熔断器状态
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# 请求结果
+OK = 0
+ERROR = 1
+EMPTY = 2
+
+
+class PlatformHealth:
+    """ 单个平台的健康度 """
+
+    __slots__ = ('outcomes', 'ttft', 'consecutive_failures', 'state', 'opened_at', 'cooldown')
+
+    def __init__(self, window: int, cooldown: float):
+        # 最近window次请求的结果
+        self.outcomes: deque = deque(maxlen=window)
+        # 首个token耗时(秒)的指数移动平均 没有数据时为None
+        self.ttft: float | None = None
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self.opened_at = 0.0
+        # 当前的熔断时长(秒) 半开探测失败后翻倍
+        self.cooldown = cooldown
+
+    def rate(self, outcome: int) -> float:
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(outcome) / len(self.outcomes)
+
+    @property
+    def error_rate(self) -> float:
+        return self.rate(ERROR)
+
+    @property
+    def empty_rate(self) -> float:
+        return self.rate(EMPTY)
+
+    def __repr__(self) -> str:
+        ttft = 'n/a' if self.ttft is None else f'{self.ttft:.2f}s'
+        return (f'PlatformHealth(state={self.state}, ttft={ttft}, error_rate={self.error_rate:.2f}, '
+                f'empty_rate={self.empty_rate:.2f}, samples={len(self.outcomes)})')
+
+
+class PlatformRouter:
+    """
+    平台路由
+    记录每个平台的首个token耗时/错误率/空回答率 失败过多时熔断; 为开启自动路由的用户选择支持当前面具和模型的最健康平台
+    """
+
+    def __init__(self, window: int = 20, min_samples: int = 4, failure_threshold: float = 0.5,
+                 max_consecutive_failures: int = 3, cooldown: float = 30.0, max_cooldown: float = 600.0,
+                 ttft_alpha: float = 0.3, default_ttft: float = 3.0, switch_margin: float = 0.7):
+        # 统计窗口(请求数)
+        self.window = window
+        # 按失败率熔断需要的最少样本数
+        self.min_samples = min_samples
+        # 失败率(错误+空回答)达到该值时熔断
+        self.failure_threshold = failure_threshold
+        # 连续失败达到该次数时熔断
+        self.max_consecutive_failures = max_consecutive_failures
+        # 熔断时长(秒) 半开探测失败后翻倍 不超过max_cooldown
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        # 首个token耗时的平滑系数
+        self.ttft_alpha = ttft_alpha
+        # 没有数据的平台按该耗时估算 让新平台也有机会被选中
+        self.default_ttft = default_ttft
+        # 最优平台的得分低于当前平台得分的该比例时才切换 避免来回切换
+        self.switch_margin = switch_margin
+        self._health: dict[str, PlatformHealth] = {}
+
+    def health(self, platform_key: str) -> PlatformHealth:
+        health = self._health.get(platform_key)
+        if health is None:
+            health = self._health[platform_key] = PlatformHealth(self.window, self.cooldown)
+        return health
+
+    def available(self, platform_key: str) -> bool:
+        """ 熔断器是否放行(熔断期已过的平台允许一次探测) """
+        health = self._health.get(platform_key)
+        if health is None or health.state == CLOSED:
+            return True
+        if health.state == HALF_OPEN:
+            # 已有探测请求在进行
+            return False
+        return time.monotonic() - health.opened_at >= health.cooldown
+
+    def score(self, platform_key: str) -> float:
+        """ 得分 越低越好: 预计首个token耗时 按错误率和空回答率加权 """
+        health = self._health.get(platform_key)
+        if health is None:
+            return self.default_ttft
+        ttft = self.default_ttft if health.ttft is None else health.ttft
+        return ttft * (1 + 4 * health.error_rate + 2 * health.empty_rate)
+
+    def candidates(self, platforms: dict, mask_key: str, model: str, allowed_keys: Iterable[str],
+                   required_models: Iterable[str] = ()) -> list[str]:
+        """
+        支持当前面具和模型且未熔断的平台 按得分排序
+        @param platforms: 平台配置(platforms.json)
+        @param allowed_keys: 用户可以使用的平台
+        @param required_models: 平台还需要支持的模型(如语音输入需要whisper-1)
+        """
+        result = []
+        for key in allowed_keys:
+            config = platforms.get(key)
+            if config is None or mask_key not in config['supported_masks']:
+                continue
+            if model not in config['mask_model_mapping'].get(mask_key, ()):
+                continue
+            if any(required not in config['supported_models'] for required in required_models):
+                continue
+            if self.available(key):
+                result.append(key)
+        result.sort(key=self.score)
+        return result
+
+    def choose(self, current_key: str, platforms: dict, mask_key: str, model: str, allowed_keys: Iterable[str],
+               required_models: Iterable[str] = ()) -> str:
+        """
+        选择平台 当前平台可用且没有明显更好的平台时保持不变
+        @return: 平台key 没有可用平台时返回当前平台
+        """
+        ranked = self.candidates(platforms, mask_key, model, allowed_keys, required_models)
+        if not ranked:
+            return current_key
+        best = ranked[0]
+        if current_key in ranked and self.score(best) >= self.switch_margin * self.score(current_key):
+            return current_key
+        return best
+
+    def record_success(self, platform_key: str, ttft: float):
+        health = self.health(platform_key)
+        health.ttft = ttft if health.ttft is None else \
+            self.ttft_alpha * ttft + (1 - self.ttft_alpha) * health.ttft
+        health.consecutive_failures = 0
+        health.outcomes.append(OK)
+        if health.state != CLOSED:
+            # 探测成功 之前的失败不再计入
+            health.state = CLOSED
+            health.cooldown = self.cooldown
+            health.outcomes.clear()
+            health.outcomes.append(OK)
+            logger.info(f'{platform_key}已恢复: {health}')
+
+    def record_error(self, platform_key: str):
+        self._record_failure(platform_key, ERROR)
+
+    def record_empty(self, platform_key: str):
+        self._record_failure(platform_key, EMPTY)
+
+    def _record_failure(self, platform_key: str, outcome: int):
+        health = self.health(platform_key)
+        health.consecutive_failures += 1
+        health.outcomes.append(outcome)
+        if health.state == HALF_OPEN:
+            health.cooldown = min(health.cooldown * 2, self.max_cooldown)
+            self._open(platform_key, health)
+            return
+        if health.state == OPEN:
+            return
+        failure_rate = health.error_rate + health.empty_rate
+        if health.consecutive_failures >= self.max_consecutive_failures or \
+                (len(health.outcomes) >= self.min_samples and failure_rate >= self.failure_threshold):
+            self._open(platform_key, health)
+
+    def _open(self, platform_key: str, health: PlatformHealth):
+        health.state = OPEN
+        health.opened_at = time.monotonic()
+        logger.warning(f'{platform_key}已熔断{health.cooldown:.0f}秒: {health}')
+
+    async def observe(self, platform_key: str, results: AsyncIterator) -> AsyncIterator:
+        """
+        透传平台的回答 同时记录首个token耗时和请求结果
+        @param results: 流式为(状态, 内容) 非流式为回答字符串
+        """
+        health = self.health(platform_key)
+        if health.state == OPEN and self.available(platform_key):
+            health.state = HALF_OPEN
+        started = time.monotonic()
+        ttft = None
+        answered = False
+        recorded = False
+        try:
+            async for result in results:
+                if isinstance(result, tuple):
+                    status, payload = result
+                    if status == 'finished':
+                        answered = bool(payload)
+                    elif status == 'additional':
+                        payload = None
+                else:
+                    payload = result
+                    answered = answered or bool(payload)
+                if ttft is None and payload:
+                    ttft = time.monotonic() - started
+                yield result
+        except Exception:
+            # 取消(CancelledError/GeneratorExit)不计入平台的失败
+            recorded = True
+            self.record_error(platform_key)
+            raise
+        else:
+            recorded = True
+            if answered:
+                self.record_success(platform_key, ttft if ttft is not None else time.monotonic() - started)
+            else:
+                self.record_empty(platform_key)
+        finally:
+            if not recorded and health.state == HALF_OPEN:
+                # 探测请求被中止 等待下一次探测
+                health.state = OPEN
+
+
+# 进程内共享的平台路由
+PLATFORM_ROUTER = PlatformRouter()
@@ -1,10 +1,14 @@
+from collections import deque
+from email.utils import parsedate_to_datetime
+import random
+import time
 from typing import Any, Callable, Coroutine, Dict, Generator, Literal, LiteralString
 import aiohttp
 import asyncio
 from aiohttp import ClientResponse
 from aiohttp.client import _RequestContextManager
-import orjson
-from bots.gpt_bot.core.streaming import SSE_DECODER
+from bots.gpt_bot.core.credentials import CREDENTIALS
+from bots.gpt_bot.core.streaming import SSEDecoder, completion_answer
 from bots.gpt_bot.gpt_platform import Platform
 from my_utils.my_logging import get_logger
 from telegram.ext import CallbackContext
@@ -14,19 +18,16 @@ logger = get_logger('gpt-session')
 
 
 async def reauth(current_platform: Platform, context: CallbackContext):
+    """
+    重新认证
+    同一平台的并发认证只会执行一次; 新的授权信息会同步到所有使用该平台的实例 当前平台对象(含历史消息)保持不变
+    """
     from my_utils import bot_util
-    """ 重新认证 """
-    json_data = None
-    with open(bot_util.TEMP_CONFIG_PATH, mode='r', encoding='utf-8') as f:
-        json_data: dict = orjson.loads(f.read())
-        if current_platform.name in json_data:
-            if 'openai_api_key' in json_data[current_platform.name]:
-                json_data[current_platform.name].pop('openai_api_key')
-    if json_data:
-        with open(bot_util.TEMP_CONFIG_PATH, mode='w+', encoding='utf-8') as f:
-            f.write(orjson.dumps(json_data).decode())
-            # 刷新token成功!
-    current_platform = context.user_data['current_platform'] = await bot_util.instantiate_platform(platform_key=current_platform.name)
+    if not CREDENTIALS.manages(current_platform.name):
+        # 授权信息不需要生成的平台(如free_1/free_2) 无需处理
+        return current_platform
+    await CREDENTIALS.refresh(bot_util.platforms[current_platform.name],
+                              stale_token=current_platform.openai_api_key)
     return current_platform
 
 
@@ -67,10 +68,100 @@ async def handle_server_internal_error(e: Exception, context: CallbackContext, *
         kwargs['headers']['authorization'] = current_platform.openai_api_key
 
 
+class RetryPolicy:
+    """ 某个状态码的重试策略 """
+
+    def __init__(self, handler: Callable[..., Coroutine[None, None, None]] = None, retry: bool = True,
+                 honour_retry_after: bool = True):
+        # 重试前执行的处理器(如重新认证) 处理器抛出异常时放弃重试
+        self.handler = handler
+        # 是否重试
+        self.retry = retry
+        # 是否遵守响应头Retry-After
+        self.honour_retry_after = honour_retry_after
+
+
+# 状态码 -> 重试策略 没有配置的状态码直接抛出异常
+DEFAULT_STATUS_POLICIES: Dict[int, RetryPolicy] = {
+    401: RetryPolicy(handle_unauthorized_error),
+    403: RetryPolicy(handle_unauthorized_error),
+    405: RetryPolicy(handle_method_not_allowed),
+    429: RetryPolicy(),
+    500: RetryPolicy(handle_server_internal_error),
+    502: RetryPolicy(handle_service_unavailable),
+    503: RetryPolicy(handle_service_unavailable),
+    504: RetryPolicy(handle_service_unavailable),
+}
+
+
+class RetryBudget:
+    """
+    进程内共享的重试预算
+    统计窗口内重试数不超过 请求数*ratio(至少min_retries次) 上游故障时所有请求不会一起重试放大负载
+    """
+
+    def __init__(self, ratio: float = 0.2, min_retries: int = 10, window: float = 10.0):
+        # 重试数与请求数的比例上限
+        self.ratio = ratio
+        # 请求量很少时也允许的重试数
+        self.min_retries = min_retries
+        # 统计窗口(秒)
+        self.window = window
+        self._requests: deque = deque()
+        self._retries: deque = deque()
+        # 因预算耗尽放弃的重试数
+        self.exhausted = 0
+
+    def _prune(self, now: float):
+        deadline = now - self.window
+        for timestamps in (self._requests, self._retries):
+            while timestamps and timestamps[0] < deadline:
+                timestamps.popleft()
+
+    def record_request(self):
+        self._requests.append(time.monotonic())
+
+    def try_acquire(self) -> bool:
+        """ 申请一次重试 预算不足时返回False """
+        now = time.monotonic()
+        self._prune(now)
+        if len(self._retries) >= max(self.min_retries, self.ratio * len(self._requests)):
+            self.exhausted += 1
+            return False
+        self._retries.append(now)
+        return True
+
+    def __repr__(self) -> str:
+        self._prune(time.monotonic())
+        return (f'RetryBudget(requests={len(self._requests)}, retries={len(self._retries)}, '
+                f'exhausted={self.exhausted})')
+
+
+# 进程内共享的重试预算
+RETRY_BUDGET = RetryBudget()
+
+
+def retry_after_seconds(e: Exception) -> float | None:
+    """ 解析响应头Retry-After(秒数或HTTP日期) """
+    headers = getattr(e, 'headers', None)
+    value = headers.get('Retry-After') if headers else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
 class SessionWithRetry:
 
-    def __init__(self, session: aiohttp.ClientSession, context: CallbackContext, retry_attempts: int = 3, retry_interval: float = 2.0,
-                 conditions_handlers: Dict[Callable[[Exception], bool], Coroutine[None, Exception, None]] = None):
+    def __init__(self, session: aiohttp.ClientSession, context: CallbackContext, retry_attempts: int = 3, retry_interval: float = 1.0,
+                 max_retry_interval: float = 10.0, max_retry_after: float = 30.0,
+                 status_policies: Dict[int, RetryPolicy] = None, budget: RetryBudget = RETRY_BUDGET):
         """ 会话增强-自动重试 """
         # 会话对象
         self.session = session
@@ -78,81 +169,85 @@ class SessionWithRetry:
         self.context = context
         # 重试次数
         self.retry_attempts = retry_attempts
-        # 重试间隔
+        # 退避的基础间隔 第n次重试前等待 [0, retry_interval * 2^n) 的随机时长
         self.retry_interval = retry_interval
-        # 条件处理器映射 注册几个默认的  不要配置重复条件 因为只会后面的条件可能得不到执行机会!
-        self.conditions_handlers = conditions_handlers or {
-            lambda e: hasattr(e, 'status') and e.status == 403: handle_unauthorized_error,
-            lambda e: hasattr(e, 'status') and e.status == 405: handle_method_not_allowed,
-            lambda e: hasattr(e, 'status') and e.status == 500: handle_server_internal_error,
-            lambda e: hasattr(e, 'status') and e.status == 503: handle_service_unavailable,
-        }
+        # 退避间隔的上限
+        self.max_retry_interval = max_retry_interval
+        # Retry-After超过该值时不再重试
+        self.max_retry_after = max_retry_after
+        # 状态码 -> 重试策略
+        self.status_policies = DEFAULT_STATUS_POLICIES if status_policies is None else status_policies
+        # 重试预算
+        self.budget = budget
+
+    def backoff(self, attempt: int, retry_after: float | None = None) -> float:
+        """ 指数退避 + 全抖动 服务端指定了Retry-After时不早于该时间 """
+        delay = random.uniform(0, min(self.max_retry_interval, self.retry_interval * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
 
     async def fetch_with_retry(self, method: str, url: str, stream: bool = False, **kwargs):
         attempt = 0
         exception = None
+        self.budget.record_request()
         while attempt < self.retry_attempts:
+            retry_after = None
             try:
                 async with getattr(self.session, method)(url, allow_redirects=True, **kwargs) as resp:
                     if stream:
-                        sse_iter = SSE_DECODER.aiter_bytes(
+                        # 每个响应使用独立的解析器 避免并发流之间状态串扰
+                        sse_iter = SSEDecoder().aiter_bytes(
                             resp.content.iter_any())
-                        answer = ''
                         answer_parts = []
                         async for sse in sse_iter:
-                            answer_parts.append(sse.data)
-                            answer = ''.join(answer_parts)
-                            yield 'not_finished', answer
-                        if not answer:
-                            await asyncio.sleep(self.retry_interval)
-                            attempt += 1
-                            continue
-                        yield 'finished', answer
+                            delta = sse.data
+                            if delta:
+                                answer_parts.append(delta)
+                                yield 'not_finished', delta
+                        # 完整回答只在流结束时拼接一次
+                        answer = ''.join(answer_parts)
+                        if answer:
+                            yield 'finished', answer
+                            return
                     else:
-                        completion = await resp.text()
-                        result = []
-                        for line in completion.splitlines():
-                            if line or line != 'data: [DONE]':
-                                try:
-                                    delta = orjson.loads(line[6:])[
-                                        'choices'][0]['delta']
-                                    if delta:
-                                        result.append(delta['content'])
-                                except:
-                                    continue
-                        answer = ''.join(result)
-                        if not answer:
-                            await asyncio.sleep(self.retry_interval)
-                            attempt += 1
-                            continue
-                        yield answer
-                    return
+                        # 响应体通常依然是SSE格式 复用解析器 每个事件只解析一次 末尾没有空行的事件同样保留
+                        completion = await resp.read()
+                        answer = completion_answer(completion)
+                        if answer:
+                            yield answer
+                            return
+                # 空回答 按退避间隔重试
 
             except Exception as e:
-                should_retry = False
-                for condition, handler in self.conditions_handlers.items():
-                    if condition(e):
-                        try:
-                            # 记录改异常 日志会用到
-                            exception = e
-                            # 尝试处理器
-                            await handler(e, self.context, **kwargs)
-                            should_retry = True
-                            # 隔几秒后重新发起请求
-                            await asyncio.sleep(self.retry_interval)
-                            break
-                        except Exception as handler_exception:
-                            # 异常处理器方法报错 放弃重试
-                            raise handler_exception
-                if not should_retry:
-                    # 如果没有满足条件的处理器则直接抛出异常
+                policy = self.status_policies.get(getattr(e, 'status', None))
+                if policy is None or not policy.retry:
+                    # 如果没有满足条件的策略则直接抛出异常
                     raise e
+                # 记录改异常 日志会用到
+                exception = e
+                if policy.honour_retry_after:
+                    retry_after = retry_after_seconds(e)
+                    if retry_after is not None and retry_after > self.max_retry_after:
+                        raise e
+                if policy.handler is not None:
+                    # 处理器报错(如重新认证失败) 放弃重试
+                    await policy.handler(e, self.context, **kwargs)
 
             attempt += 1
+            if attempt >= self.retry_attempts:
+                break
+            if not self.budget.try_acquire():
+                logger.warning(f'retry budget exhausted, give up {url}: {self.budget}')
+                break
+            await asyncio.sleep(self.backoff(attempt - 1, retry_after))
 
+        if exception is not None:
+            raise Exception(
+                f"Error still occurs after {attempt} attempts:\n\n{str(exception)}")
         # 如果尝试次数已用尽，抛出异常
         raise Exception(
-            f"Error still occurs after {self.retry_attempts} attempts:\n\n{str(exception)}")
+            f"Empty answer after {attempt} attempts")
 
     async def post(self, url: str, stream: bool = False, **kwargs):
         """ 增强post方法 """
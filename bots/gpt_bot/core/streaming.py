@@ -1,8 +1,52 @@
 import orjson
-from typing import Any, AsyncIterator, Iterator
+from typing import Any, AsyncIterator, Iterator, NamedTuple, Sequence
+
+
+class StreamDelta(NamedTuple):
+    """ 单个流式事件中与回答相关的字段 """
+    # 增量文本
+    content: str = ''
+    # 结束原因 stop / length / tool_calls ... 未结束时为None
+    finish_reason: str | None = None
+    # 工具调用的增量 原样保留接口返回的列表
+    tool_calls: list[dict] | None = None
+    # token用量 通常只出现在最后一个事件中
+    usage: dict | None = None
+
+
+# [DONE]或者无法解析的事件共用同一个空结果
+EMPTY_DELTA = StreamDelta()
+
+
+def extract_delta(data: str) -> StreamDelta:
+    """ 从chat.completion.chunk中一次性提取所需字段 """
+    if not data or data == '[DONE]':
+        return EMPTY_DELTA
+    try:
+        chunk = orjson.loads(data)
+    except orjson.JSONDecodeError:
+        # 心跳等非json事件
+        return EMPTY_DELTA
+    if not isinstance(chunk, dict):
+        return EMPTY_DELTA
+    usage = chunk.get('usage')
+    choices = chunk.get('choices')
+    if not choices:
+        # 部分接口会在最后单独返回一个只有usage的事件
+        return StreamDelta(usage=usage) if usage else EMPTY_DELTA
+    choice = choices[0]
+    delta = choice.get('delta') or {}
+    return StreamDelta(
+        content=delta.get('content') or '',
+        finish_reason=choice.get('finish_reason'),
+        tool_calls=delta.get('tool_calls'),
+        usage=usage
+    )
 
 
 class ServerSentEvent:
+    __slots__ = ('_id', '_data', '_event', '_retry', '_delta')
+
     def __init__(
         self,
         *,
@@ -18,6 +62,8 @@ class ServerSentEvent:
         self._data = data
         self._event = event or None
         self._retry = retry
+        # 解析结果 首次访问时才解析 之后直接复用
+        self._delta: StreamDelta | None = None
 
     @property
     def event(self) -> str | None:
@@ -31,22 +77,48 @@ class ServerSentEvent:
     def retry(self) -> int | None:
         return self._retry
 
+    @property
+    def delta(self) -> StreamDelta:
+        delta = self._delta
+        if delta is None:
+            delta = self._delta = extract_delta(self._data)
+        return delta
+
     @property
     def data(self) -> str:
-        # 如果是 [DONE] 就返回 [DONE] 不是的话 就尝试解析
-        if self._data == '[DONE]':
-            return ''
-        else:
-            return orjson.loads(self._data)['choices'][0]['delta'].get('content', '')
+        # 增量文本 [DONE] 返回空字符串
+        return self.delta.content
+
+    @property
+    def finish_reason(self) -> str | None:
+        return self.delta.finish_reason
+
+    @property
+    def tool_calls(self) -> list[dict] | None:
+        return self.delta.tool_calls
+
+    @property
+    def usage(self) -> dict | None:
+        return self.delta.usage
 
     def json(self) -> Any:
         return orjson.loads(self._data)
 
     def __repr__(self) -> str:
-        return f"ServerSentEvent(event={self.event}, data={self.data}, id={self.id}, retry={self.retry})"
+        return f"ServerSentEvent(event={self.event}, data={self._data}, id={self.id}, retry={self.retry})"
+
+
+# 已消费的字节超过该阈值才压缩缓冲区 避免每个事件都搬移剩余数据
+_COMPACT_THRESHOLD = 64 * 1024
+# 换行符的字节值
+_LF = 0x0A
+_CR = 0x0D
+# 没有完整事件时返回的共享空结果
+_NO_EVENTS: tuple = ()
 
 
 class SSEDecoder:
+    """ SSE解析器 持有单个响应的解析状态 每个响应都要单独实例化 不可在并发的流之间共享 """
     _data: list[str]
     _event: str | None
     _retry: int | None
@@ -57,51 +129,120 @@ class SSEDecoder:
         self._data = []
         self._last_event_id = None
         self._retry = None
+        # 可复用的接收缓冲区
+        self._buffer = bytearray()
+        # 缓冲区中尚未消费的起始位置
+        self._start = 0
+        # 下一次查找事件分隔符的起始位置 已扫描过且不含分隔符的部分不再重复扫描
+        self._scan_from = 0
+        # 是否出现过\r 按照SSE规范 \r\n\r\n / \n\n / \r\r 均表示一个事件结束
+        self._has_cr = False
 
-    def iter_bytes(self, iterator: Iterator[bytes]) -> Iterator[ServerSentEvent]:
+    def iter_bytes(self, iterator: Iterator[bytes], emit_trailing: bool = False) -> Iterator[ServerSentEvent]:
         """Given an iterator that yields raw binary data, iterate over it & yield every event encountered"""
-        for chunk in self._iter_chunks(iterator):
-            # Split before decoding so splitlines() only uses \r and \n
-            for raw_line in chunk.splitlines():
-                line = raw_line.decode("utf-8")
-                sse = self.decode(line)
-                if sse:
-                    yield sse
-
-    def _iter_chunks(self, iterator: Iterator[bytes]) -> Iterator[bytes]:
-        """Given an iterator that yields raw binary data, iterate over it and yield individual SSE chunks"""
-        data = b""
         for chunk in iterator:
-            for line in chunk.splitlines(keepends=True):
-                data += line
-                if data.endswith((b"\r\r", b"\n\n", b"\r\n\r\n")):
-                    yield data
-                    data = b""
-        if data:
-            yield data
+            yield from self.feed(chunk)
+        yield from self.flush(emit_trailing)
 
     async def aiter_bytes(self, iterator: AsyncIterator[bytes]) -> AsyncIterator[ServerSentEvent]:
         """Given an iterator that yields raw binary data, iterate over it & yield every event encountered"""
-        async for chunk in self._aiter_chunks(iterator):
-            # Split before decoding so splitlines() only uses \r and \n
-            for raw_line in chunk.splitlines():
-                line = raw_line.decode("utf-8")
+        async for chunk in iterator:
+            for sse in self.feed(chunk):
+                yield sse
+        for sse in self.flush():
+            yield sse
+
+    def feed(self, chunk: bytes) -> Sequence[ServerSentEvent]:
+        """ 写入一段网络数据 返回其中所有完整的事件 """
+        buffer = self._buffer
+        buffer.extend(chunk)
+        # 用整数做成员判断 走memchr 比bytes子串判断快得多
+        if _LF not in chunk:
+            if _CR not in chunk:
+                # 不含换行符的分片不可能结束一个事件 无需查找
+                return _NO_EVENTS
+            self._has_cr = True
+        elif not self._has_cr and _CR in chunk:
+            self._has_cr = True
+        end, terminator_length = self._find_terminator(buffer)
+        if end == -1:
+            # 末尾不足一个分隔符的字节可能是被截断的分隔符 下次需要重新扫描
+            scan_from = len(buffer) - 3
+            self._scan_from = scan_from if scan_from > self._start else self._start
+            return _NO_EVENTS
+        events = []
+        start = self._start
+        with memoryview(buffer) as view:
+            while end != -1:
+                # 只在事件边界处做一次utf-8解码
+                self._decode_block(str(view[start:end], "utf-8"), events)
+                start = self._scan_from = end + terminator_length
+                end, terminator_length = self._find_terminator(buffer)
+        if start == len(buffer):
+            buffer.clear()
+            self._start = self._scan_from = 0
+        elif start > _COMPACT_THRESHOLD:
+            # 只搬移尚未消费的少量数据
+            del buffer[:start]
+            self._start = self._scan_from = 0
+        else:
+            self._start = start
+        return events
+
+    def flush(self, emit_trailing: bool = False) -> list[ServerSentEvent]:
+        """
+        流结束时处理缓冲区中剩余的数据 按照SSE规范 没有以空行结束的事件会被丢弃
+        @param emit_trailing: 保留末尾没有以空行结束的事件 用于一次性读取的完整响应体(非流式)
+        """
+        events = []
+        if self._start < len(self._buffer):
+            with memoryview(self._buffer) as view:
+                for line in str(view[self._start:], "utf-8", errors="replace").splitlines():
+                    sse = self.decode(line)
+                    if sse:
+                        events.append(sse)
+        if emit_trailing:
+            sse = self.decode("")
+            if sse:
+                events.append(sse)
+        self._buffer.clear()
+        self._start = self._scan_from = 0
+        return events
+
+    def _find_terminator(self, buffer: bytearray) -> tuple[int, int]:
+        """ 查找最靠前的事件分隔符 返回(位置, 分隔符长度) """
+        found = buffer.find(b"\n\n", self._scan_from)
+        if not self._has_cr:
+            # 绝大多数接口只使用\n 无需再查找其他分隔符
+            return found, 2
+        found_length = 2
+        for terminator in (b"\r\n\r\n", b"\r\r"):
+            # 只在已找到的位置之前查找 避免重复扫描整个缓冲区
+            limit = len(buffer) if found == -1 else found + len(terminator)
+            index = buffer.find(terminator, self._scan_from, limit)
+            if index != -1 and (found == -1 or index < found):
+                found, found_length = index, len(terminator)
+        return found, found_length
+
+    def _decode_block(self, block: str, events: list[ServerSentEvent]) -> None:
+        if "\n" not in block and "\r" not in block:
+            if block.startswith("data: ") and not self._data:
+                # 绝大多数事件只有一行data 直接构造事件
+                events.append(ServerSentEvent(
+                    event=self._event, data=block[6:], id=self._last_event_id, retry=self._retry))
+                self._event = None
+                self._retry = None
+                return
+            self.decode(block)
+        else:
+            for line in block.splitlines():
                 sse = self.decode(line)
                 if sse:
-                    yield sse
-
-    async def _aiter_chunks(self, iterator: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
-        """Given an iterator that yields raw binary data, iterate over it and yield individual SSE chunks"""
-        data = bytearray()
-        async for chunk in iterator:
-            lines = chunk.splitlines(keepends=True)
-            for line in lines:
-                data.extend(line)
-                if data.endswith((b"\r\r", b"\n\n", b"\r\n\r\n")):
-                    yield bytes(data)
-                    data.clear()
-        if data:
-            yield bytes(data)
+                    events.append(sse)
+        # 事件块结束 相当于遇到一个空行
+        sse = self.decode("")
+        if sse:
+            events.append(sse)
 
     def decode(self, line: str) -> ServerSentEvent | None:
         # See: https://html.spec.whatwg.org/multipage/server-sent-events.html#event-stream-interpretation  # noqa: E501
@@ -152,5 +293,17 @@ class SSEDecoder:
         return None
 
 
-# 全局SSE解析器
-SSE_DECODER = SSEDecoder()
+
+def completion_answer(body: bytes) -> str:
+    """
+    非流式响应的完整回答 部分平台无论stream取值都返回SSE
+    @param body: 完整的响应体 json或SSE(最后一个事件之后可能没有空行)
+    """
+    if body.lstrip().startswith(b'{'):
+        try:
+            choices = orjson.loads(body).get('choices')
+        except orjson.JSONDecodeError:
+            choices = None
+        if choices:
+            return (choices[0].get('message') or {}).get('content') or ''
+    return ''.join(sse.data for sse in SSEDecoder().iter_bytes((body,), emit_trailing=True))
@@ -0,0 +1,169 @@
+""" 流式回答的停滞检测: 上游中途不再发送数据时取消请求 由另一个健康的平台接着已输出的内容继续回答 """
+import asyncio
+import os
+from typing import TYPE_CHECKING, AsyncIterator, Iterable
+
+import aiohttp
+from telegram.ext import CallbackContext
+
+from bots.gpt_bot.core.router import PLATFORM_ROUTER
+from my_utils.my_logging import get_logger
+
+if TYPE_CHECKING:
+    from bots.gpt_bot.gpt_platform import Platform
+
+logger = get_logger('watchdog')
+
+# 等待第一个token的超时时间(秒) 长上下文/推理较慢的模型首个token本身就慢
+FIRST_TOKEN_TIMEOUT = float(os.getenv('STREAM_FIRST_TOKEN_TIMEOUT', 60))
+# 两个token之间的最长间隔(秒)
+STREAM_IDLE_TIMEOUT = float(os.getenv('STREAM_IDLE_TIMEOUT', 20))
+# 一次回答最多续写几次
+MAX_CONTINUATIONS = 2
+# 续写的提示词
+CONTINUE_PROMPT = '你的上一条回答因网络中断被截断了。请从中断处继续输出剩余内容，不要重复已经输出的部分，也不要添加任何说明。'
+# 续写开头与已输出内容重叠时去重: 先缓冲这么多字符再比较 重叠不少于MIN_OVERLAP个字符才去掉
+OVERLAP_PROBE = 64
+MIN_OVERLAP = 8
+
+
+class StreamStalled(Exception):
+    """ 上游在超时时间内没有发送任何数据 """
+
+    def __init__(self, platform_name: str, timeout: float):
+        super().__init__(f'{platform_name}超过{timeout:.0f}秒没有响应')
+        self.platform_name = platform_name
+
+
+async def watch_stream(platform_name: str, stream: AsyncIterator, first_timeout: float = FIRST_TOKEN_TIMEOUT,
+                       idle_timeout: float = STREAM_IDLE_TIMEOUT) -> AsyncIterator:
+    """
+    透传流式结果 超时没有新数据时取消上游请求并抛出StreamStalled
+    @param stream: 平台的流式结果 (状态, 内容)
+    """
+    timeout = first_timeout
+    try:
+        while True:
+            try:
+                async with asyncio.timeout(timeout):
+                    result = await anext(stream)
+            except StopAsyncIteration:
+                return
+            except TimeoutError:
+                # 超时会取消正在等待的读取 上游连接随之关闭
+                raise StreamStalled(platform_name, timeout) from None
+            yield result
+            if result[0] != 'additional':
+                timeout = idle_timeout
+    finally:
+        await stream.aclose()
+
+
+async def watched_request(gpt_platform: 'Platform', content, context: CallbackContext, session: aiohttp.ClientSession,
+                          first_timeout: float = FIRST_TOKEN_TIMEOUT) -> AsyncIterator:
+    """
+    平台的流式请求 经过停滞检测和健康统计
+    先准备提问(语音在这里转录 长语音需要较久) 首个token的超时和平台的首token耗时都从提问准备好之后开始计算
+    """
+    messages = await gpt_platform.prepare_messages(content)
+    results = PLATFORM_ROUTER.observe(gpt_platform.name, watch_stream(
+        gpt_platform.name, gpt_platform.completion(True, context, session, *messages), first_timeout))
+    try:
+        async for result in results:
+            yield result
+    finally:
+        await results.aclose()
+
+
+def strip_overlap(partial: str, head: str) -> str:
+    """ 去掉续写开头与已输出内容结尾重复的部分 """
+    for size in range(min(len(partial), len(head)), MIN_OVERLAP - 1, -1):
+        if partial.endswith(head[:size]):
+            return head[size:]
+    return head
+
+
+async def _continuation_platform(context: CallbackContext, allowed_keys: Iterable[str], excluded: set) -> 'Platform | None':
+    """ 续写平台: 支持当前面具和模型的最健康平台 使用当前历史消息的副本 """
+    from my_utils import bot_util
+    current_mask = context.user_data['current_mask']
+    candidates = PLATFORM_ROUTER.candidates(
+        bot_util.platforms, current_mask['mask_key'], context.user_data['current_model'], allowed_keys)
+    platform_key = next((key for key in candidates if key not in excluded), None)
+    if platform_key is None:
+        return None
+    new_platform = await bot_util.instantiate_platform(platform_key)
+    new_platform.chat.set_max_message_count(current_mask['max_message_count'])
+    new_platform.chat._messages.take_over(context.user_data['current_platform'].chat._messages)
+    return new_platform
+
+
+async def continue_on_stall(results: AsyncIterator, content, context: CallbackContext, session: aiohttp.ClientSession,
+                            allowed_keys: Iterable[str], origin: dict | None = None) -> AsyncIterator:
+    """
+    透传流式结果; 上游停滞时由另一个平台接着已输出的内容续写 用户看到的仍是同一条回答
+    续写的回答由当前平台写入历史消息(续写平台使用的是历史消息的副本)
+    @param results: 经过watch_stream的流式结果
+    @param content: 本次的提问内容
+    @param allowed_keys: 用户可以使用的平台
+    @param origin: 发生续写时origin['platform']置为None(回答由多个平台拼成)
+    """
+    answer_parts = []
+    try:
+        async for result in results:
+            if result[0] == 'not_finished':
+                answer_parts.append(result[1])
+            yield result
+        return
+    except StreamStalled as e:
+        # 语音需要重新转录 无法续写
+        if isinstance(content, dict):
+            raise
+        stalled = e
+    if origin is not None:
+        origin['platform'] = None
+    current_platform: 'Platform' = context.user_data['current_platform']
+    user_messages = await current_platform.prepare_messages(content)
+    excluded = {stalled.platform_name}
+    for _ in range(MAX_CONTINUATIONS):
+        partial = ''.join(answer_parts)
+        new_platform = await _continuation_platform(context, allowed_keys, excluded)
+        if new_platform is None:
+            raise stalled
+        logger.info(f'{stalled}, continue {len(partial)} chars on {new_platform.name}')
+        messages = list(user_messages)
+        if partial:
+            messages.append({'role': 'assistant', 'content': partial})
+            messages.append({'role': 'user', 'content': CONTINUE_PROMPT})
+        continuation = PLATFORM_ROUTER.observe(new_platform.name, watch_stream(
+            new_platform.name, new_platform.completion(True, context, session, *messages)))
+        head = ''
+        try:
+            async for status, item in continuation:
+                if status != 'not_finished':
+                    continue
+                if head is not None:
+                    head += item
+                    if len(head) < OVERLAP_PROBE:
+                        continue
+                    item, head = strip_overlap(partial, head), None
+                if item:
+                    answer_parts.append(item)
+                    yield 'not_finished', item
+            if head:
+                head = strip_overlap(partial, head)
+                answer_parts.append(head)
+                yield 'not_finished', head
+            break
+        except StreamStalled as e:
+            stalled = e
+            excluded.add(e.platform_name)
+            if head:
+                head = strip_overlap(partial, head)
+                answer_parts.append(head)
+                yield 'not_finished', head
+    else:
+        raise stalled
+    answer = ''.join(answer_parts)
+    yield 'finished', answer
+    await current_platform.chat.append_messages(answer, context, *user_messages)
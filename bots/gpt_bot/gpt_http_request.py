@@ -1,9 +1,19 @@
 # 定制化请求
+import asyncio
+import os
+import time
+from typing import TYPE_CHECKING
 
-import requests
-from fake_useragent import FakeUserAgent
+import aiohttp
 
-headers = {
+from my_utils import global_var
+from my_utils.ua_util import ua
+
+if TYPE_CHECKING:
+    from bots.gpt_bot.gpt_platform import Platform
+
+# 公共请求头 每次请求复制一份 不在并发的请求间共享修改
+BASE_HEADERS = {
     'accept': 'application/json',
     'accept-language': 'zh-CN,zh-TW;q=0.9,zh;q=0.8,en;q=0.7,ja;q=0.6',
     'priority': 'u=1, i',
@@ -14,72 +24,100 @@ headers = {
     'sec-fetch-mode': 'cors',
     'sec-fetch-site': 'cross-site'
 }
+# 余额查询的超时时间(秒)
+BALANCE_TIMEOUT = aiohttp.ClientTimeout(total=30)
+# 余额查询结果的缓存时间(秒)
+BALANCE_CACHE_TTL = int(os.getenv('BALANCE_CACHE_TTL', 60))
+
 
-# 随机ua
-ua = FakeUserAgent(browsers="chrome", os='windows', platforms='pc')
+def build_headers(authorization: str, **extra) -> dict:
+    """ 本次请求的请求头 """
+    return {**BASE_HEADERS, 'user-agent': ua.random, 'Authorization': authorization, **extra}
+
+
+async def read_json(response: aiohttp.ClientResponse):
+    """ 状态码不是200时以响应内容作为异常信息 """
+    if response.status != 200:
+        raise RuntimeError(await response.text())
+    return await response.json(content_type=None)
 
 
 class BotHttpRequest:
 
     @staticmethod
-    async def audio_transcribe(file_path: str, openai_api_key: str, openai_base_url: str):
-        headers['user-agent'] = ua.random
-        headers['Authorization'] = f'Bearer {openai_api_key}'
-        with open(file_path, 'rb') as file:
-            files = {
-                'file': (file_path, file, 'audio/wav')
-            }
-            data = {
-                'model': 'whisper-1'
-                # 'language': 'zh'
-            }
-            response = requests.post(
-                url=f'{openai_base_url}/audio/transcriptions',
-                files=files,
-                data=data,
-                headers=headers
-            )
-        if response.status_code == 200:
-            return response.json()['text']
-        else:
-            raise RuntimeError(response.text)
+    async def audio_transcribe(audio: bytes, file_name: str, openai_api_key: str, openai_base_url: str,
+                               mime_type: str = 'audio/ogg', session: aiohttp.ClientSession | None = None):
+        session = session or global_var.GLOBAL_SESSION
+        data = aiohttp.FormData()
+        data.add_field('file', audio, filename=file_name, content_type=mime_type)
+        data.add_field('model', 'whisper-1')
+        async with session.post(f'{openai_base_url}/audio/transcriptions', data=data,
+                                headers=build_headers(f'Bearer {openai_api_key}'), raise_for_status=False) as response:
+            return (await read_json(response))['text']
 
     # 获取订阅
     @staticmethod
-    async def get_subscription(openai_api_key: str, openai_base_url: str):
-        # 生成一个随机的 User-Agent
-        headers['user-agent'] = ua.random
-        headers['content-type'] = 'application/json'
-        headers['Authorization'] = f'Bearer {openai_api_key}'
-        response = requests.get(
-            f'{openai_base_url[:-3]}/dashboard/billing/subscription',
-            headers=headers
-        )
-        return response
+    async def get_subscription(openai_api_key: str, openai_base_url: str, session: aiohttp.ClientSession | None = None):
+        session = session or global_var.GLOBAL_SESSION
+        async with session.get(f'{openai_base_url[:-3]}/dashboard/billing/subscription',
+                               headers=build_headers(f'Bearer {openai_api_key}', **{'content-type': 'application/json'}),
+                               timeout=BALANCE_TIMEOUT, raise_for_status=False) as response:
+            return await read_json(response)
 
     # 获取使用信息
     @staticmethod
-    async def get_usage(openai_api_key: str, openai_base_url: str):
-        headers['user-agent'] = ua.random
-        headers['content-type'] = 'application/json'
-        headers['Authorization'] = f'Bearer {openai_api_key}'
-        response = requests.get(
-            f'{openai_base_url[:-3]}/dashboard/billing/usage',
-            headers=headers
-        )
-        return response
+    async def get_usage(openai_api_key: str, openai_base_url: str, session: aiohttp.ClientSession | None = None):
+        session = session or global_var.GLOBAL_SESSION
+        async with session.get(f'{openai_base_url[:-3]}/dashboard/billing/usage',
+                               headers=build_headers(f'Bearer {openai_api_key}', **{'content-type': 'application/json'}),
+                               timeout=BALANCE_TIMEOUT, raise_for_status=False) as response:
+            return await read_json(response)
 
     @staticmethod
-    async def query_balance(openai_api_key: str, openai_base_url: str):
-        headers['user-agent'] = ua.random
-        headers['content-type'] = 'application/json'
-        headers['Authorization'] = openai_api_key
-        response = requests.post(
-            f'{openai_base_url}/query/balance',
-            headers=headers
-        )
-        if response.status_code == 200:
-
-            return response.json()
-        else:
-            raise RuntimeError(response.text)
+    async def query_balance(openai_api_key: str, openai_base_url: str, session: aiohttp.ClientSession | None = None):
+        session = session or global_var.GLOBAL_SESSION
+        async with session.post(f'{openai_base_url}/query/balance',
+                                headers=build_headers(openai_api_key, **{'content-type': 'application/json'}),
+                                timeout=BALANCE_TIMEOUT, raise_for_status=False) as response:
+            return await read_json(response)
+
+
+class BalanceCache:
+    """
+    余额查询结果的缓存 按(平台, api_key)区分
+    ttl内直接返回上次的结果; 同时发起的查询合并为一次上游请求 失败的结果不缓存
+    """
+
+    def __init__(self, ttl: int = BALANCE_CACHE_TTL, max_entries: int = 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # (平台, api_key) -> (过期时间, 余额)
+        self._results: dict[tuple, tuple[float, str]] = {}
+        # (平台, api_key) -> 进行中的查询
+        self._inflight: dict[tuple, asyncio.Task] = {}
+
+    async def query(self, platform: 'Platform') -> str:
+        key = (platform.name, platform.openai_api_key)
+        cached = self._results.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._inflight[key] = asyncio.create_task(self._load(key, platform))
+        # 某个调用方被取消时不影响其他等待同一查询的调用方
+        return await asyncio.shield(task)
+
+    async def _load(self, key: tuple, platform: 'Platform') -> str:
+        try:
+            balance = await platform.query_balance()
+            now = time.monotonic()
+            if len(self._results) >= self.max_entries:
+                self._results = {k: v for k, v in self._results.items() if v[0] > now}
+            self._results[key] = (now + self.ttl, balance)
+            return balance
+        finally:
+            self._inflight.pop(key, None)
+
+
+# 进程内共享的余额缓存
+BALANCE_CACHE = BalanceCache()
@@ -1,19 +1,15 @@
 # 平台接口
 import asyncio
 import aiohttp
-import orjson
 import os.path
 from abc import ABCMeta
 import openai
 from telegram.ext import CallbackContext
 import platform
 from bots.gpt_bot.chat import Chat
-
-
+from bots.gpt_bot.core.audio import should_chunk, transcribe_chunked
+from bots.gpt_bot.core.streaming import completion_answer
 from bots.gpt_bot.gpt_http_request import BotHttpRequest
-from bots.gpt_bot.core.streaming import SSE_DECODER
-from fake_useragent import FakeUserAgent
-ua = FakeUserAgent(browsers="chrome", os='windows', platforms='pc')
 
 
 def gpt_platform(cls):
@@ -133,9 +129,10 @@ class Platform(metaclass=ABCMeta):
 
     async def completion(self, stream: bool,  context, session: aiohttp.ClientSession, *messages):
         # 默认的提问方法
+        # 流式响应约定: ('not_finished', 增量内容) ... ('finished', 完整回答) 完整回答只在结束时拼接一次
         openai_completion_options = context.user_data['current_mask']['openai_completion_options']
         new_messages, openai_completion_options = self.chat.combine_messages(
-            *messages, **openai_completion_options)
+            *messages, model=context.user_data.get('current_model'), **openai_completion_options)
         answer = ''
         if stream:
             completion = await self.chat.openai_client.chat.completions.create(**{
@@ -149,8 +146,8 @@ class Platform(metaclass=ABCMeta):
                 delta_content = item.choices[0].delta.content
                 if delta_content:
                     answer_parts.append(delta_content)
-                    answer = ''.join(answer_parts)
-                    yield 'not_finished', answer
+                    yield 'not_finished', delta_content
+            answer = ''.join(answer_parts)
             yield 'finished', answer
         else:
             completion = await self.chat.openai_client.chat.completions.create(**{
@@ -166,7 +163,7 @@ class Platform(metaclass=ABCMeta):
 
     async def prepare_messages(self, content) -> list[dict[str, str]]:
         if isinstance(content, dict) and content.get('type') == "audio":
-            return await self.audio_transcribe(content['audio_path'])
+            return await self.audio_transcribe(content)
         if isinstance(content, list):
             result = []
             for item in content:
@@ -189,21 +186,22 @@ class Platform(metaclass=ABCMeta):
         })
         return generate_res.data[0].url
 
-    async def audio_transcribe(self, ogg_path: str):
-        # 音频转录
-        try:
-            # 创建转录
-            with open(ogg_path, "rb") as audio_file:
-                transcript = await self.chat.openai_client.audio.transcriptions.create(
-                    file=audio_file,
-                    model='whisper-1',
-                    language='zh',
-                    response_format="text"
-                )
-            return [{"role": "user", "content": transcript}]
-        finally:
-            if os.path.exists(ogg_path):
-                os.remove(ogg_path)
+    async def audio_transcribe(self, audio: dict):
+        # 音频转录 直接上传内存中的音频 长音频分片并发转录
+        if should_chunk(audio):
+            transcript = await transcribe_chunked(audio, self.transcribe_audio)
+        else:
+            transcript = await self.transcribe_audio(audio['file_name'], audio['data'], audio['mime_type'])
+        return [{"role": "user", "content": transcript}]
+
+    async def transcribe_audio(self, file_name: str, data: bytes, mime_type: str) -> str:
+        # 单次上传转录
+        return await self.chat.openai_client.audio.transcriptions.create(
+            file=(file_name, data, mime_type),
+            model='whisper-1',
+            language='zh',
+            response_format="text"
+        )
 
     async def query_balance(self):
         # 查询余额
@@ -211,24 +209,34 @@ class Platform(metaclass=ABCMeta):
                                          BotHttpRequest.get_usage(self.openai_api_key, self.openai_base_url))
         subscription = responses[0]
         usage = responses[1]
-        total = orjson.loads(subscription.text)['soft_limit_usd']
-        used = orjson.loads(usage.text)['total_usage'] / 100
+        total = subscription['soft_limit_usd']
+        used = usage['total_usage'] / 100
         return f'已使用 ${round(used, 2)} , 订阅总额 ${round(total, 2)}'
 
-    async def summary(self, content: str, prompt: str, context, *messages):
-        """ 提取摘要 """
-        try:
-            res = await self.chat.openai_client.chat.completions.create(**{
-                "messages": [
-                    {'role': 'system', 'content': prompt},
-                    {'role': 'user', 'content': content}
-                ],
-                "model": "gpt-3.5-turbo",
-                "stream": False,
-                "timeout": 30
-            })
-            answer = res.choices[0].message.content
-        except:
-            answer = content
-        await self.chat.append_messages(
-            answer, context, *messages)
+    def summary_request(self, new_messages: list) -> tuple[str, dict, dict]:
+        """
+        生成摘要的请求 各平台的接口地址/认证方式不同时覆盖该方法
+        @return: (url, headers, json_data)
+        """
+        return f'{self.openai_base_url}/chat/completions', {
+            'authorization': f'Bearer {self.openai_api_key}'
+        }, {
+            'messages': new_messages,
+            'model': 'gpt-3.5-turbo',
+            'stream': False
+        }
+
+    async def summary(self, content: str, prompt: str, session: aiohttp.ClientSession) -> str:
+        """
+        提取摘要 通过共享会话请求 失败时抛出异常
+        @param content: 需要摘要的内容
+        @param prompt: 摘要提示词
+        """
+        url, headers, json_data = self.summary_request([
+            {'role': 'system', 'content': prompt},
+            {'role': 'user', 'content': content}
+        ])
+        async with session.post(url, headers=headers, json=json_data, timeout=aiohttp.ClientTimeout(total=30)) as resp:
+            body = await resp.read()
+        # 部分平台无论stream取值都返回SSE
+        return completion_answer(body)
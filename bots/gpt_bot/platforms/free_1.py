@@ -1,7 +1,6 @@
 # 免费的api平台 支持3.5-turbo
 import aiohttp
 from bots.gpt_bot.core.session import SessionWithRetry
-from bots.gpt_bot.core.streaming import SSE_DECODER
 from bots.gpt_bot.gpt_platform import Platform
 from bots.gpt_bot.gpt_platform import gpt_platform
 from my_utils.bot_util import ua
@@ -21,7 +20,7 @@ class Free_1(Platform):
         # 默认的提问方法
         openai_completion_options = context.user_data['current_mask']['openai_completion_options']
         new_messages, openai_completion_options = self.chat.combine_messages(
-            *messages, **openai_completion_options)
+            *messages, model=context.user_data.get('current_model'), **openai_completion_options)
         headers = {
             'origin': self.foreign_openai_base_url,
             'user-agent': ua.random,
@@ -37,3 +36,16 @@ class Free_1(Platform):
             yield result
         await self.chat.append_messages(
             result[1] if isinstance(result, tuple) else result, context, *messages)
+
+    def summary_request(self, new_messages: list) -> tuple[str, dict, dict]:
+        headers = {
+            'origin': self.foreign_openai_base_url,
+            'user-agent': ua.random,
+            'authorization': self.openai_api_key,
+        }
+        json_data = {
+            'messages': new_messages,
+            'stream': False,
+            'model': 'gpt-3.5-turbo'
+        }
+        return f'{self.foreign_openai_base_url}/chat/completions', headers, json_data
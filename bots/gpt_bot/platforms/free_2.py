@@ -2,45 +2,19 @@
 import asyncio
 import platform
 import aiohttp
-import js2py
-from bots.gpt_bot.core.streaming import SSE_DECODER
+from bots.gpt_bot.core.deepai_token import DEEPAI_TOKENS
+from bots.gpt_bot.core.hedging import LatencyHistory, race_streams
+from bots.gpt_bot.core.streaming import SSEDecoder
 from bots.gpt_bot.gpt_platform import Platform
 from bots.gpt_bot.gpt_platform import gpt_platform
 from telegram.ext import CallbackContext
 import orjson
 
-from my_utils import bot_util, code_util, tiktoken_util
-
-DEEP_AI_TOKEN_JS = """
-    function generateToken(agent) {
-        var d, e, g, f, l, h, k, m, n, p, q, w, r, y, C, I, H, D, t, E, z, N, M, ca, O, P, S, T, J, R, Q, W, X, da, ia, Y, ea, Z, U, aa, fa, ha;
-        p = Math.round(1E11 * Math.random()) + "";
-        q = function() {
-            for (var A = [], F = 0; 64 > F; )
-                A[F] = 0 | 4294967296 * Math.sin(++F % Math.PI);
-            return function(B) {
-                var G, K, L, ba = [G = 1732584193, K = 4023233417, ~G, ~K], V = [], x = unescape(encodeURI(B)) + "\u0080", v = x.length;
-                B = --v / 4 + 2 | 15;
-                for (V[--B] = 8 * v; ~v; )
-                    V[v >> 2] |= x.charCodeAt(v) << 8 * v--;
-                for (F = x = 0; F < B; F += 16) {
-                    for (v = ba; 64 > x; v = [L = v[3], G + ((L = v[0] + [G & K | ~G & L, L & G | ~L & K, G ^ K ^ L, K ^ (G | ~L)][v = x >> 4] + A[x] + ~~V[F | [x, 5 * x + 1, 3 * x + 5, 7 * x][v] & 15]) << (v = [7, 12, 17, 22, 5, 9, 14, 20, 4, 11, 16, 23, 6, 10, 15, 21][4 * v + x++ % 4]) | L >>> -v), G, K])
-                        G = v[1] | 0,
-                        K = v[2];
-                    for (x = 4; x; )
-                        ba[--x] += v[x]
-                }
-                for (B = ""; 32 > x; )
-                    B += (ba[x >> 3] >> 4 * (1 ^ x++) & 15).toString(16);
-                return B.split("").reverse().join("")
-            }
-        }();
-
-        return "tryit-" + p + "-" + q(agent + q(agent + q(agent + p + "x")));
-    }
-    """
+from my_utils import bot_util, code_util
 
 HTTP_PROXY = 'http://127.0.0.1:10809' if platform.system().lower() == 'windows' else None
+# LLaMA各后端的首个token耗时 所有会话共用
+LLAMA_LATENCY = LatencyHistory()
 
 
 @gpt_platform
@@ -56,7 +30,7 @@ class Free_2(Platform):
     async def completion(self, stream: bool, context: CallbackContext,  session: aiohttp.ClientSession, *messages):
         openai_completion_options = context.user_data['current_mask']['openai_completion_options']
         new_messages, openai_completion_options = self.chat.combine_messages(
-            *messages, **openai_completion_options)
+            *messages, model=context.user_data.get('current_model'), **openai_completion_options)
         # 当前模型
         current_model = context.user_data['current_model']
         # answer = ''
@@ -64,11 +38,17 @@ class Free_2(Platform):
         #     async for status, item in self.gpt_4o_complete(stream, new_messages, **kwargs):
         #         answer = item
         #         yield status, item
+        answer = ''
         if current_model == 'LLaMA':
             # 尝试deepinfra和deepai
             async for status, item in self.llama_complete(stream, new_messages, session):
-                answer = item
-                yield status, item
+                if status == 'finished':
+                    # 只有finished携带完整回答 其余为增量或附加内容
+                    answer = item
+                    if not stream:
+                        yield item
+                if stream:
+                    yield status, item
         # elif current_model == 'gemini-1.5-flash-latest':
             # 谷歌的收费模型
             #     async for status, item in self.gemini_complete(stream, new_messages):
@@ -149,18 +129,16 @@ class Free_2(Platform):
     # =========================================LLaMA===========================================
 
     async def llama_complete(self, stream: bool, new_messages: list, session: aiohttp.ClientSession):
-        # 尝试 deepinfra 然后尝试deepai
+        # deepai和deepinfra竞速 先输出内容的一方胜出 另一方立即取消(deepai会修改消息 各用一份副本)
+        backends = {
+            'deepai': self.deepai(stream, list(new_messages), session),
+            'deepinfra': self.deepinfra(stream, list(new_messages), session)
+        }
         try:
-            completion = self.deepai(stream, new_messages, session)
-            async for status, item in completion:
+            async for status, item in race_streams(backends, LLAMA_LATENCY):
                 yield status, item
-        except:
-            try:
-                completion = self.deepinfra(stream, new_messages, session)
-                async for status, item in completion:
-                    yield status, item
-            except:
-                raise RuntimeError('LLaMA请求失败!')
+        except Exception as e:
+            raise RuntimeError('LLaMA请求失败!') from e
 
     # =========================================LLaMA-DeepInfra===========================================
     async def deepinfra(self, stream: bool, new_messages: list, session: aiohttp.ClientSession):
@@ -174,15 +152,16 @@ class Free_2(Platform):
             "User-Agent": agent,
             "X-Deepinfra-Source": "web-page"
         }
-        answer = ''
         async with  session.post("https://api.deepinfra.com/v1/openai/chat/completions", headers=headers, json=json_data) as resp:
-            sse_iter = SSE_DECODER.aiter_bytes(resp.content.iter_any())
+            # 每个响应使用独立的解析器
+            sse_iter = SSEDecoder().aiter_bytes(resp.content.iter_any())
             answer_parts = []
             async for sse in sse_iter:
-                answer_parts.append(sse.data)
-                answer = ''.join(answer_parts)
-                yield 'not_finished', answer
-            yield 'finished', answer
+                delta = sse.data
+                if delta:
+                    answer_parts.append(delta)
+                    yield 'not_finished', delta
+            yield 'finished', ''.join(answer_parts)
     # =========================================LLaMA-Deepai===========================================
 
     async def deepai(self, stream: bool, new_messages: list, session: aiohttp.ClientSession):
@@ -203,14 +182,12 @@ class Free_2(Platform):
             "chat_style": "chat",
             "online": "online",
             "chatHistory": orjson.dumps(new_messages, option=orjson.OPT_INDENT_2).decode()}
-        agent = bot_util.ua.random
-        generateToken = js2py.eval_js(DEEP_AI_TOKEN_JS)
-        token = generateToken(agent)
+        # 预先生成的(User-Agent, api-key)
+        agent, token = DEEPAI_TOKENS.take()
         headers = {
             "api-key": token,
             "User-Agent": agent,
         }
-        answer = ''
         async with session.post("https://api.deepai.org/hacking_is_a_serious_crime", headers=headers, data=payload) as response:
             answer_parts = []
             other_parts = []
@@ -226,22 +203,22 @@ class Free_2(Platform):
                         splits = chunk.split('')   
                         # 属于主体内容
                         part_one = splits[0]
-                        answer_parts.append(part_one)
-                        answer = ''.join(answer_parts)
+                        if part_one:
+                            answer_parts.append(part_one)
+                            yield 'not_finished', part_one
                         is_finished = True
-                        yield 'finished', answer
+                        yield 'finished', ''.join(answer_parts)
                         # 属于附加内容 
                         part_two = splits[1]
                         other_parts.append(part_two)
                     else:
                         answer_parts.append(chunk)
-                        answer = ''.join(answer_parts)
-                        yield 'not_finished', answer
+                        yield 'not_finished', chunk
                 except:
                     # 解码失败
                     continue
             if not is_finished:
-                yield 'finished', answer
+                yield 'finished', ''.join(answer_parts)
             else:
                 yield 'additional', ''.join(other_parts)
     # =========================================gemini-1.5-flash-latest===========================================
@@ -249,25 +226,17 @@ class Free_2(Platform):
     async def gemini_complete(self, stream: bool, *new_messages):
         yield
         
-    async def summary(self, content: str, prompt: str,context, *messages):
+    async def summary(self, content: str, prompt: str, session: aiohttp.ClientSession) -> str:
         new_messages = [{'role': 'system', 'content': prompt}, {'role': 'user', 'content': content}]
-        payload = { 
+        payload = {
             "chat_style": "chat",
-                       
             "chatHistory": orjson.dumps(new_messages).decode()}
-        agent = bot_util.ua.random
-        generateToken = js2py.eval_js(DEEP_AI_TOKEN_JS)
-        token = generateToken(agent)
+        # 预先生成的(User-Agent, api-key)
+        agent, token = DEEPAI_TOKENS.take()
         headers = {
             "api-key": token,
             "User-Agent": agent,
         }
-        try:
-            async with aiohttp.ClientSession(raise_for_status=True,trust_env=True, timeout=aiohttp.ClientTimeout(total=30)) as session:
-                async with session.post("https://api.deepai.org/hacking_is_a_serious_crime", headers=headers, data=payload) as res:
-                    answer = await res.text() 
-        except:
-            answer =  content
-        await self.chat.append_messages(
-            answer, context, *messages)
-
+        async with session.post("https://api.deepai.org/hacking_is_a_serious_crime", headers=headers, data=payload,
+                                timeout=aiohttp.ClientTimeout(total=30)) as res:
+            return await res.text()
@@ -5,7 +5,7 @@ from bots.gpt_bot.core.session import SessionWithRetry
 from bots.gpt_bot.gpt_platform import gpt_platform
 from bots.gpt_bot.gpt_platform import Platform
 from telegram.ext import CallbackContext
-from my_utils import bot_util, tiktoken_util
+from my_utils import bot_util
 from my_utils.my_logging import get_logger
 
 logger = get_logger('free_3')
@@ -26,7 +26,7 @@ class Free_3(Platform):
     async def completion(self, stream: bool, context: CallbackContext, session: aiohttp.ClientSession, *messages):
         openai_completion_options = context.user_data['current_mask']['openai_completion_options']
         new_messages, openai_completion_options = self.chat.combine_messages(
-            *messages, **openai_completion_options)
+            *messages, model=context.user_data.get('current_model'), **openai_completion_options)
         json_data = {
             'stream': stream,
             'messages': new_messages,
@@ -44,9 +44,7 @@ class Free_3(Platform):
         await self.chat.append_messages(
             result[1] if isinstance(result, tuple) else result, context, *messages)
 
-    async def summary(self, content: str, prompt: str, context, *messages):
-        new_messages = [{'role': 'system', 'content': prompt},
-                        {'role': 'user', 'content': content}]
+    def summary_request(self, new_messages: list) -> tuple[str, dict, dict]:
         json_data = {
             'stream': True,
             'messages': new_messages,
@@ -57,12 +55,4 @@ class Free_3(Platform):
             'user-agent': bot_util.ua.random,
             'authorization': self.openai_api_key
         }
-        try:
-            async with aiohttp.ClientSession(raise_for_status=True, trust_env=True,  timeout=aiohttp.ClientTimeout(total=30)) as session:
-                async for summary in SessionWithRetry(session, context).post(
-                        f'{self.foreign_openai_base_url}/api/chat/completions', headers=headers, json=json_data):
-                    answer = summary
-        except:
-            answer = content
-        await self.chat.append_messages(
-            answer, context, *messages)
+        return f'{self.foreign_openai_base_url}/api/chat/completions', headers, json_data
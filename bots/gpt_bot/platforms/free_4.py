@@ -4,11 +4,10 @@ import platform
 import re
 import aiohttp
 from bots.gpt_bot.core.session import SessionWithRetry
-from bots.gpt_bot.core.streaming import SSE_DECODER
 from bots.gpt_bot.gpt_platform import gpt_platform
 from bots.gpt_bot.gpt_platform import Platform
 from telegram.ext import CallbackContext
-from my_utils import bot_util, code_util, tiktoken_util
+from my_utils import bot_util, code_util
 import orjson
 
 
@@ -58,7 +57,7 @@ class Free_4(Platform):
     async def completion(self, stream: bool, context: CallbackContext, session: aiohttp.ClientSession, *messages):
         openai_completion_options = context.user_data['current_mask']['openai_completion_options']
         new_messages, openai_completion_options = self.chat.combine_messages(
-            *messages, **openai_completion_options)
+            *messages, model=context.user_data.get('current_model'), **openai_completion_options)
         json_data = {
             'stream': stream,
             'messages': new_messages,
@@ -76,9 +75,7 @@ class Free_4(Platform):
         await self.chat.append_messages(
             result[1] if isinstance(result, tuple) else result, context, *messages)
 
-    async def summary(self, content: str, prompt: str, context, *messages):
-        new_messages = [{'role': 'system', 'content': prompt},
-                        {'role': 'user', 'content': content}]
+    def summary_request(self, new_messages: list) -> tuple[str, dict, dict]:
         json_data = {
             'stream': True,
             'messages': new_messages,
@@ -89,12 +86,4 @@ class Free_4(Platform):
             'user-agent': bot_util.ua.random,
             'authorization': self.openai_api_key
         }
-        try:
-            async with aiohttp.ClientSession(raise_for_status=True, trust_env=True, timeout=aiohttp.ClientTimeout(total=30)) as session:
-                async for summary in SessionWithRetry(session, context).post(f'{self.foreign_openai_base_url}/openai/chat/completions', headers=headers, json=json_data):
-                    answer = summary
-        except:
-            answer = content
-
-        await self.chat.append_messages(
-            answer, context, *messages)
+        return f'{self.foreign_openai_base_url}/openai/chat/completions', headers, json_data
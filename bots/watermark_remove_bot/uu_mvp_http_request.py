@@ -1,16 +1,13 @@
 # 定制化请求
 
-from fake_useragent import FakeUserAgent
 from my_utils.global_var import GLOBAL_SESSION as session
+from my_utils.ua_util import ua
 from my_utils.validation_util import validate
 
 
 requires = validate('UU_MVP_BASE_URL')
 UU_MVP_BASE_URL = requires[0]
 
-# 创建一个 UserAgent 实例
-ua = FakeUserAgent(browsers='chrome', os='windows', platforms='pc')
-
 
 class UuMvpHttpRequest:
 
@@ -7,23 +7,24 @@ import importlib
 import orjson
 import os
 import re
-from redis import ConnectionPool
 import requests
 from urllib.parse import urlparse
 import uuid
 
-from fake_useragent import FakeUserAgent
 from telegram import Update
 from telegram.constants import ParseMode
+from telegram.error import RetryAfter
 from telegram.ext import CallbackContext
 from my_utils import global_var, redis_util
+from my_utils.config_store import ConfigStore
 from my_utils.my_logging import get_logger
+from my_utils.ua_util import ua
 from my_utils.validation_util import validate
-# 随机ua
-ua = FakeUserAgent(browsers="chrome", os='windows', platforms='pc')
 logger = get_logger('bot_util')
 # 临时配置路径
 TEMP_CONFIG_PATH = os.path.join('temp', 'config.json')
+# 临时配置 键为平台key  值为 授权码/认证信息
+TEMP_CONFIG = ConfigStore(TEMP_CONFIG_PATH)
 # 代码分享平台的地址
 HASTE_SERVER_HOST = os.getenv('HASTE_SERVER_HOST', None)
 if not HASTE_SERVER_HOST:
@@ -46,20 +47,27 @@ else:
 
 # 默认平台
 DEFAULT_PLATFORM_KEY: str = os.getenv('DEFAULT_PLATFORM_KEY', 'free_1')
-# 模型注册表
+# 模型注册表 平台类在首次使用时才导入(openai等依赖较重)
 PLATFORMS_REGISTRY = {}
-platforms_path = os.path.abspath(os.path.join('bots', 'gpt_bot', 'platforms'))
-for file in os.listdir(platforms_path):
-    if not file.endswith('.py'):
-        continue
-    name = file.split(".")[0]
-    platform_module = importlib.import_module(f'bots.gpt_bot.platforms.{name}')
+
+
+def get_platform_class(platform_key: str):
+    """
+    获取平台类 首次获取时导入对应的平台模块
+    @param platform_key: 平台key 与bots/gpt_bot/platforms下的模块名一致
+    """
+    platform_class = PLATFORMS_REGISTRY.get(platform_key)
+    if platform_class is not None:
+        return platform_class
+    platform_module = importlib.import_module(
+        f'bots.gpt_bot.platforms.{platform_key}')
     for attr_name in dir(platform_module):
         attr = getattr(platform_module, attr_name)
         if isinstance(attr, type) and getattr(attr, '_is_gpt_platform', False):
-            platform_key = attr._platform_key()
-            PLATFORMS_REGISTRY[platform_key] = attr
-
+            PLATFORMS_REGISTRY[attr._platform_key()] = attr
+    if platform_key not in PLATFORMS_REGISTRY:
+        raise RuntimeError(f'平台{platform_key}不存在!')
+    return PLATFORMS_REGISTRY[platform_key]
 
 def platform_default_mask():
     """平台默认面具
@@ -115,7 +123,9 @@ async def instantiate_platform(platform_key: str = DEFAULT_PLATFORM_KEY, need_lo
     }
     if need_logger:
         logger.info(f'当前使用的openai代理平台为{platform["name"]}.')
-    return PLATFORMS_REGISTRY[platform_key](**platform_init_params)
+    new_platform = get_platform_class(platform_key)(**platform_init_params)
+    register_credentials(new_platform)
+    return new_platform
 
 
 async def migrate_platform(from_platform, to_platform_key: str, context: CallbackContext, max_message_count: int):
@@ -152,15 +162,37 @@ async def migrate_platform(from_platform, to_platform_key: str, context: Callbac
     }
     logger.info(f'当前使用的openai代理平台为{to_platform["name"]}.')
     # 新平台
-    new_platform = PLATFORMS_REGISTRY[to_platform_key](
+    new_platform = get_platform_class(to_platform_key)(
         **platform_init_params)
+    register_credentials(new_platform)
     # 恢复历史消息
-    new_platform.chat._messages.core = from_platform.chat._messages.core
+    new_platform.chat._messages.take_over(from_platform.chat._messages)
     # 修剪历史消息
     new_platform.chat.clear_messages(context)
     return new_platform
 
 
+async def handover_platform(from_platform, to_platform_key: str, max_message_count: int):
+    """
+    自动切换平台(路由) 用户没有要求切换 历史消息原样转交给新平台 不清空
+    @param from_platform 原平台对象
+    @param to_platform_key: 要切换到的平台key
+    @param   max_message_count 最大消息数
+    @return:  平台对象
+    """
+    new_platform = await instantiate_platform(to_platform_key)
+    new_platform.chat.set_max_message_count(max_message_count)
+    new_platform.chat._messages.take_over(from_platform.chat._messages)
+    return new_platform
+
+
+def register_credentials(platform):
+    """ 免费平台的实例登记到授权信息管理 授权刷新后自动同步 """
+    if platform.name in CREDENTIAL_GENERATORS:
+        from bots.gpt_bot.core.credentials import CREDENTIALS
+        CREDENTIALS.register(platform)
+
+
 # =====================================授权相关====================================
 values = validate('ALLOWED_TELEGRAM_USER_IDS')
 # 允许访问的用户列表 逗号分割并去除空格
@@ -172,10 +204,7 @@ def check_visitor_quota(user_id):
     today_date = datetime.date.today()
     redis_key = f"visitor_quota:{user_id}:{today_date}"
 
-    if global_var.REDIS_POOL is None:
-        raise RuntimeError("Redis pool is not initialized.")
-
-    with redis_util.get_redis_client(global_var.REDIS_POOL) as redis_client:
+    with redis_util.get_redis_client(global_var.get_redis_pool()) as redis_client:
         # 获取当前用户今天的访问次数
         count = redis_util.get(redis_client, redis_key)
         if count is None:
@@ -214,12 +243,15 @@ def auth(func):
                 context.user_data['identity'] = 'user'
 
             if context.bot.first_name == 'GPTBot':
-                context.user_data['current_platform'] = await instantiate_platform(
-                    need_logger=True)
+                from bots.gpt_bot.core.persistence import rehydrate
+                # 优先恢复重启前的会话
+                if not await rehydrate(user_id, context.user_data):
+                    context.user_data['current_platform'] = await instantiate_platform(
+                        need_logger=True)
+                    context.user_data['current_mask'] = platform_default_mask()
+                    context.user_data['current_model'] = platform_default_model()
                 context.user_data['candidate_platform'] = await instantiate_platform(
                     platform_key='free_1', need_logger=False)
-                context.user_data['current_mask'] = platform_default_mask()
-                context.user_data['current_model'] = platform_default_model()
         else:
             if context.user_data['identity'] == 'visitor':
                 # 检查访客的每日访问次数是否超限
@@ -228,25 +260,32 @@ def auth(func):
                     return
 
         await func(*args, **kwargs)
+        if 'current_platform' in context.user_data:
+            from bots.gpt_bot.core.persistence import CONVERSATION_STORE
+            CONVERSATION_STORE.mark_dirty(user_id, context.user_data)
 
     return wrapper
 
 
 async def generate_api_key(platform: dict):
-    # 尝试先从临时配置文件获取
-    if os.path.exists(TEMP_CONFIG_PATH):
-        with open(TEMP_CONFIG_PATH, mode='r', encoding='utf-8') as f:
-            temp_config_data: dict = orjson.loads(f.read())
-            #   配置文件键为平台key  值为 授权码/认证信息
-            if platform['platform_key'] in temp_config_data and 'openai_api_key' in temp_config_data[platform['platform_key']]:
-                return temp_config_data[platform['platform_key']]
-    # 扩展性配置  免费节点的特殊操作
-    if platform['platform_key'] == 'free_3':
-        return await generate_authorization(platform)
-    elif platform['platform_key'] == 'free_4':
-        return await generate_authorization(platform)
-    # elif platform['platform_key'] == 'free_1':
-    #     return generate_code(platform)
+    """
+    获取免费平台的授权信息 优先使用内存中的 其次是临时配置文件 都没有或即将过期时重新生成
+    @return: 带openai_api_key的平台配置副本(不修改全局的平台配置)
+    """
+    from bots.gpt_bot.core.credentials import CREDENTIALS
+    platform_key = platform['platform_key']
+    if not CREDENTIALS.manages(platform_key):
+        # 扩展性配置  免费节点的特殊操作
+        CREDENTIALS.register_generator(
+            platform_key, CREDENTIAL_GENERATORS[platform_key], load_saved_api_key)
+    # 加载器同步读取内存 先在线程中检查其他进程的写入
+    await TEMP_CONFIG.refresh()
+    return await CREDENTIALS.resolve(platform)
+
+
+def load_saved_api_key(platform_key: str) -> str | None:
+    """ 从临时配置读取授权信息(内存缓存 文件被其他进程更新后才重新读取) """
+    return (TEMP_CONFIG.get(platform_key) or {}).get('openai_api_key')
 
 
 async def generate_code(platform: dict):
@@ -282,18 +321,8 @@ async def generate_code(platform: dict):
     platform['foreign_openai_base_url'] = f'{url}api/openai/v1'
     platform['openai_api_key'] = f'nk-{code}'
 
-    if os.path.exists(TEMP_CONFIG_PATH):
-        with open(TEMP_CONFIG_PATH, mode='r', encoding='utf-8') as f:
-            old_json_data: dict = orjson.loads(f.read())
-    else:
-        old_json_data = {}
-
     # 刷新临时配置文件
-    with open(TEMP_CONFIG_PATH, mode='w+', encoding='utf-8') as f:
-        old_json_data.update({
-            platform['platform_key']: platform
-        })
-        f.write(orjson.dumps(old_json_data, option=orjson.OPT_INDENT_2).decode())
+    await TEMP_CONFIG.update(platform['platform_key'], platform)
     return platform
 
 
@@ -364,24 +393,21 @@ async def generate_authorization(platform: dict):
             token_type = json_data['token_type']
             platform['openai_api_key'] = f'{token_type} {token}'
 
-            if os.path.exists(TEMP_CONFIG_PATH):
-                with open(TEMP_CONFIG_PATH, mode='r', encoding='utf-8') as f:
-                    old_json_data: dict = orjson.loads(f.read())
-            else:
-                old_json_data = {}
-
             # 刷新临时配置文件
-            with open(TEMP_CONFIG_PATH, mode='w+', encoding='utf-8') as f:
-                old_json_data.update({
-                    platform['platform_key']:  platform
-                })
-                f.write(orjson.dumps(old_json_data,
-                        option=orjson.OPT_INDENT_2).decode())
+            await TEMP_CONFIG.update(platform['platform_key'], platform)
             return platform
         else:
             # 保持原认证信息不变
             raise Exception('刷新认证信息失败!')
 
+
+# 需要爬虫生成授权信息的平台
+CREDENTIAL_GENERATORS = {
+    'free_3': generate_authorization,
+    'free_4': generate_authorization,
+    # 'free_1': generate_code,
+}
+
 # =====================================消息相关====================================
 
 
@@ -406,7 +432,7 @@ async def send_message(update: Update, text):
                 await update.message.reply_text(text)
 
 
-async def edit_message(update: Update, context: CallbackContext, message_id, stream_ended, text):
+async def edit_message(update: Update, context: CallbackContext, message_id, stream_ended, text, retry_after_attempts: int = 2):
     try:
         # 等流式响应完全结束再尝试markdown格式 加快速度
         if stream_ended:
@@ -436,6 +462,12 @@ async def edit_message(update: Update, context: CallbackContext, message_id, str
                 message_id=message_id,
                 disable_web_page_preview=True
             )
+    except RetryAfter as e:
+        # 编辑被限流时AiohttpRequest不会自动重试 最终结果按要求等待后重发 不走代码分享平台
+        if retry_after_attempts <= 0:
+            raise
+        await asyncio.sleep(e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after)
+        await edit_message(update, context, message_id, stream_ended, text, retry_after_attempts - 1)
     except Exception as e:
         if 'Message is not modified' in e.message:
             await context.bot.edit_message_text(
@@ -0,0 +1,161 @@
+""" 多进程共享的json配置文件(temp/config.json) """
+import asyncio
+import contextlib
+import os
+import sys
+import tempfile
+import time
+
+import orjson
+
+from my_utils.my_logging import get_logger
+
+logger = get_logger('config_store')
+
+if sys.platform == 'win32':
+    import msvcrt
+
+    @contextlib.contextmanager
+    def file_lock(lock_path: str):
+        with open(lock_path, 'a+b') as lock_file:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    @contextlib.contextmanager
+    def file_lock(lock_path: str):
+        """ 跨进程的排他锁 """
+        with open(lock_path, 'a+b') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+class ConfigStore:
+    """
+    读: 直接读内存 最多每check_interval秒在线程中检查一次文件的修改时间 其他进程写入后才重新加载
+    写: 在线程中执行 持有文件锁 重新读取最新内容后合并 写入临时文件再原子替换
+    文件操作都在线程中执行 内存数据只在事件循环中替换
+    """
+
+    def __init__(self, path: str, check_interval: float = 2.0):
+        self.path = path
+        self.lock_path = f'{path}.lock'
+        # 检查文件变化的最小间隔(秒)
+        self.check_interval = check_interval
+        self._data: dict = {}
+        # 已加载文件的(修改时间, 大小)
+        self._signature: tuple | None = None
+        self._checked_at = 0.0
+        # get()触发的后台刷新
+        self._refresh_task: asyncio.Task | None = None
+
+    def _stat_signature(self) -> tuple | None:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _read_file(self) -> dict:
+        try:
+            with open(self.path, mode='rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            return {}
+        try:
+            return orjson.loads(content) if content else {}
+        except orjson.JSONDecodeError:
+            logger.warning(f'{self.path}内容损坏 已忽略')
+            return {}
+
+    def _due(self) -> bool:
+        return not self._checked_at or time.monotonic() - self._checked_at >= self.check_interval
+
+    def _load_changed(self, signature: tuple | None) -> tuple[dict, tuple | None] | None:
+        """
+        文件有变化时重新读取 不修改实例状态(可在线程中执行)
+        @param signature: 已加载文件的签名
+        @return: (内容, 签名) 没有变化时为None
+        """
+        current = self._stat_signature()
+        if current == signature:
+            return None
+        return self._read_file(), current
+
+    def _apply(self, signature: tuple | None, loaded: tuple[dict, tuple | None] | None):
+        # 读取期间本进程写入过的 以写入的内容为准
+        if loaded is not None and self._signature == signature:
+            self._data, self._signature = loaded
+
+    async def refresh(self):
+        """ 最多每check_interval秒检查一次文件 在线程中读取 在事件循环中替换内存数据 """
+        if not self._due():
+            return
+        self._checked_at = time.monotonic()
+        signature = self._signature
+        self._apply(signature, await asyncio.to_thread(self._load_changed, signature))
+
+    def get(self, key: str, default=None):
+        """
+        读取配置 在事件循环中不阻塞: 返回内存中的数据 需要检查文件时在后台刷新
+        需要立即读到其他进程的写入时先await refresh()
+        """
+        if self._due():
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                # 不在事件循环中(如启动时) 直接读取
+                self._checked_at = time.monotonic()
+                self._apply(self._signature, self._load_changed(self._signature))
+            else:
+                if self._refresh_task is None:
+                    self._refresh_task = loop.create_task(self.refresh())
+                    self._refresh_task.add_done_callback(self._refresh_done)
+        return self._data.get(key, default)
+
+    def _refresh_done(self, task: asyncio.Task):
+        self._refresh_task = None
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f'{self.path}刷新失败: {task.exception()}')
+
+    def invalidate(self):
+        """ 下一次读取时强制检查文件 """
+        self._checked_at = 0.0
+
+    async def update(self, key: str, value):
+        """ 更新配置 """
+        data, signature = await asyncio.to_thread(self._update_locked, key, value)
+        self._data, self._signature = data, signature
+        self._checked_at = time.monotonic()
+
+    def _update_locked(self, key: str, value) -> tuple[dict, tuple | None]:
+        """ 在线程中执行 不修改实例状态 @return: (写入后的内容, 文件签名) """
+        directory = os.path.dirname(self.path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        with file_lock(self.lock_path):
+            # 其他进程可能刚写入过 以文件中的最新内容为准
+            data = self._read_file()
+            data[key] = value
+            content = orjson.dumps(data, option=orjson.OPT_INDENT_2)
+            fd, temp_path = tempfile.mkstemp(
+                prefix='.config-', suffix='.tmp', dir=directory)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(content)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_path, self.path)
+            except BaseException:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(temp_path)
+                raise
+            return data, self._stat_signature()
@@ -106,33 +106,70 @@ dns_map = {
 default_dns = '127.0.0.1'
 # 优先返回ipv4记录
 default_family = socket.AF_INET
-# 创建自定义解析器实例
-custom_resolver = CustomResolver(dns_map, default_dns, default_family)
-
-# 全局会话
-GLOBAL_SESSION = aiohttp.ClientSession(
-    trust_env=True,  # 是否使用代理
-    raise_for_status=True,  # 自动抛异常
-    timeout=aiohttp.ClientTimeout(total=300),
-    connector_owner=True,  # 拥有连接池控制权
-    connector=aiohttp.TCPConnector(
-        limit=100,  # 最大连接数
-        limit_per_host=10,  # 每个主机的最大连接数
-        resolver=custom_resolver,  # 配置dns解析器
-        use_dns_cache=True,  # 是否使用dns缓存
-        ttl_dns_cache=3600,  # dns缓存时间
-        keepalive_timeout=3600  # 空闲连接存活时间
-    )
-)
-
-# Redis连接池用于存储每日访问计数和过期时间
-REDIS_POOL: ConnectionPool = redis_util.create_redis_pool()
+
+# 全局会话 首次使用时才创建: 多进程模式下由子进程创建 不会在fork前绑定父进程的事件循环和连接
+_session: aiohttp.ClientSession | None = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    """ 获取全局会话 """
+    global _session
+    if _session is None:
+        _session = aiohttp.ClientSession(
+            trust_env=True,  # 是否使用代理
+            raise_for_status=True,  # 自动抛异常
+            timeout=aiohttp.ClientTimeout(total=300),
+            connector_owner=True,  # 拥有连接池控制权
+            connector=aiohttp.TCPConnector(
+                limit=100,  # 最大连接数
+                limit_per_host=10,  # 每个主机的最大连接数
+                resolver=CustomResolver(dns_map, default_dns, default_family),  # 配置dns解析器
+                use_dns_cache=True,  # 是否使用dns缓存
+                ttl_dns_cache=3600,  # dns缓存时间
+                keepalive_timeout=3600  # 空闲连接存活时间
+            )
+        )
+    return _session
+
+
+class LazySession:
+    """ 全局会话的占位对象 访问属性时才创建真正的会话 兼容 from my_utils.global_var import GLOBAL_SESSION 的写法 """
+    __slots__ = ()
+
+    def __getattr__(self, name: str):
+        return getattr(get_session(), name)
+
+    def __repr__(self) -> str:
+        return f'LazySession({_session!r})'
+
+
+GLOBAL_SESSION = LazySession()
+
+# Redis连接池用于存储每日访问计数和过期时间 首次使用时才创建(此时.env已加载)
+_redis_pool: ConnectionPool | None = None
+
+
+def get_redis_pool() -> ConnectionPool:
+    """ 获取Redis连接池 """
+    global _redis_pool
+    if _redis_pool is None:
+        _redis_pool = redis_util.create_redis_pool()
+    return _redis_pool
+
+
+def __getattr__(name: str):
+    # 兼容global_var.REDIS_POOL的写法
+    if name == 'REDIS_POOL':
+        return get_redis_pool()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 async def close_session():
     """ 关闭连接 """
-    await GLOBAL_SESSION.close()
-    redis_util.close_redis_pool(REDIS_POOL)
+    if _session is not None:
+        await _session.close()
+    if _redis_pool is not None:
+        redis_util.close_redis_pool(_redis_pool)
 
 
 def atexit_handler():
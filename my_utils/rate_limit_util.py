@@ -0,0 +1,182 @@
+""" Telegram Bot API的出站限流工具 """
+import asyncio
+import heapq
+import itertools
+import time
+
+from my_utils.my_logging import get_logger
+
+logger = get_logger('rate_limit_util')
+
+# 优先级 数值越小越优先
+PRIORITY_SEND = 0
+PRIORITY_EDIT = 1
+PRIORITY_TYPING = 2
+
+# 发送类接口
+SEND_METHODS = frozenset({
+    'sendMessage', 'sendPhoto', 'sendDocument', 'sendAudio', 'sendVoice', 'sendVideo',
+    'sendAnimation', 'sendSticker', 'sendMediaGroup', 'copyMessage', 'forwardMessage'
+})
+# 编辑类接口 属于锦上添花
+EDIT_METHODS = frozenset({
+    'editMessageText', 'editMessageReplyMarkup', 'editMessageCaption', 'editMessageMedia'
+})
+# 输入状态
+TYPING_METHODS = frozenset({'sendChatAction'})
+
+
+def method_priority(method: str) -> int | None:
+    """ 接口对应的优先级 None表示不限流(getUpdates/getFile/answerCallbackQuery等) """
+    if method in SEND_METHODS:
+        return PRIORITY_SEND
+    if method in EDIT_METHODS:
+        return PRIORITY_EDIT
+    if method in TYPING_METHODS:
+        return PRIORITY_TYPING
+    return None
+
+
+class TokenBucket:
+    """ 令牌桶 等待令牌时按照优先级排队 可被retry_after整体冻结 """
+
+    def __init__(self, rate: float, capacity: float):
+        # 每秒生成的令牌数
+        self.rate = rate
+        # 桶容量(允许的突发量)
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        # 被限流冻结到的时间点
+        self._blocked_until = 0.0
+        # 等待队列 (优先级, 序号, future)
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+        self._timer: asyncio.TimerHandle | None = None
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens +
+                           (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self) -> bool:
+        """ 不等待地获取令牌 """
+        if self._waiters:
+            # 已有请求在排队 不能插队
+            return False
+        return self._take()
+
+    def _take(self) -> bool:
+        now = time.monotonic()
+        if now < self._blocked_until:
+            return False
+        self._refill(now)
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    async def acquire(self, priority: int = PRIORITY_SEND):
+        """ 获取令牌 高优先级的请求先拿到令牌 """
+        if self.try_acquire():
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        self._schedule()
+        await future
+
+    def block(self, seconds: float):
+        """ 收到retry_after后冻结整个桶 """
+        self._blocked_until = max(
+            self._blocked_until, time.monotonic() + seconds)
+        self._tokens = 0
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        self._schedule()
+
+    @property
+    def idle(self) -> bool:
+        """ 桶已满且无人排队 可以被回收 """
+        now = time.monotonic()
+        self._refill(now)
+        return not self._waiters and self._tokens >= self.capacity and now >= self._blocked_until
+
+    def _schedule(self):
+        if self._timer or not self._waiters:
+            return
+        now = time.monotonic()
+        self._refill(now)
+        delay = max(self._blocked_until - now,
+                    (1 - self._tokens) / self.rate, 0)
+        self._timer = asyncio.get_running_loop().call_later(delay, self._release)
+
+    def _release(self):
+        self._timer = None
+        waiters = self._waiters
+        while waiters:
+            _, _, future = waiters[0]
+            if future.done():
+                # 等待方已取消
+                heapq.heappop(waiters)
+                continue
+            if not self._take():
+                break
+            heapq.heappop(waiters)
+            future.set_result(None)
+        self._schedule()
+
+
+class FloodLimiter:
+    """ 全局 + 单个会话两级限流 """
+
+    # 会话桶数量超过该值时清理空闲的桶
+    MAX_CHAT_BUCKETS = 2048
+
+    def __init__(self, global_rate: float = 30, private_rate: float = 1, group_rate: float = 20 / 60,
+                 burst: float = 3):
+        # 全局 每秒最多30条
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self._chat_buckets: dict[int | str, TokenBucket] = {}
+
+    def chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.MAX_CHAT_BUCKETS:
+                self._evict()
+            # 群组(负数id)的限制比私聊严格得多
+            is_group = str(chat_id).startswith('-')
+            bucket = self._chat_buckets[chat_id] = TokenBucket(
+                self.group_rate if is_group else self.private_rate, self.burst)
+        return bucket
+
+    def _evict(self):
+        for chat_id in [chat_id for chat_id, bucket in self._chat_buckets.items() if bucket.idle]:
+            del self._chat_buckets[chat_id]
+
+    async def acquire(self, chat_id, priority: int) -> bool:
+        """
+        获取发送许可
+        @return: False表示输入状态这类请求被直接丢弃
+        """
+        chat_bucket = self.chat_bucket(chat_id) if chat_id is not None else None
+        if priority == PRIORITY_TYPING:
+            # 输入状态只是提示 拿不到令牌就丢弃 不和正文抢额度
+            if chat_bucket and not chat_bucket.try_acquire():
+                return False
+            return self.global_bucket.try_acquire()
+        if chat_bucket:
+            await chat_bucket.acquire(priority)
+        await self.global_bucket.acquire(priority)
+        return True
+
+    def block(self, chat_id, seconds: float):
+        """ 按照retry_after冻结对应会话 没有会话时冻结全局 """
+        logger.warning(f'flood control: chat={chat_id} retry_after={seconds}s')
+        if chat_id is not None:
+            self.chat_bucket(chat_id).block(seconds)
+        else:
+            self.global_bucket.block(seconds)
@@ -1,5 +1,6 @@
 import os
 import redis
+from redis.client import NEVER_DECODE
 
 
 def create_redis_pool() -> redis.ConnectionPool:
@@ -36,3 +37,8 @@ def get(redis_client: redis.StrictRedis, key):
 def set(redis_client: redis.StrictRedis, key, value, expire):
     """ 设置值 """
     redis_client.set(key, value, expire)
+
+
+def get_bytes(redis_client: redis.StrictRedis, key) -> bytes | None:
+    """ 获取二进制值 连接池开启了decode_responses 需要跳过解码 """
+    return redis_client.execute_command('GET', key, **{NEVER_DECODE: []})
@@ -1,22 +1,93 @@
 """ 计算token消耗的工具 """
-import tiktoken
+import functools
 
-# 编码器
-encoder = tiktoken.get_encoding('cl100k_base')
+# 默认编码 非OpenAI模型(claude/gemini/llama等)没有公开的词表 用它近似
+DEFAULT_ENCODING = 'cl100k_base'
+# 各模型的上下文窗口 按前缀匹配 更具体的前缀放在前面
+MODEL_CONTEXT_WINDOWS = (
+    ('gpt-4o', 128000),
+    ('gpt-4-turbo', 128000),
+    ('gpt-4-32k', 32768),
+    ('gpt-4', 8192),
+    ('gpt-3.5-turbo', 16385),
+    ('claude-3', 200000),
+    ('gemini-1.5', 1000000),
+    ('deepseek', 32768),
+    ('零一万物', 32768),
+    ('llama', 8192),
+)
+# 未知模型的上下文窗口
+DEFAULT_CONTEXT_WINDOW = 8192
+# 为回答预留的token数(面具未配置max_tokens时) 不超过窗口的1/4
+COMPLETION_RESERVE = 4096
+# 每条消息的格式开销(role/分隔符)
+MESSAGE_OVERHEAD = 4
+# 单张图片的估算token数(高清模式单个512分块为170 按4块+基础85估算)
+IMAGE_TOKENS = 765
 
 
-def count_token(content: str):
+@functools.cache
+def get_encoder(encoding_name: str = DEFAULT_ENCODING):
+    """ 编码器 首次使用时才加载tiktoken及其词表 """
+    import tiktoken
+    return tiktoken.get_encoding(encoding_name)
+
+
+@functools.cache
+def encoding_name_for_model(model: str | None) -> str:
+    """ 模型对应的编码名称 """
+    if model:
+        from tiktoken.model import encoding_name_for_model as tiktoken_encoding_name
+        try:
+            return tiktoken_encoding_name(model)
+        except KeyError:
+            pass
+    return DEFAULT_ENCODING
+
+
+@functools.cache
+def context_window(model: str | None) -> int:
+    """ 模型的上下文窗口 """
+    model = (model or '').lower()
+    for prefix, window in MODEL_CONTEXT_WINDOWS:
+        if model.startswith(prefix):
+            return window
+    return DEFAULT_CONTEXT_WINDOW
+
+
+def context_budget(model: str | None, max_tokens: int | None = None) -> int:
+    """ 提示词(含历史消息)可用的token数 = 上下文窗口 - 为回答预留的token """
+    window = context_window(model)
+    return window - (max_tokens or min(COMPLETION_RESERVE, window // 4))
+
+
+def count_token(content: str, encoding_name: str = DEFAULT_ENCODING):
     """ 计算单条内容的token """
-    return len(encoder.encode(content))
+    return len(get_encoder(encoding_name).encode(content, disallowed_special=()))
+
+
+def count_message_tokens(message: dict, encoding_name: str = DEFAULT_ENCODING) -> int:
+    """ 计算单条消息的token 兼容多模态消息(文本+图片) """
+    content = message.get('content')
+    if isinstance(content, str):
+        return MESSAGE_OVERHEAD + count_token(content, encoding_name)
+    tokens = MESSAGE_OVERHEAD
+    for part in content or ():
+        if isinstance(part, str):
+            tokens += count_token(part, encoding_name)
+        elif part.get('type') == 'text':
+            tokens += count_token(part.get('text', ''), encoding_name)
+        else:
+            tokens += IMAGE_TOKENS
+    return tokens
 
 
-def count_tokens(messages: list[dict]):
+def count_tokens(messages: list[dict], encoding_name: str = DEFAULT_ENCODING):
     """ 计算总消息的token """
     total_tokens = 0
     for message in messages:
         # 每个消息的 token 数
-        message_tokens = encoder.encode(message['content'])
-        total_tokens += len(message_tokens)
+        total_tokens += count_message_tokens(message, encoding_name)
 
     return total_tokens
 
@@ -24,9 +95,9 @@ def count_tokens(messages: list[dict]):
 if __name__ == '__main__':
     # 示例消息历史
     messages = [
-        "你好！你今天怎么样？",
-        "我很好，谢谢！你呢？",
-        "我也很好。有什么可以帮你的吗？"
+        {'role': 'user', 'content': "你好！你今天怎么样？"},
+        {'role': 'assistant', 'content': "我很好，谢谢！你呢？"},
+        {'role': 'user', 'content': "我也很好。有什么可以帮你的吗？"}
     ]
 
     # 计算总 token 数
@@ -0,0 +1,38 @@
+""" 共享的随机user-agent池 """
+import random
+
+# 预生成的user-agent数量
+POOL_SIZE = 64
+# fake_useragent不可用时的兜底
+FALLBACK_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36'
+
+
+class UserAgentPool:
+    """ 首次使用时通过FakeUserAgent预生成一批user-agent 之后只做随机选择 整个进程共用一份 """
+
+    def __init__(self, size: int = POOL_SIZE, **fake_useragent_options):
+        self.size = size
+        self.fake_useragent_options = fake_useragent_options
+        self._pool: tuple[str, ...] | None = None
+
+    @property
+    def pool(self) -> tuple[str, ...]:
+        if self._pool is None:
+            try:
+                from fake_useragent import FakeUserAgent
+                fake_ua = FakeUserAgent(**self.fake_useragent_options)
+                # 去重后保持顺序
+                self._pool = tuple(dict.fromkeys(
+                    fake_ua.random for _ in range(self.size))) or (FALLBACK_USER_AGENT,)
+            except Exception:
+                self._pool = (FALLBACK_USER_AGENT,)
+        return self._pool
+
+    @property
+    def random(self) -> str:
+        """ 与FakeUserAgent.random用法一致 """
+        return random.choice(self.pool)
+
+
+# 随机ua
+ua = UserAgentPool(browsers='chrome', os='windows', platforms='pc')